@@ -3,15 +3,28 @@
 # ==============================
 
 import os
+import json
 import asyncio
+import bisect
+import inspect
 import logging
 import sqlite3
 import random
+import threading
+import time
+import heapq
+import itertools
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, NamedTuple, Optional, Union
 
-from aiogram import Bot, Dispatcher, Router, types
-from aiogram.filters import Command, CommandStart
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router, types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.filters import Command, CommandStart, Filter, StateFilter
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -120,18 +133,76 @@ class PlayerStates(StatesGroup):
     in_battle = State()
     in_hunt = State()
 
+class ClanStates(StatesGroup):
+    waiting_clan_name = State()
+
+class AdminStates(StatesGroup):
+    admin_give_currency = State()
+
 # ==============================
 # БАЗА ДАННЫХ
 # ==============================
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('magic_rpg.db', check_same_thread=False)
-        self.create_tables()
+    """Хранилище игры. Вся работа с SQLite идет в отдельном потоке, хендлеры используют только await-методы"""
 
-    def create_tables(self):
-        cursor = self.conn.cursor()
+    # Окно группового коммита и максимальный размер пачки записей
+    WRITE_BATCH_DELAY = 0.005
+    WRITE_BATCH_SIZE = 256
+
+    # Профиль хранилища: WAL позволяет читать параллельно с записью
+    PRAGMAS = (
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -16000),  # в КиБ
+    )
+    READ_POOL_SIZE = 4
+
+    # Кэш игроков: сколько держим в памяти и как часто сбрасываем изменения
+    PLAYER_CACHE_SIZE = 10000
+    PLAYER_FLUSH_INTERVAL = 5.0
 
+    # Верхние границы для apply_deltas: число или колонка игрока (нижняя граница всегда 0)
+    PLAYER_CEILINGS = {
+        'health': 'max_health',
+        'mana': 'max_mana',
+        'energy': GameConfig.ENERGY_MAX,
+    }
+    # Валюты: трата больше баланса отклоняется целиком, а не обрезается до нуля
+    SPEND_FIELDS = ('gold', 'sapphires')
+
+    # Энергия хранится как (energy, energy_ts) и досчитывается при чтении
+    ENERGY_REGEN_PERIOD = 60  # секунд на ENERGY_REGEN единиц
+
+    def __init__(self, path: str = 'magic_rpg.db'):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self._apply_pragmas(self.conn)
+        # Один выделенный поток на соединение: медленный commit не блокирует event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        # Пул потоков с read-only соединениями для тяжелых SELECT (топы, статистика)
+        self._readers = threading.local()
+        self.read_executor = ThreadPoolExecutor(max_workers=self.READ_POOL_SIZE, thread_name_prefix='sqlite-read')
+        # Очередь изменений и единственный писатель, создаются при первой записи
+        self._writes: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        # Write-behind кэш игроков: LRU по user_id и измененные поля, ожидающие записи
+        self._players: OrderedDict = OrderedDict()
+        self._dirty: Dict[int, set] = {}
+        self._flushing: set = set()
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        # Копии игроков, уже собранные в рамках текущего апдейта (см. player_scope)
+        self._scope: ContextVar[Optional[Dict[int, Dict]]] = ContextVar('player_scope', default=None)
+
+    def _apply_pragmas(self, conn: sqlite3.Connection):
+        for name, value in self.PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+
+    @staticmethod
+    def create_tables(cursor):
+        """Базовые таблицы игроков и инвентаря"""
         # Игроки
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS players (
@@ -170,10 +241,222 @@ class Database:
             )
         ''')
 
-        self.conn.commit()
+    # ------------------------------
+    # Выполнение в потоке базы данных
+    # ------------------------------
+
+    async def run(self, func: Callable, *args) -> Any:
+        """Ставит func(cursor, *args) в очередь записи и ждет, пока пачка с ней будет зафиксирована"""
+        if self._writer is None or self._writer.done():
+            self._writes = asyncio.Queue()
+            self._writer = asyncio.create_task(self._write_loop())
+
+        future = asyncio.get_running_loop().create_future()
+        self._writes.put_nowait((func, args, future))
+        return await future
+
+    async def _write_loop(self):
+        """Единственный писатель: собирает изменения в пачки и коммитит их одной транзакцией"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._writes.get()]
+            # Даем соседним запросам попасть в ту же транзакцию
+            await asyncio.sleep(self.WRITE_BATCH_DELAY)
+            while not self._writes.empty() and len(batch) < self.WRITE_BATCH_SIZE:
+                batch.append(self._writes.get_nowait())
+
+            try:
+                results = await loop.run_in_executor(self.executor, self._commit_batch, batch)
+            except Exception as e:
+                logging.exception("Не удалось зафиксировать пачку записей")
+                results = [(False, e)] * len(batch)
+
+            for (_, _, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
 
-    def get_player(self, user_id: int) -> Optional[Dict]:
+    def _commit_batch(self, batch: list) -> list:
+        """Выполняет пачку изменений одной транзакцией, каждое изменение в своем SAVEPOINT"""
         cursor = self.conn.cursor()
+        results = []
+        cursor.execute('BEGIN')
+        try:
+            for func, args, _ in batch:
+                cursor.execute('SAVEPOINT write_job')
+                try:
+                    results.append((True, func(cursor, *args)))
+                except Exception as e:
+                    # Ошибка одного запроса не откатывает остальных
+                    cursor.execute('ROLLBACK TO write_job')
+                    results.append((False, e))
+                cursor.execute('RELEASE write_job')
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return results
+
+    async def _read(self, func: Callable, *args, readonly: bool = False) -> Any:
+        loop = asyncio.get_running_loop()
+        if readonly:
+            return await loop.run_in_executor(self.read_executor, self._run_pooled_read, func, args)
+        return await loop.run_in_executor(self.executor, self._run_read, func, args)
+
+    def _run_read(self, func: Callable, args: tuple) -> Any:
+        return func(self.conn.cursor(), *args)
+
+    def _run_pooled_read(self, func: Callable, args: tuple) -> Any:
+        # У каждого потока пула свое read-only соединение
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+            self._apply_pragmas(conn)
+            self._readers.conn = conn
+        return func(conn.cursor(), *args)
+
+    async def fetchone(self, query: str, params: tuple = (), readonly: bool = False) -> Optional[tuple]:
+        return await self._read(lambda cursor: cursor.execute(query, params).fetchone(), readonly=readonly)
+
+    async def fetchall(self, query: str, params: tuple = (), readonly: bool = False) -> List[tuple]:
+        return await self._read(lambda cursor: cursor.execute(query, params).fetchall(), readonly=readonly)
+
+    async def fetchval(self, query: str, params: tuple = (), default: Any = None, readonly: bool = False) -> Any:
+        """Возвращает первое поле первой строки или default"""
+        row = await self.fetchone(query, params, readonly=readonly)
+        return row[0] if row and row[0] is not None else default
+
+    async def execute(self, query: str, params: tuple = ()) -> int:
+        """Выполняет изменяющий запрос и возвращает lastrowid"""
+        return await self.run(lambda cursor: cursor.execute(query, params).lastrowid)
+
+    async def backup(self, path: str):
+        """Копирует базу через SQLite backup API на потоке писателя, между пачками: в копию попадает и WAL"""
+        def copy(cursor):
+            target = sqlite3.connect(path)
+            try:
+                cursor.connection.backup(target)
+            finally:
+                target.close()
+
+        await self._read(copy)
+
+    async def migrate(self, migrations: List[Callable]) -> int:
+        """Применяет миграции с номером больше PRAGMA user_version и возвращает итоговую версию"""
+        return await self.run(self._migrate, migrations)
+
+    @staticmethod
+    def _migrate(cursor, migrations: List[Callable]) -> int:
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(migrations, 1):
+            if number <= version:
+                continue
+            # Миграция и новая версия фиксируются той же транзакцией
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {number}')
+            logging.info(f"Схема обновлена до версии {number}: {migration.__doc__}")
+        return max(version, len(migrations))
+
+    # ------------------------------
+    # Игроки
+    # ------------------------------
+
+    async def get_player(self, user_id: int) -> Optional[Dict]:
+        """Возвращает копию игрока из кэша, при промахе загружает его из базы"""
+        scope = self._scope.get()
+        if scope is not None and user_id in scope:
+            return dict(scope[user_id])
+
+        player = await self._cached_player(user_id)
+        if player is None:
+            return None
+        player = self._snapshot(player)
+        if scope is not None:
+            scope[user_id] = dict(player)
+        return player
+
+    @contextmanager
+    def player_scope(self):
+        """Кэш на время одного апдейта: повторные get_player внутри него не собирают запись заново"""
+        scope = {}
+        token = self._scope.set(scope)
+        try:
+            yield
+        finally:
+            self._scope.reset(token)
+            # Фоновые задачи, запущенные из хендлера, держат ссылку на словарь и не должны видеть старые записи
+            scope.clear()
+
+    def _forget_scoped(self, user_id: int):
+        scope = self._scope.get()
+        if scope is not None:
+            scope.pop(user_id, None)
+
+    async def _cached_player(self, user_id: int) -> Optional[Dict]:
+        """Возвращает живую запись игрока из LRU-кэша, при промахе загружает ее"""
+        player = self._players.get(user_id)
+        if player is None:
+            player = await self._load_player(user_id, lambda: self._read(self._get_player, user_id))
+            if player is None:
+                return None
+        self._players.move_to_end(user_id)
+        self._evict_players()
+        return player
+
+    def _snapshot(self, player: Dict) -> Dict:
+        """Копия записи для хендлеров с энергией, досчитанной на текущий момент"""
+        player = dict(player)
+        player['energy'], player['energy_ts'] = self.regenerate_energy(player['energy'], player['energy_ts'])
+        return player
+
+    @classmethod
+    def regenerate_energy(cls, energy: int, energy_ts: int, now: Optional[int] = None) -> tuple:
+        """Возвращает текущую энергию и новую точку отсчета по сохраненной паре (energy, energy_ts)"""
+        now = int(time.time()) if now is None else now
+        if energy >= GameConfig.ENERGY_MAX:
+            # Полная энергия не копится: отсчет начнется с момента траты
+            return energy, now
+        periods = max(0, now - (energy_ts or 0)) // cls.ENERGY_REGEN_PERIOD
+        energy = min(GameConfig.ENERGY_MAX, energy + periods * GameConfig.ENERGY_REGEN)
+        if energy >= GameConfig.ENERGY_MAX:
+            return energy, now
+        # Неполный период не теряется: сдвигаем отсчет только на прошедшие целые периоды
+        return energy, energy_ts + periods * cls.ENERGY_REGEN_PERIOD
+
+    async def _load_player(self, user_id: int, load: Callable[[], Awaitable]) -> Optional[Dict]:
+        """Загружает игрока в кэш; одновременные промахи по одному игроку ждут одну загрузку
+
+        Ждущие получают тот же итог, что и первый: запись, None или исключение загрузки.
+        """
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            return await asyncio.shield(loading)
+
+        loading = self._loading[user_id] = asyncio.get_running_loop().create_future()
+        try:
+            player = await load()
+            if player is not None:
+                self._players[user_id] = player
+                self._start_flusher()
+        except Exception as e:
+            del self._loading[user_id]
+            loading.set_exception(e)
+            # Ждущих может и не быть: не даем asyncio ругаться на непрочитанное исключение
+            loading.exception()
+            raise
+        except BaseException:
+            del self._loading[user_id]
+            loading.cancel()
+            raise
+        del self._loading[user_id]
+        loading.set_result(player)
+        return player
+
+    @staticmethod
+    def _get_player(cursor, user_id: int) -> Optional[Dict]:
         cursor.execute('SELECT * FROM players WHERE user_id = ?', (user_id,))
         row = cursor.fetchone()
         if row:
@@ -181,8 +464,11 @@ class Database:
             return dict(zip(columns, row))
         return None
 
-    def create_player(self, user_id: int, username: str, character_name: str, character_class: str):
-        cursor = self.conn.cursor()
+    async def create_player(self, user_id: int, username: str, character_name: str, character_class: str):
+        await self.run(self._create_player, user_id, username, character_name, character_class)
+
+    @staticmethod
+    def _create_player(cursor, user_id: int, username: str, character_name: str, character_class: str):
         class_stats = GameConfig.CLASSES[character_class]
 
         cursor.execute('''
@@ -196,57 +482,678 @@ class Database:
             class_stats['damage'], class_stats['defense'],
             class_stats['intellect'], class_stats['agility']
         ))
-        self.conn.commit()
 
-    def update_player_stats(self, user_id: int, updates: Dict):
-        cursor = self.conn.cursor()
-        set_clause = ', '.join([f"{key} = ?" for key in updates.keys()])
-        values = list(updates.values()) + [user_id]
+    async def update_player_stats(self, user_id: int, updates: Dict):
+        """Меняет поля игрока в памяти, в базу они попадут при ближайшем сбросе кэша"""
+        if not updates:
+            return
+        player = await self._cached_player(user_id)
+        if player is None:
+            return
+
+        if 'energy' in updates and 'energy_ts' not in updates:
+            updates = {**updates, 'energy_ts': int(time.time())}
+        player.update(updates)
+        self._dirty.setdefault(user_id, set()).update(updates)
+        self._forget_scoped(user_id)
+
+    async def apply_deltas(self, user_id: int, deltas: Dict[str, int], allow_partial: bool = False) -> Optional[Dict]:
+        """Прибавляет deltas к полям игрока с учетом границ и возвращает свежую запись
+
+        None — игрок не найден или ему не хватает валюты на трату; тогда не меняется ни одно поле.
+        allow_partial=True для штрафов: валюта списывается сколько есть, до нуля.
+        """
+        if user_id not in self._players and user_id not in self._loading and 'energy' not in deltas:
+            # Игрока нет в памяти: один UPDATE ... RETURNING вместо чтения и записи
+            player = await self._load_player(
+                user_id, lambda: self.run(self._apply_deltas_returning, user_id, deltas, allow_partial)
+            )
+            if player is None:
+                return None
+            self._players.move_to_end(user_id)
+            self._evict_players()
+            self._forget_scoped(user_id)
+            return self._snapshot(player)
+
+        player = await self._cached_player(user_id)
+        if player is None:
+            return None
+
+        if not allow_partial and not self.can_afford(player, deltas):
+            return None
+
+        if 'energy' in deltas:
+            # Перед тратой фиксируем накопленную энергию, иначе восстановление потеряется
+            player['energy'], player['energy_ts'] = self.regenerate_energy(player['energy'], player['energy_ts'])
+            self._dirty.setdefault(user_id, set()).add('energy_ts')
+        for field, delta in deltas.items():
+            player[field] += delta
+        for field in deltas:
+            ceiling = self.PLAYER_CEILINGS.get(field)
+            if isinstance(ceiling, str):
+                ceiling = player[ceiling]
+            player[field] = max(0, player[field])
+            if ceiling is not None:
+                player[field] = min(player[field], ceiling)
+
+        self._dirty.setdefault(user_id, set()).update(deltas)
+        self._forget_scoped(user_id)
+        return self._snapshot(player)
+
+    async def run_with_charge(self, user_id: int, costs: Dict[str, int], func: Callable, *args) -> Optional[tuple]:
+        """Списывает costs и выполняет func(cursor, *args) одной транзакцией
+
+        Возвращает (свежая запись игрока, результат func) или None, если средств не хватает.
+        Если транзакция откатилась, списание в кэше отменяется и ошибка пробрасывается дальше.
+        """
+        player = await self._cached_player(user_id)
+        deltas = {field: -amount for field, amount in costs.items() if amount}
+        if player is None or not self.can_afford(player, deltas):
+            return None
+
+        # Списываем в кэше сразу: параллельная трата уже увидит уменьшенный баланс.
+        # Грязные поля не вытесняются из кэша, пока транзакция не завершится
+        for field, delta in deltas.items():
+            player[field] += delta
+        self._dirty.setdefault(user_id, set()).update(deltas)
+        self._forget_scoped(user_id)
+        charged = {field: player[field] for field in deltas}
+
+        def charge_and_run(cursor):
+            if charged:
+                set_clause = ', '.join(f'{field} = ?' for field in charged)
+                cursor.execute(f'UPDATE players SET {set_clause} WHERE user_id = ?', [*charged.values(), user_id])
+                if cursor.rowcount == 0:
+                    raise LookupError(f"Игрок {user_id} не найден")
+            return func(cursor, *args)
+
+        try:
+            result = await self.run(charge_and_run)
+        except Exception:
+            for field, delta in deltas.items():
+                player[field] -= delta
+            self._dirty.setdefault(user_id, set()).update(deltas)
+            self._forget_scoped(user_id)
+            raise
+        return self._snapshot(player), result
+
+    @classmethod
+    def can_afford(cls, player: Dict, deltas: Dict[str, int]) -> bool:
+        return all(player[field] + deltas.get(field, 0) >= 0 for field in cls.SPEND_FIELDS)
+
+    @classmethod
+    def _apply_deltas_returning(cls, cursor, user_id: int, deltas: Dict[str, int],
+                                allow_partial: bool = False) -> Optional[Dict]:
+        assignments = []
+        values = []
+        for field, delta in deltas.items():
+            expression = f'MAX(0, {field} + ?)'
+            params = [delta]
+            ceiling = cls.PLAYER_CEILINGS.get(field)
+            if isinstance(ceiling, str):
+                # Потолок считаем от нового значения, если он меняется в этом же запросе
+                if ceiling in deltas:
+                    expression = f'MIN({ceiling} + ?, {expression})'
+                    params.insert(0, deltas[ceiling])
+                else:
+                    expression = f'MIN({ceiling}, {expression})'
+            elif ceiling is not None:
+                expression = f'MIN(?, {expression})'
+                params.insert(0, ceiling)
+            assignments.append(f'{field} = {expression}')
+            values.extend(params)
+
+        # Трата валюты проходит только целиком: иначе строка не совпадет и вернется None
+        guards = [] if allow_partial else [
+            field for field in cls.SPEND_FIELDS if deltas.get(field, 0) < 0
+        ]
+        guard_clause = ''.join(f' AND {field} + ? >= 0' for field in guards)
+
+        cursor.execute(
+            f'UPDATE players SET {", ".join(assignments)} WHERE user_id = ?{guard_clause} RETURNING *',
+            values + [user_id] + [deltas[field] for field in guards]
+        )
+        row = cursor.fetchone()
+        if row:
+            columns = [description[0] for description in cursor.description]
+            return dict(zip(columns, row))
+        return None
+
+    async def flush_players(self):
+        """Записывает все измененные поля игроков одной пачкой"""
+        if not self._dirty:
+            return
+
+        rows = [
+            (user_id, {field: self._players[user_id][field] for field in fields})
+            for user_id, fields in self._dirty.items()
+        ]
+        self._dirty = {}
+        user_ids = {user_id for user_id, _ in rows}
+        self._flushing |= user_ids
+        try:
+            await self.run(self._update_players, rows)
+        except Exception:
+            # Возвращаем поля в грязные, чтобы повторить запись при следующем сбросе
+            for user_id, updates in rows:
+                self._dirty.setdefault(user_id, set()).update(updates)
+            raise
+        finally:
+            self._flushing -= user_ids
+        self._evict_players()
+
+    @staticmethod
+    def _update_players(cursor, rows: list):
+        for user_id, updates in rows:
+            set_clause = ', '.join([f"{key} = ?" for key in updates.keys()])
+            values = list(updates.values()) + [user_id]
+
+            cursor.execute(f'UPDATE players SET {set_clause} WHERE user_id = ?', values)
+
+    def _evict_players(self):
+        """Вытесняет самых давно активных игроков; несохраненных сначала сбрасывает в базу"""
+        overflow = len(self._players) - self.PLAYER_CACHE_SIZE
+        if overflow <= 0:
+            return
+
+        # Последнего активного игрока не трогаем: с ним прямо сейчас работает хендлер
+        newest = next(reversed(self._players))
+        victims = []
+        for user_id in self._players:
+            if len(victims) >= overflow or user_id == newest:
+                break
+            if user_id not in self._dirty and user_id not in self._flushing:
+                victims.append(user_id)
+
+        for user_id in victims:
+            del self._players[user_id]
+
+        if len(victims) < overflow and self._dirty:
+            asyncio.create_task(self.flush_players())
 
-        cursor.execute(f'UPDATE players SET {set_clause} WHERE user_id = ?', values)
-        self.conn.commit()
+    def _start_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.PLAYER_FLUSH_INTERVAL)
+            try:
+                await self.flush_players()
+            except Exception:
+                logging.exception("Не удалось сбросить кэш игроков")
 
 # Инициализация базы данных
 db = Database()
 
+# ==============================
+# ИСХОДЯЩИЕ СООБЩЕНИЯ
+# ==============================
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Забирает токен и возвращает 0 или сколько секунд ждать до появления токена (не забирая его)"""
+        self.refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class MessageDispatcher:
+    """Очередь исходящих сообщений: общий и почтовый лимиты Telegram, ограниченное число воркеров, RetryAfter
+
+    Чат всегда попадает к одному и тому же воркеру, поэтому сообщения в один чат уходят по порядку.
+    """
+
+    GLOBAL_RATE = 25  # сообщений в секунду на весь бот, с запасом до лимита Telegram в 30
+    CHAT_RATE = 1.0
+    CHAT_BURST = 3
+    WORKERS = 8
+    MAX_ATTEMPTS = 3
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self._global = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._queues: List[asyncio.Queue] = []
+        self._workers: List[asyncio.Task] = []
+        self._paused_until = 0.0  # после RetryAfter ждут все воркеры: флуд-лимит общий
+
+    async def send(self, chat_id: int, text: str, wait: bool = False, **kwargs) -> Optional[Message]:
+        """Ставит сообщение в очередь; с wait=True дожидается отправки и возвращает сообщение или бросает ошибку"""
+        self._start_workers()
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._queues[chat_id % self.WORKERS].put_nowait((chat_id, text, kwargs, future))
+        return await future if future is not None else None
+
+    async def drain(self, timeout: float = 10.0):
+        """Дожидается отправки уже поставленных сообщений, например перед остановкой бота"""
+        if self._queues:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Не все исходящие сообщения успели отправиться")
+
+    def _start_workers(self):
+        if self._workers:
+            return
+        self._queues = [asyncio.Queue() for _ in range(self.WORKERS)]
+        self._workers = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_BUCKETS:
+                # Полное ведро ничем не отличается от нового, такие чаты можно забыть
+                now = time.monotonic()
+                for idle_id in [key for key, idle in self._chats.items()
+                                if idle.tokens + (now - idle.updated) * idle.rate >= idle.capacity]:
+                    del self._chats[idle_id]
+            bucket = self._chats[chat_id] = TokenBucket(self.CHAT_RATE, self.CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_id: int):
+        """Ждет токен чата, затем общий токен и окончание паузы после RetryAfter"""
+        while (delay := self._chat_bucket(chat_id).take()) > 0:
+            await asyncio.sleep(delay)
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global.take()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            chat_id, text, kwargs, future = await queue.get()
+            try:
+                result = await self._deliver(chat_id, text, kwargs)
+                if future is not None and not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                else:
+                    logging.debug(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: Dict) -> Message:
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            await self._acquire(chat_id)
+            try:
+                return await bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == self.MAX_ATTEMPTS:
+                    raise
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logging.warning(f"Флуд-лимит Telegram: пауза {e.retry_after} с")
+
+    def __len__(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+outbox = MessageDispatcher()
+
+class EditSlot:
+    """Состояние одного сообщения: отпечаток последней правки и правка, ждущая своей очереди"""
+
+    __slots__ = ('fingerprint', 'sent_at', 'pending', 'flusher')
+
+    def __init__(self):
+        self.fingerprint: Optional[int] = None
+        self.sent_at = 0.0
+        self.pending: Optional[tuple] = None  # (отпечаток, текст, параметры, future)
+        self.flusher: Optional[asyncio.Task] = None
+
+class MessageEditor:
+    """Правка сообщений без пустых запросов: одинаковые правки отбрасываются, частые склеиваются в последнюю"""
+
+    COALESCE_WINDOW = 0.3  # секунд между правками одного сообщения
+    MAX_MESSAGES = 10000
+
+    def __init__(self):
+        self._slots: OrderedDict = OrderedDict()
+
+    async def edit(self, message: Message, text: str, **kwargs) -> bool:
+        return await self.edit_message(message.chat.id, message.message_id, text, **kwargs)
+
+    async def edit_message(self, chat_id: int, message_id: int, text: str, **kwargs) -> bool:
+        """Правит сообщение; False, если правка ничего не меняла или ее перекрыла более свежая"""
+        key = (chat_id, message_id)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = EditSlot()
+            self._evict()
+        else:
+            self._slots.move_to_end(key)
+
+        fingerprint = self.fingerprint(text, kwargs)
+        if slot.pending is None and fingerprint == slot.fingerprint:
+            return False
+
+        if slot.pending is not None and not slot.pending[3].done():
+            slot.pending[3].set_result(False)
+        future = asyncio.get_running_loop().create_future()
+        slot.pending = (fingerprint, text, kwargs, future)
+        if slot.flusher is None or slot.flusher.done():
+            slot.flusher = asyncio.create_task(self._flush(key, slot))
+        return await future
+
+    @staticmethod
+    def fingerprint(text: str, kwargs: Dict) -> int:
+        markup = kwargs.get('reply_markup')
+        options = tuple(sorted((name, value) for name, value in kwargs.items() if name != 'reply_markup'))
+        return hash((text, markup.model_dump_json() if markup is not None else None, options))
+
+    async def _flush(self, key: tuple, slot: EditSlot):
+        """Отправляет последнюю ждущую правку не чаще раза в COALESCE_WINDOW"""
+        while slot.pending is not None:
+            delay = slot.sent_at + self.COALESCE_WINDOW - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            fingerprint, text, kwargs, future = slot.pending
+            slot.pending = None
+            if future.done():
+                continue  # Хендлер, ждавший правку, уже отменен
+            if fingerprint == slot.fingerprint:
+                future.set_result(False)
+                continue
+
+            try:
+                await bot.edit_message_text(text, chat_id=key[0], message_id=key[1], **kwargs)
+                slot.fingerprint = fingerprint
+                result, error = True, None
+            except TelegramBadRequest as e:
+                if 'message is not modified' in str(e):
+                    slot.fingerprint = fingerprint
+                    result, error = False, None
+                else:
+                    result, error = None, e
+            except Exception as e:
+                result, error = None, e
+            slot.sent_at = time.monotonic()
+
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _evict(self):
+        while len(self._slots) > self.MAX_MESSAGES:
+            key, slot = next(iter(self._slots.items()))
+            if slot.pending is not None:
+                break
+            del self._slots[key]
+
+editor = MessageEditor()
+
+# ==============================
+# КОНТЕКСТ ИГРОКА
+# ==============================
+
+class PlayerContextMiddleware(BaseMiddleware):
+    """Загружает игрока, от имени которого пришел апдейт, один раз и передает его хендлеру как player"""
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        user = data.get('event_from_user')
+        with db.player_scope():
+            data['player'] = await db.get_player(user.id) if user else None
+            return await handler(event, data)
+
+# Внутренний middleware: срабатывает только когда хендлер уже выбран, свободный текст базу не трогает
+router.message.middleware(PlayerContextMiddleware())
+router.callback_query.middleware(PlayerContextMiddleware())
+
+# Аргументы, которые диспетчеры команд и кнопок передают хендлеру, если он их принимает
+INJECTED_PARAMS = ('state', 'player')
+
+def injected_params(func: Callable) -> tuple:
+    parameters = inspect.signature(func).parameters
+    return tuple(name for name in INJECTED_PARAMS if name in parameters)
+
 # ==============================
 # СИСТЕМА ЕСТЕСТВЕННОГО ЯЗЫКА
 # ==============================
 
 class NaturalLanguageProcessor:
+    """Сопоставляет свободный текст с командами бота по таблице синонимов"""
+
+    ALIASES = {
+        'profile': ('профиль', 'мой профиль', 'статы', 'характеристики', 'персонаж'),
+        'hunt': ('охота', 'охотиться', 'монстры', 'пойти на охоту', 'бить монстров'),
+        'pvp': ('дуэль', 'пвп', 'сразиться', 'бой', 'поединок'),
+        'help': ('помощь', 'команды', 'справка', 'обучение', 'как играть'),
+        'clan': ('клан', 'мой клан', 'кланы'),
+        'mine': ('шахта', 'моя шахта', 'шахты'),
+        'shop': ('магазин', 'лавка', 'купить'),
+        'boss': ('босс', 'боссы', 'рейд'),
+        'events': ('события', 'ивенты'),
+        'royal': ('королевская битва', 'королевская', 'батл рояль'),
+        'hunt_dark': ('тёмная охота', 'темная охота'),
+        'upgrade': ('улучшить', 'улучшения', 'прокачка'),
+        'achievements': ('достижения', 'ачивки'),
+        'daily': ('ежедневная награда', 'награда', 'ежедневка'),
+    }
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Приводит текст к виду ключей таблицы: нижний регистр, ё -> е, одиночные пробелы"""
+        return ' '.join(text.lower().replace('ё', 'е').split())
+
     @staticmethod
-    def process_text(text: str) -> str:
-        text = text.lower().strip()
+    def process_text(text: Optional[str]) -> str:
+        if not text:
+            return 'unknown'
+        return COMMAND_TABLE.get(NaturalLanguageProcessor.normalize(text), 'unknown')
+
+# Таблица "нормализованный текст -> команда" строится один раз при импорте и дальше не меняется
+COMMAND_TABLE = MappingProxyType({
+    NaturalLanguageProcessor.normalize(alias): command
+    for command, aliases in NaturalLanguageProcessor.ALIASES.items()
+    for alias in aliases
+})
+
+class TextCommandMiddleware(BaseMiddleware):
+    """Один раз на сообщение распознает текстовую команду и кладет ее в data['text_command']"""
+
+    async def __call__(self, handler, event: Message, data: Dict[str, Any]):
+        data['text_command'] = NaturalLanguageProcessor.process_text(event.text)
+        return await handler(event, data)
+
+router.message.outer_middleware(TextCommandMiddleware())
+
+# Команда -> (хендлер, принимаемые им INJECTED_PARAMS); заполняется декоратором text_command
+TEXT_COMMANDS: Dict[str, tuple] = {}
+
+# Состояния, в которых текст — это ввод данных, а не команда
+TEXT_INPUT_STATES = {
+    PlayerStates.choosing_name.state,
+    ClanStates.waiting_clan_name.state,
+    AdminStates.admin_give_currency.state,
+}
+
+class TextCommandFilter(Filter):
+    """Пропускает сообщение, если middleware распознал в нем текстовую команду"""
+
+    async def __call__(self, message: Message, text_command: str, raw_state: Optional[str]) -> bool:
+        return text_command in TEXT_COMMANDS and raw_state not in TEXT_INPUT_STATES
+
+# Фильтры, которые ограничивают текстовый хендлер: команда, состояние FSM или распознанный текст
+SCOPED_MESSAGE_FILTERS = (Command, StateFilter, State, TextCommandFilter)
+
+def check_text_handlers_scoped(router: Router):
+    """Не дает запустить бота с хендлером, который ловит любой текст и лезет в базу на каждое сообщение"""
+    unscoped = [
+        handler.callback.__name__
+        for handler in router.message.handlers
+        if not any(isinstance(f.callback, SCOPED_MESSAGE_FILTERS) for f in handler.filters or ())
+    ]
+    if unscoped:
+        raise RuntimeError(f"Текстовые хендлеры без команды или состояния FSM: {', '.join(unscoped)}")
+
+def text_command(command: str):
+    """Регистрирует хендлер как обработчик текстовой команды command"""
+    def decorator(func):
+        TEXT_COMMANDS[command] = (func, injected_params(func))
+        return func
+    return decorator
+
+@router.message(TextCommandFilter())
+async def dispatch_text_command(message: Message, state: FSMContext, player: Optional[Dict], text_command: str):
+    """Вызывает хендлер распознанной команды одним поиском в словаре"""
+    handler, params = TEXT_COMMANDS[text_command]
+    context = {'state': state, 'player': player}
+    await handler(message, **{name: context[name] for name in params})
 
-        command_map = {
-            # Профиль
-            'профиль': 'profile', 'мой профиль': 'profile', 'статы': 'profile',
-            'характеристики': 'profile', 'персонаж': 'profile',
+# ==============================
+# МАРШРУТИЗАЦИЯ КНОПОК
+# ==============================
 
-            # Охота
-            'охота': 'hunt', 'охотиться': 'hunt', 'монстры': 'hunt',
-            'пойти на охоту': 'hunt', 'бить монстров': 'hunt',
+class CallbackRoute:
+    """Шаблон callback_data: постоянный префикс и типизированные параметры в конце
+
+    Параметр записывается как {name}, {name:int} или {name:a|b|c} (одно из перечисленных значений).
+    Несколько параметров разделяются текстом, например {battle_id:int}_{direction:up|down}.
+    """
+
+    __slots__ = ('prefix', 'params', 'separators', 'handler', 'state', 'injected')
+
+    def __init__(self, pattern: str, handler: Callable, state: Optional[State] = None):
+        self.prefix, _, rest = pattern.partition('{')
+        # (имя, тип, допустимые значения) и текст, который идет за каждым параметром
+        self.params = []
+        self.separators = []
+        while rest:
+            spec, _, rest = rest.partition('}')
+            name, _, kind = spec.partition(':')
+            self.params.append((name, int if kind == 'int' else str, frozenset(kind.split('|')) if '|' in kind else None))
+            separator, _, rest = rest.partition('{')
+            self.separators.append(separator)
+        if self.separators and (self.separators[-1] or not all(self.separators[:-1])):
+            raise ValueError(f"Шаблон кнопки {pattern}: параметры должны разделяться текстом и стоять в конце")
+        self.handler = handler
+        self.state = state
+        self.injected = injected_params(handler)
+
+    def pack(self, *values: Any) -> str:
+        """Собирает callback_data для кнопки"""
+        return self.prefix + ''.join(f'{value}{separator}' for value, separator in zip(values, self.separators))
+
+    def unpack(self, suffix: str) -> Optional[Dict[str, Any]]:
+        """Разбирает хвост callback_data после префикса; None, если он не подходит шаблону"""
+        args = {}
+        for (name, kind, choices), separator in zip(self.params, self.separators):
+            if separator:
+                value, found, suffix = suffix.partition(separator)
+                if not found:
+                    return None
+            else:
+                value, suffix = suffix, ''
+            if choices is not None:
+                valid = value in choices
+            elif kind is int:
+                valid = value.isdigit()
+            else:
+                valid = bool(value)
+            if not valid:
+                return None
+            args[name] = int(value) if kind is int else value
+        return args if not suffix else None
 
-            # Дуэли
-            'дуэль': 'pvp', 'пвп': 'pvp', 'сразиться': 'pvp',
-            'бой': 'pvp', 'поединок': 'pvp',
+class CallbackRouter:
+    """Префиксное дерево шаблонов: хендлер кнопки находится за один проход по callback_data"""
 
-            # Помощь
-            'помощь': 'help', 'команды': 'help', 'справка': 'help',
-            'обучение': 'help', 'как играть': 'help'
-        }
+    def __init__(self):
+        # Узел: символ -> дочерний узел; под ключом None лежат шаблоны, чей префикс заканчивается здесь
+        self._root: Dict = {}
+
+    def route(self, pattern: str, state: Optional[State] = None):
+        """Регистрирует хендлер кнопок pattern; у хендлера появляется метод pack для сборки callback_data"""
+        def decorator(func):
+            route = CallbackRoute(pattern, func, state)
+            node = self._root
+            for char in route.prefix:
+                node = node.setdefault(char, {})
+            routes = node.setdefault(None, {})
+            slot = 'param' if route.params else 'exact'
+            if slot in routes:
+                raise ValueError(f"Шаблон кнопки {pattern} пересекается с уже зарегистрированным")
+            routes[slot] = route
+            func.pack = route.pack
+            return func
+        return decorator
+
+    def resolve(self, data: str) -> Optional[tuple]:
+        """Возвращает (шаблон, разобранные параметры); точное совпадение важнее самого длинного префикса"""
+        node = self._root
+        candidates = []
+        for position, char in enumerate(data):
+            route = node.get(None, {}).get('param')
+            if route is not None:
+                candidates.append((position, route))
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            routes = node.get(None, {})
+            if 'exact' in routes:
+                return routes['exact'], {}
+            if 'param' in routes:
+                candidates.append((len(data), routes['param']))
+
+        for position, route in reversed(candidates):
+            args = route.unpack(data[position:])
+            if args is not None:
+                return route, args
+        return None
+
+callbacks = CallbackRouter()
+
+class CallbackRouteFilter(Filter):
+    """Находит шаблон кнопки и передает хендлеру уже разобранные параметры"""
+
+    async def __call__(self, callback: CallbackQuery, raw_state: Optional[str]) -> Union[bool, Dict[str, Any]]:
+        resolved = callbacks.resolve(callback.data or '')
+        if resolved is None:
+            return False
+        route, args = resolved
+        if route.state is not None and raw_state != route.state.state:
+            return False
+        return {'callback_route': route, 'callback_args': args}
 
-        return command_map.get(text, 'unknown')
+@router.callback_query(CallbackRouteFilter())
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext, player: Optional[Dict],
+                            callback_route: CallbackRoute, callback_args: Dict[str, Any]):
+    """Вызывает хендлер найденного шаблона кнопки"""
+    context = {'state': state, 'player': player}
+    await callback_route.handler(callback, **callback_args, **{name: context[name] for name in callback_route.injected})
 
 # ==============================
 # ОСНОВНЫЕ КОМАНДЫ БОТА
 # ==============================
 
 @router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
-    user_id = message.from_user.id
-    player = db.get_player(user_id)
-
+async def cmd_start(message: Message, state: FSMContext, player: Optional[Dict]):
     if player:
         # Игрок уже зарегистрирован
         await message.answer(
@@ -303,14 +1210,13 @@ async def process_character_name(message: Message, state: FSMContext):
     )
 
 # Обработчик выбора класса
-@router.callback_query(lambda c: c.data.startswith('class_'))
-async def process_class_selection(callback: CallbackQuery, state: FSMContext):
-    class_type = callback.data.replace('class_', '')
+@callbacks.route(f"class_{{class_type:{'|'.join(GameConfig.CLASSES)}}}")
+async def process_class_selection(callback: CallbackQuery, class_type: str, state: FSMContext):
     user_data = await state.get_data()
     character_name = user_data['character_name']
 
     # Создаем игрока в базе данных
-    db.create_player(
+    await db.create_player(
         user_id=callback.from_user.id,
         username=callback.from_user.username or callback.from_user.first_name,
         character_name=character_name,
@@ -319,7 +1225,8 @@ async def process_class_selection(callback: CallbackQuery, state: FSMContext):
 
     class_info = GameConfig.CLASSES[class_type]
 
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         f"🎊 Поздравляю, {character_name}!\n"
         f"Ты стал {class_info['name']}!\n\n"
         f"📊 Твои стартовые характеристики:\n"
@@ -336,11 +1243,8 @@ async def process_class_selection(callback: CallbackQuery, state: FSMContext):
 
 # Команда /profile и ее текстовые аналоги
 @router.message(Command('profile'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'profile')
-async def cmd_profile(message: Message):
-    user_id = message.from_user.id
-    player = db.get_player(user_id)
-
+@text_command('profile')
+async def cmd_profile(message: Message, player: Optional[Dict]):
     if not player:
         await message.answer("❌ Ты еще не создал персонажа! Напиши /start чтобы начать игру.")
         return
@@ -379,10 +1283,9 @@ async def cmd_profile(message: Message):
     await message.answer(profile_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Обработчик восстановления энергии
-@router.callback_query(lambda c: c.data == 'restore_energy')
-async def restore_energy(callback: CallbackQuery):
+@callbacks.route('restore_energy')
+async def restore_energy(callback: CallbackQuery, player: Optional[Dict]):
     user_id = callback.from_user.id
-    player = db.get_player(user_id)
 
     if player['energy'] >= GameConfig.ENERGY_MAX:
         await callback.answer("⚡ У тебя уже полная энергия!", show_alert=True)
@@ -390,14 +1293,16 @@ async def restore_energy(callback: CallbackQuery):
 
     # Восстанавливаем энергию (1 сапфир = 50 энергии)
     if player['sapphires'] >= 1:
-        db.update_player_stats(user_id, {
+        player = await db.apply_deltas(user_id, {
             'energy': GameConfig.ENERGY_MAX,
-            'sapphires': player['sapphires'] - 1
+            'sapphires': -1
         })
+        if player is None:
+            await callback.answer("❌ Недостаточно сапфиров для восстановления энергии!", show_alert=True)
+            return
         await callback.answer("⚡ Энергия полностью восстановлена за 1 сапфир!", show_alert=True)
 
         # Обновляем сообщение профиля
-        player = db.get_player(user_id)
         await update_profile_message(callback.message, player)
     else:
         await callback.answer("❌ Недостаточно сапфиров для восстановления энергии!", show_alert=True)
@@ -427,36 +1332,54 @@ async def update_profile_message(message: Message, player: Dict):
         [InlineKeyboardButton(text="📦 Инвентарь", callback_data="inventory")]
     ])
 
-    await message.edit_text(profile_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(message, profile_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # ==============================
 # СИСТЕМА ИНВЕНТАРЯ
 # ==============================
 
-@router.callback_query(lambda c: c.data == 'inventory')
+@callbacks.route('inventory')
 async def show_inventory(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     # Получаем предметы из инвентаря
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT item_name, item_type, rarity, quantity FROM inventory WHERE user_id = ?', (user_id,))
-    items = cursor.fetchall()
+    items = await db.fetchall('''
+        SELECT i.name, i.item_type, i.rarity, i.stats, inv.quantity
+        FROM inventory inv
+        JOIN items i ON i.id = inv.item_id
+        WHERE inv.user_id = ?
+    ''', (user_id,))
 
     if not items:
         inventory_text = "📦 Твой инвентарь пуст.\n\nОтправляйся на охоту или открой кейсы чтобы получить предметы!"
     else:
         inventory_text = "📦 **Твой инвентарь:**\n\n"
         for item in items:
-            item_name, item_type, rarity, quantity = item
+            item_name, item_type, rarity, stats, quantity = item
             rarity_icon = get_rarity_icon(rarity)
-            inventory_text += f"{rarity_icon} {item_name} ({item_type}) x{quantity}\n"
+            inventory_text += f"{rarity_icon} {item_name} ({item_type}){format_item_stats(stats)} x{quantity}\n"
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ Назад к профилю", callback_data="back_to_profile")],
         [InlineKeyboardButton(text="🎁 Открыть кейс", callback_data="open_case")]
     ])
 
-    await callback.message.edit_text(inventory_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, inventory_text, reply_markup=keyboard, parse_mode='Markdown')
+
+# Характеристики предмета из items.stats для списка инвентаря
+ITEM_STAT_LABELS = {
+    'damage': '⚔️',
+    'defense': '🛡️',
+    'health': '❤️',
+    'strength': '💪',
+    'intellect': '🧠',
+    'agility': '🏃',
+}
+
+def format_item_stats(stats_json: str) -> str:
+    stats = json.loads(stats_json)
+    parts = [f"{label}{stats[field]}" for field, label in ITEM_STAT_LABELS.items() if field in stats]
+    return f" [{' '.join(parts)}]" if parts else ""
 
 # Функция для получения иконки редкости
 def get_rarity_icon(rarity: str) -> str:
@@ -471,10 +1394,8 @@ def get_rarity_icon(rarity: str) -> str:
     return icons.get(rarity, '⚪')
 
 # Обработчик возврата к профилю
-@router.callback_query(lambda c: c.data == 'back_to_profile')
-async def back_to_profile(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    player = db.get_player(user_id)
+@callbacks.route('back_to_profile')
+async def back_to_profile(callback: CallbackQuery, player: Optional[Dict]):
     await update_profile_message(callback.message, player)
 
 # ==============================
@@ -482,7 +1403,7 @@ async def back_to_profile(callback: CallbackQuery):
 # ==============================
 
 @router.message(Command('help'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'help')
+@text_command('help')
 async def cmd_help(message: Message):
     help_text = (
         "🎮 **Magic RPG Bot - Помощь**\n\n"
@@ -521,18 +1442,14 @@ async def cmd_help(message: Message):
 
 # Команда охоты и текстовые аналоги
 @router.message(Command('hunt'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'hunt')
-@router.callback_query(lambda c: c.data == 'hunt_start')
-async def cmd_hunt(update: types.Update, state: FSMContext):
+@text_command('hunt')
+@callbacks.route('hunt_start')
+async def cmd_hunt(update: types.Update, state: FSMContext, player: Optional[Dict]):
     if isinstance(update, CallbackQuery):
         message = update.message
-        user_id = update.from_user.id
         await update.answer()
     else:
         message = update
-        user_id = update.from_user.id
-
-    player = db.get_player(user_id)
 
     if not player:
         await message.answer("❌ Ты еще не создал персонажа! Напиши /start чтобы начать игру.")
@@ -584,15 +1501,13 @@ async def cmd_hunt(update: types.Update, state: FSMContext):
     )
 
     if isinstance(update, CallbackQuery):
-        await message.edit_text(battle_text, reply_markup=keyboard, parse_mode='Markdown')
+        await editor.edit(message, battle_text, reply_markup=keyboard, parse_mode='Markdown')
     else:
         await message.answer(battle_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Обработчик атаки в охоте
-@router.callback_query(lambda c: c.data == 'hunt_attack', PlayerStates.in_hunt)
-async def hunt_attack(callback: CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
-    player = db.get_player(user_id)
+@callbacks.route('hunt_attack', state=PlayerStates.in_hunt)
+async def hunt_attack(callback: CallbackQuery, state: FSMContext, player: Optional[Dict]):
     battle_data = await state.get_data()
 
     monster_name = battle_data['monster']
@@ -631,10 +1546,8 @@ async def hunt_attack(callback: CallbackQuery, state: FSMContext):
     await continue_hunt_battle(callback, battle_log, monster, monster_health, player_health, player)
 
 # Обработчик магической атаки
-@router.callback_query(lambda c: c.data == 'hunt_magic', PlayerStates.in_hunt)
-async def hunt_magic(callback: CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
-    player = db.get_player(user_id)
+@callbacks.route('hunt_magic', state=PlayerStates.in_hunt)
+async def hunt_magic(callback: CallbackQuery, state: FSMContext, player: Optional[Dict]):
     battle_data = await state.get_data()
 
     monster_name = battle_data['monster']
@@ -683,8 +1596,8 @@ async def hunt_magic(callback: CallbackQuery, state: FSMContext):
     await continue_hunt_battle(callback, battle_log, monster, monster_health, player_health, player)
 
 # Обработчик защиты
-@router.callback_query(lambda c: c.data == 'hunt_defend', PlayerStates.in_hunt)
-async def hunt_defend(callback: CallbackQuery, state: FSMContext):
+@callbacks.route('hunt_defend', state=PlayerStates.in_hunt)
+async def hunt_defend(callback: CallbackQuery, state: FSMContext, player: Optional[Dict]):
     battle_data = await state.get_data()
 
     monster_name = battle_data['monster']
@@ -700,29 +1613,29 @@ async def hunt_defend(callback: CallbackQuery, state: FSMContext):
 
     # Проверяем поражение
     if player_health <= 0:
-        await handle_hunt_defeat(callback, state, db.get_player(callback.from_user.id))
+        await handle_hunt_defeat(callback, state, player)
         return
 
     # Обновляем состояние боя
     await state.update_data(player_health=player_health)
 
     # Продолжаем бой
-    await continue_hunt_battle(callback, battle_log, monster, battle_data['monster_health'], player_health, db.get_player(callback.from_user.id))
+    await continue_hunt_battle(callback, battle_log, monster, battle_data['monster_health'], player_health, player)
 
 # Обработчик побега
-@router.callback_query(lambda c: c.data == 'hunt_flee', PlayerStates.in_hunt)
-async def hunt_flee(callback: CallbackQuery, state: FSMContext):
+@callbacks.route('hunt_flee', state=PlayerStates.in_hunt)
+async def hunt_flee(callback: CallbackQuery, state: FSMContext, player: Optional[Dict]):
     user_id = callback.from_user.id
-    player = db.get_player(user_id)
 
     # Шанс побега 70%
     if random.random() < 0.7:
         # Тратим энергию даже при побеге
-        db.update_player_stats(user_id, {'energy': player['energy'] - 5})
+        player = await db.apply_deltas(user_id, {'energy': -5})
 
-        await callback.message.edit_text(
+        await editor.edit(
+            callback.message,
             "🏃 Ты успешно сбежал с поля боя!\n"
-            f"Потрачено 5 энергии. Осталось: {player['energy'] - 5}",
+            f"Потрачено 5 энергии. Осталось: {player['energy']}",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="⚔️ Снова на охоту", callback_data="hunt_start")],
                 [InlineKeyboardButton(text="👤 В профиль", callback_data="back_to_profile")]
@@ -769,7 +1682,7 @@ async def continue_hunt_battle(callback: CallbackQuery, battle_log: str, monster
         ]
     ])
 
-    await callback.message.edit_text(battle_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, battle_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Обработчик победы в охоте
 async def handle_hunt_victory(callback: CallbackQuery, state: FSMContext, player: Dict, monster: Dict):
@@ -783,29 +1696,30 @@ async def handle_hunt_victory(callback: CallbackQuery, state: FSMContext, player
     item_drop = None
     if random.random() < 0.2:
         item_drop = get_random_item_drop(monster['level'])
-        add_item_to_inventory(user_id, item_drop)
+        await add_item_to_inventory(user_id, item_drop)
 
     # Обновляем статистику игрока
-    new_exp = player['experience'] + exp_reward
-    new_level = player['level']
+    player = await db.apply_deltas(user_id, {
+        'gold': gold_reward,
+        'experience': exp_reward,
+        'energy': -10
+    })
+    updates = {
+        'health': player['max_health'],  # Восстанавливаем здоровье после боя
+        'mana': player['max_mana']       # Восстанавливаем ману
+    }
 
     # Проверяем повышение уровня
+    new_level = player['level']
     exp_needed = new_level * 100
-    if new_exp >= exp_needed and new_level < GameConfig.MAX_LEVEL:
+    if player['experience'] >= exp_needed and new_level < GameConfig.MAX_LEVEL:
         new_level += 1
-        new_exp = 0
+        updates.update({'level': new_level, 'experience': 0})
         level_up_bonus = "🎊 **Повышение уровня!** Ты достиг уровня {new_level}!\n"
     else:
         level_up_bonus = ""
 
-    db.update_player_stats(user_id, {
-        'gold': player['gold'] + gold_reward,
-        'experience': new_exp,
-        'level': new_level,
-        'energy': player['energy'] - 10,
-        'health': player['max_health'],  # Восстанавливаем здоровье после боя
-        'mana': player['max_mana']       # Восстанавливаем ману
-    })
+    await db.update_player_stats(user_id, updates)
 
     victory_text = (
         f"🎉 **Победа!** Ты победил {monster['name']}!\n\n"
@@ -819,14 +1733,14 @@ async def handle_hunt_victory(callback: CallbackQuery, state: FSMContext, player
     if item_drop:
         victory_text += f"🎁 Выпал предмет: {item_drop['name']}!\n"
 
-    victory_text += f"\nТвой баланс: {player['gold'] + gold_reward} золота"
+    victory_text += f"\nТвой баланс: {player['gold']} золота"
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⚔️ Снова на охоту", callback_data="hunt_start")],
         [InlineKeyboardButton(text="👤 В профиль", callback_data="back_to_profile")]
     ])
 
-    await callback.message.edit_text(victory_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, victory_text, reply_markup=keyboard, parse_mode='Markdown')
     await state.clear()
 
 # Обработчик поражения в охоте
@@ -836,9 +1750,8 @@ async def handle_hunt_defeat(callback: CallbackQuery, state: FSMContext, player:
     # Штраф за поражение
     gold_loss = min(player['gold'] // 10, 100)  # 10% но не более 100
 
-    db.update_player_stats(user_id, {
-        'gold': player['gold'] - gold_loss,
-        'energy': max(0, player['energy'] - 5),
+    await db.apply_deltas(user_id, {'gold': -gold_loss, 'energy': -5}, allow_partial=True)
+    await db.update_player_stats(user_id, {
         'health': player['max_health'] // 2,  # Восстанавливаем половину здоровья
         'mana': player['max_mana'] // 2       # Восстанавливаем половину маны
     })
@@ -858,25 +1771,67 @@ async def handle_hunt_defeat(callback: CallbackQuery, state: FSMContext, player:
         [InlineKeyboardButton(text="👤 В профиль", callback_data="back_to_profile")]
     ])
 
-    await callback.message.edit_text(defeat_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, defeat_text, reply_markup=keyboard, parse_mode='Markdown')
     await state.clear()
 
 # ==============================
 # СИСТЕМА ПРЕДМЕТОВ
 # ==============================
 
-def get_random_item_drop(monster_level: int) -> Dict:
-    # Базовые предметы которые могут выпасть
-    items = [
-        {"name": "⚔️ Ржавый меч", "type": "weapon", "rarity": "common", "damage": 5},
-        {"name": "🛡️ Кожаный доспех", "type": "armor", "rarity": "common", "defense": 3},
-        {"name": "🧪 Зелье здоровья", "type": "potion", "rarity": "common", "effect": "heal_50"},
-        {"name": "🔮 Слабый посох", "type": "weapon", "rarity": "uncommon", "damage": 8, "intellect": 2},
-        {"name": "🏹 Охотничий лук", "type": "weapon", "rarity": "uncommon", "damage": 7, "agility": 3}
-    ]
+class LootTable:
+    """Таблица выпадения по методу алиасов: собирается один раз, выбор за O(1) без выделения памяти"""
+
+    __slots__ = ('outcomes', '_prob', '_alias')
+
+    def __init__(self, weighted: List[tuple]):
+        """weighted — пары (исход, вес) с положительными весами"""
+        self.outcomes = tuple(outcome for outcome, _ in weighted)
+        size = len(self.outcomes)
+        total = sum(weight for _, weight in weighted)
+        scaled = [weight * size / total for _, weight in weighted]
+        self._prob = [1.0] * size
+        self._alias = list(range(size))
+
+        # Метод Возе: каждый недобравший до 1 столбец доливается из переполненного
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._prob[less] = scaled[less]
+            self._alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Остатки равны 1 с точностью до округления
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def sample(self) -> Any:
+        column = int(random.random() * len(self.outcomes))
+        if random.random() < self._prob[column]:
+            return self.outcomes[column]
+        return self.outcomes[self._alias[column]]
+
+    def sample_many(self, count: int) -> List[Any]:
+        """Пачка независимых выборов для массового открытия и симуляций"""
+        outcomes, prob, alias, size = self.outcomes, self._prob, self._alias, len(self.outcomes)
+        result = []
+        for _ in range(count):
+            column = int(random.random() * size)
+            result.append(outcomes[column] if random.random() < prob[column] else outcomes[alias[column]])
+        return result
+
+# Базовые предметы которые могут выпасть с монстров; словари общие, изменять только копии
+MONSTER_DROP_TABLE = LootTable([
+    ({"name": "⚔️ Ржавый меч", "type": "weapon", "rarity": "common", "damage": 5}, 1),
+    ({"name": "🛡️ Кожаный доспех", "type": "armor", "rarity": "common", "defense": 3}, 1),
+    ({"name": "🧪 Зелье здоровья", "type": "potion", "rarity": "common", "effect": "heal_50"}, 1),
+    ({"name": "🔮 Слабый посох", "type": "weapon", "rarity": "uncommon", "damage": 8, "intellect": 2}, 1),
+    ({"name": "🏹 Охотничий лук", "type": "weapon", "rarity": "uncommon", "damage": 7, "agility": 3}, 1),
+])
 
+def get_random_item_drop(monster_level: int) -> Dict:
     # Улучшаем предметы в зависимости от уровня монстра
-    item = random.choice(items).copy()
+    item = MONSTER_DROP_TABLE.sample().copy()
     if monster_level > 5:
         if item['type'] == 'weapon':
             item['damage'] += monster_level // 3
@@ -885,38 +1840,78 @@ def get_random_item_drop(monster_level: int) -> Dict:
 
     return item
 
-def add_item_to_inventory(user_id: int, item: Dict):
-    cursor = db.conn.cursor()
+class ItemRegistry:
+    """Справочник items в памяти: (имя, характеристики) -> id; новые варианты заводятся при первой записи"""
 
-    # Проверяем есть ли уже такой предмет
-    cursor.execute(
-        'SELECT id, quantity FROM inventory WHERE user_id = ? AND item_name = ?',
-        (user_id, item['name'])
-    )
-    existing = cursor.fetchone()
+    # Поля предмета, которые не относятся к характеристикам
+    BASE_FIELDS = ('name', 'type', 'rarity')
 
-    if existing:
-        # Увеличиваем количество
-        cursor.execute(
-            'UPDATE inventory SET quantity = quantity + 1 WHERE id = ?',
-            (existing[0],)
-        )
-    else:
-        # Добавляем новый предмет
-        cursor.execute(
-            'INSERT INTO inventory (user_id, item_name, item_type, rarity) VALUES (?, ?, ?, ?)',
-            (user_id, item['name'], item['type'], item['rarity'])
-        )
+    def __init__(self):
+        self._ids: Dict[tuple, int] = {}
+
+    @classmethod
+    def key(cls, item: Dict) -> tuple:
+        """(имя, характеристики в JSON) — один и тот же предмет с разными бонусами считается разным"""
+        stats = {field: value for field, value in item.items() if field not in cls.BASE_FIELDS}
+        return item['name'], json.dumps(stats, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+    async def load(self):
+        rows = await db.fetchall('SELECT id, name, stats FROM items', readonly=True)
+        self._ids = {(name, stats): item_id for item_id, name, stats in rows}
+
+    def get(self, key: tuple) -> Optional[int]:
+        return self._ids.get(key)
+
+    def remember(self, ids: Dict[tuple, int]):
+        """Запоминает id, заведенные в уже зафиксированной транзакции"""
+        self._ids.update(ids)
+
+    @staticmethod
+    def register(cursor, key: tuple, item: Dict) -> int:
+        """Заводит вариант предмета или находит уже заведенный; выполняется в потоке базы"""
+        name, stats = key
+        cursor.execute('''
+            INSERT INTO items (name, item_type, rarity, stats) VALUES (?, ?, ?, ?)
+            ON CONFLICT (name, stats) DO UPDATE SET name = excluded.name
+            RETURNING id
+        ''', (name, item['type'], item['rarity'], stats))
+        return cursor.fetchone()[0]
+
+item_registry = ItemRegistry()
+
+async def add_item_to_inventory(user_id: int, item: Dict):
+    await add_items_to_inventory(user_id, [item])
+
+async def add_items_to_inventory(user_id: int, items: List[Dict]):
+    item_registry.remember(await db.run(_add_items_to_inventory, user_id, items))
+
+def _add_items_to_inventory(cursor, user_id: int, items: List[Dict]) -> Dict[tuple, int]:
+    """Добавляет пачку предметов одним executemany; возвращает id впервые заведенных вариантов
+
+    Новые id попадают в item_registry только после коммита (см. ItemRegistry.remember),
+    чтобы откаченная вставка не оставила в памяти несуществующий id.
+    """
+    counts = Counter()
+    new_ids = {}
+    for item in items:
+        key = item_registry.key(item)
+        item_id = item_registry.get(key) or new_ids.get(key)
+        if item_id is None:
+            item_id = new_ids[key] = item_registry.register(cursor, key, item)
+        counts[item_id] += 1
+
+    cursor.executemany('''
+        INSERT INTO inventory (user_id, item_id, quantity) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, item_id) DO UPDATE SET quantity = quantity + excluded.quantity
+    ''', [(user_id, item_id, count) for item_id, count in counts.items()])
+    return new_ids
 
-    db.conn.commit()
 # ==============================
 # ЧАСТЬ 4: PvP СИСТЕМА И ДУЭЛИ
 # ==============================
 
 # Добавляем таблицу PvP рейтингов в базу данных
-def create_pvp_tables():
-    cursor = db.conn.cursor()
-
+def create_pvp_tables(cursor):
     # Таблица PvP рейтингов
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS pvp_ratings (
@@ -929,40 +1924,385 @@ def create_pvp_tables():
         )
     ''')
 
-    # Таблица активных PvP боев
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS pvp_battles (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            player1_id INTEGER,
-            player2_id INTEGER,
-            player1_health INTEGER,
-            player2_health INTEGER,
-            player1_mana INTEGER,
-            player2_mana INTEGER,
-            current_turn INTEGER DEFAULT 1,
-            battle_log TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (player1_id) REFERENCES players (user_id),
-            FOREIGN KEY (player2_id) REFERENCES players (user_id)
-        )
-    ''')
+# ==============================
+# ХРАНИЛИЩЕ PVP БОЕВ
+# ==============================
+
+class PvPBattle:
+    """Состояние одного PvP боя; стороны 0 и 1 — первый и второй игрок"""
+
+    __slots__ = ('id', 'player_ids', 'fighters', 'health', 'mana', 'log', 'deadline', 'messages')
+
+    def __init__(self, battle_id: int, player_ids: tuple, fighters: tuple, deadline: float, messages: tuple = (None, None)):
+        self.id = battle_id
+        self.player_ids = player_ids
+        # Сообщение с боем у каждой стороны: (chat_id, message_id), у бота None
+        self.messages = list(messages)
+        # Неизменяемые на время боя характеристики: имя, запас здоровья и маны, урон и защита
+        self.fighters = fighters
+        self.health = [fighter['health'] for fighter in fighters]
+        self.mana = [fighter['mana'] for fighter in fighters]
+        self.log = ''
+        self.deadline = deadline
+
+    def side_of(self, user_id: int) -> Optional[int]:
+        if user_id == self.player_ids[0]:
+            return 0
+        if user_id == self.player_ids[1]:
+            return 1
+        return None
+
+class PvPBattleStore:
+    """Активные PvP бои в памяти: ход не трогает базу, брошенные бои истекают по куче дедлайнов"""
+
+    BATTLE_TTL = 600  # секунд без действий до удаления боя
+    FIGHTER_FIELDS = ('character_name', 'health', 'max_health', 'mana', 'max_mana', 'damage', 'defense')
+
+    def __init__(self):
+        self._battles: Dict[int, PvPBattle] = {}
+        # (дедлайн, id боя); после touch старая запись остается в куче и пропускается при очистке
+        self._deadlines: List[tuple] = []
+        # Номера не повторяются после перезапуска, старые кнопки не попадут в чужой бой
+        self._ids = itertools.count(int(time.time() * 1000))
+
+    def create(self, player1_id: int, player2_id: int, fighter1: Dict, fighter2: Dict,
+               messages: tuple = (None, None)) -> PvPBattle:
+        self.sweep()
+        fighters = tuple({field: fighter[field] for field in self.FIGHTER_FIELDS} for fighter in (fighter1, fighter2))
+        battle = PvPBattle(next(self._ids), (player1_id, player2_id), fighters, 0.0, messages)
+        self._battles[battle.id] = battle
+        self.touch(battle)
+        return battle
+
+    def get(self, battle_id: int) -> Optional[PvPBattle]:
+        self.sweep()
+        return self._battles.get(battle_id)
+
+    def touch(self, battle: PvPBattle):
+        """Продлевает жизнь боя после хода"""
+        battle.deadline = time.monotonic() + self.BATTLE_TTL
+        heapq.heappush(self._deadlines, (battle.deadline, battle.id))
+
+    def finish(self, battle_id: int) -> Optional[PvPBattle]:
+        return self._battles.pop(battle_id, None)
+
+    def sweep(self):
+        """Удаляет бои с истекшим дедлайном; каждая запись кучи разбирается один раз"""
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, battle_id = heapq.heappop(self._deadlines)
+            battle = self._battles.get(battle_id)
+            if battle is not None and battle.deadline <= now:
+                del self._battles[battle_id]
+
+    def __len__(self) -> int:
+        return len(self._battles)
+
+pvp_battles = PvPBattleStore()
+
+# ==============================
+# ПОДБОР СОПЕРНИКОВ PVP
+# ==============================
+
+class MatchTicket:
+    """Заявка на поиск боя: кто ищет, с каким рейтингом и какое сообщение показать при подборе"""
+
+    __slots__ = ('user_id', 'rating', 'since', 'chat_id', 'message_id')
+
+    def __init__(self, user_id: int, rating: int, chat_id: int, message_id: int):
+        self.user_id = user_id
+        self.rating = rating
+        self.since = time.monotonic()
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+class MatchmakingQueue:
+    """Очередь поиска PvP: заявки отсортированы по рейтингу, окно подбора растет со временем ожидания"""
+
+    BASE_WINDOW = 100
+    WINDOW_GROWTH = 50  # рейтинга за каждые WINDOW_STEP секунд ожидания
+    WINDOW_STEP = 10
+    MAX_WINDOW = 500
+    SEARCH_TTL = 120  # секунд до отмены поиска
+    MATCH_INTERVAL = 5  # как часто сводим уже ожидающих игроков
+
+    def __init__(self, on_match: Callable[[MatchTicket, MatchTicket], Awaitable],
+                 on_expire: Callable[[MatchTicket], Awaitable]):
+        self._queue: List[tuple] = []  # (rating, user_id) по возрастанию
+        self._tickets: Dict[int, MatchTicket] = {}
+        self._on_match = on_match
+        self._on_expire = on_expire
+        self._matcher: Optional[asyncio.Task] = None
+
+    def window(self, ticket: MatchTicket, now: float) -> int:
+        steps = int(now - ticket.since) // self.WINDOW_STEP
+        return min(self.MAX_WINDOW, self.BASE_WINDOW + steps * self.WINDOW_GROWTH)
+
+    def match_or_enqueue(self, ticket: MatchTicket) -> Optional[MatchTicket]:
+        """Возвращает ближайшего по рейтингу подходящего соперника или ставит заявку в очередь"""
+        self.cancel(ticket.user_id)
+        now = time.monotonic()
+        opponent = self._nearest(ticket, now)
+        if opponent is not None:
+            self._remove(opponent)
+            return opponent
+
+        bisect.insort(self._queue, (ticket.rating, ticket.user_id))
+        self._tickets[ticket.user_id] = ticket
+        if self._matcher is None or self._matcher.done():
+            self._matcher = asyncio.create_task(self._match_loop())
+        return None
+
+    def cancel(self, user_id: int) -> bool:
+        ticket = self._tickets.get(user_id)
+        if ticket is None:
+            return False
+        self._remove(ticket)
+        return True
+
+    def _remove(self, ticket: MatchTicket):
+        del self._tickets[ticket.user_id]
+        index = bisect.bisect_left(self._queue, (ticket.rating, ticket.user_id))
+        del self._queue[index]
+
+    def _nearest(self, ticket: MatchTicket, now: float) -> Optional[MatchTicket]:
+        """Идет от позиции рейтинга в обе стороны по возрастанию разницы, пока она не больше MAX_WINDOW"""
+        right = bisect.bisect_left(self._queue, (ticket.rating, ticket.user_id))
+        left = right - 1
+        own_window = self.window(ticket, now)
+        while left >= 0 or right < len(self._queue):
+            left_gap = ticket.rating - self._queue[left][0] if left >= 0 else None
+            right_gap = self._queue[right][0] - ticket.rating if right < len(self._queue) else None
+            if right_gap is None or (left_gap is not None and left_gap <= right_gap):
+                gap, (_, user_id) = left_gap, self._queue[left]
+                left -= 1
+            else:
+                gap, (_, user_id) = right_gap, self._queue[right]
+                right += 1
+            if gap > self.MAX_WINDOW:
+                return None
+
+            candidate = self._tickets[user_id]
+            expired = now - candidate.since > self.SEARCH_TTL
+            if not expired and gap <= max(own_window, self.window(candidate, now)):
+                return candidate
+        return None
+
+    async def _match_loop(self):
+        """Сводит соседей по рейтингу, чьи окна расширились, и снимает просроченные заявки"""
+        while self._tickets:
+            await asyncio.sleep(self.MATCH_INTERVAL)
+            now = time.monotonic()
+
+            for ticket in [t for t in self._tickets.values() if now - t.since > self.SEARCH_TTL]:
+                self._remove(ticket)
+                asyncio.create_task(self._on_expire(ticket))
+
+            # Ближайший по рейтингу соперник всегда сосед в отсортированной очереди
+            pairs = []
+            index = 0
+            while index + 1 < len(self._queue):
+                first = self._tickets[self._queue[index][1]]
+                second = self._tickets[self._queue[index + 1][1]]
+                if second.rating - first.rating <= max(self.window(first, now), self.window(second, now)):
+                    pairs.append((first, second))
+                    index += 2
+                else:
+                    index += 1
+
+            for first, second in pairs:
+                self._remove(first)
+                self._remove(second)
+                asyncio.create_task(self._on_match(first, second))
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+# Обработчики подбора объявлены ниже, поэтому берем их при вызове
+matchmaking = MatchmakingQueue(
+    on_match=lambda first, second: start_pvp_match(first, second),
+    on_expire=lambda ticket: expire_pvp_search(ticket),
+)
+
+# ==============================
+# ТАБЛИЦА ЛИДЕРОВ PVP
+# ==============================
+
+class BlockedSortedList:
+    """Отсортированный список из блоков по LOAD..2*LOAD ключей с деревом Фенвика по размерам блоков
+
+    Вставка и удаление сдвигают только один блок, место ключа и срез по месту ищутся за O(log n).
+    """
+
+    LOAD = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self._blocks: List[list] = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes: List[Any] = [block[-1] for block in self._blocks]
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        """Дерево Фенвика по размерам блоков, пересобирается за O(число блоков) после разбиения или удаления блока"""
+        self._tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks, 1):
+            self._tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+        self._len = sum(len(block) for block in self._blocks)
+
+    def _tree_add(self, block_index: int, delta: int):
+        i = block_index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+        self._len += delta
+
+    def _prefix(self, block_index: int) -> int:
+        """Сколько ключей в блоках до block_index"""
+        total, i = 0, block_index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, position: int) -> tuple:
+        """(номер блока, смещение в нем) для места position спуском по дереву Фенвика"""
+        block_index, step = 0, 1 << (len(self._blocks).bit_length())
+        while step:
+            child = block_index + step
+            if child < len(self._tree) and self._tree[child] <= position:
+                block_index = child
+                position -= self._tree[child]
+            step >>= 1
+        return block_index, position
+
+    def add(self, key):
+        if not self._blocks:
+            self._blocks, self._maxes = [[key]], [key]
+            self._rebuild_index()
+            return
 
-    db.conn.commit()
+        i = min(bisect.bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[i]
+        bisect.insort(block, key)
+        self._maxes[i] = block[-1]
+        self._tree_add(i, 1)
+
+        if len(block) > 2 * self.LOAD:
+            self._blocks[i:i + 1] = [block[:self.LOAD], block[self.LOAD:]]
+            self._maxes[i:i + 1] = [block[self.LOAD - 1], block[-1]]
+            self._rebuild_index()
+
+    def remove(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        block = self._blocks[i] if i < len(self._blocks) else []
+        j = bisect.bisect_left(block, key)
+        if j == len(block) or block[j] != key:
+            raise ValueError(f"{key!r} нет в списке")
+
+        del block[j]
+        if block:
+            self._maxes[i] = block[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._blocks[i], self._maxes[i]
+            self._rebuild_index()
+
+    def index(self, key) -> int:
+        """Число ключей меньше key, то есть место key в списке с нуля"""
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._blocks):
+            return self._len
+        return self._prefix(i) + bisect.bisect_left(self._blocks[i], key)
+
+    def slice(self, start: int, stop: int) -> list:
+        start, stop = max(0, start), min(stop, self._len)
+        if start >= stop:
+            return []
+        block_index, offset = self._locate(start)
+        keys = []
+        while len(keys) < stop - start:
+            keys.extend(self._blocks[block_index][offset:offset + stop - start - len(keys)])
+            block_index, offset = block_index + 1, 0
+        return keys
+
+    def __len__(self) -> int:
+        return self._len
+
+class PvPLeaderboard:
+    """Рейтинги PvP в памяти: ключи (-рейтинг, user_id) в блочном отсортированном списке, обновление и место за O(log n)"""
+
+    def __init__(self):
+        self._order = BlockedSortedList()  # (-rating, user_id) по возрастанию, то есть от лучшего к худшему
+        self._entries: Dict[int, tuple] = {}  # user_id -> (rating, wins, losses, character_name)
+
+    def load(self, rows):
+        """Полностью пересобирает таблицу из строк (user_id, rating, wins, losses, character_name)"""
+        self._entries = {user_id: (rating, wins, losses, name) for user_id, rating, wins, losses, name in rows}
+        self._order = BlockedSortedList((-entry[0], user_id) for user_id, entry in self._entries.items())
+
+    def record(self, user_id: int, rating: int, wins: int, losses: int, name: Optional[str] = None):
+        """Переставляет игрока после изменения рейтинга; имя сохраняется, если не передано"""
+        old = self._entries.get(user_id)
+        if old is not None:
+            self._order.remove((-old[0], user_id))
+            name = name or old[3]
+        self._entries[user_id] = (rating, wins, losses, name)
+        self._order.add((-rating, user_id))
+
+    def rating(self, user_id: int) -> Optional[int]:
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """Место игрока начиная с 1 или None, если он еще не в таблице"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        return self._order.index((-entry[0], user_id)) + 1
+
+    def _rows(self, start: int, stop: int) -> List[tuple]:
+        """Строки (место, user_id, rating, wins, losses, character_name) для среза таблицы"""
+        return [(place, user_id, *self._entries[user_id])
+                for place, (_, user_id) in enumerate(self._order.slice(start, stop), start + 1)]
+
+    def top(self, limit: int = 10) -> List[tuple]:
+        return self._rows(0, limit)
+
+    def around(self, user_id: int, radius: int = 2) -> List[tuple]:
+        """Игрок и его соседи по таблице: до radius мест выше и ниже"""
+        place = self.rank(user_id)
+        if place is None:
+            return []
+        return self._rows(max(0, place - 1 - radius), place + radius)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+leaderboard = PvPLeaderboard()
+
+async def load_pvp_leaderboard():
+    """Собирает таблицу лидеров из базы при запуске"""
+    rows = await db.fetchall('''
+        SELECT pr.user_id, pr.rating, pr.wins, pr.losses, p.character_name
+        FROM pvp_ratings pr
+        JOIN players p ON pr.user_id = p.user_id
+    ''', readonly=True)
+    leaderboard.load(rows)
 
-# Вызываем создание таблиц при инициализации
-create_pvp_tables()
 
 # Команда PvP и текстовые аналоги
 @router.message(Command('pvp'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'pvp')
-async def cmd_pvp(message: Message):
-    user_id = message.from_user.id
-    player = db.get_player(user_id)
-
+@text_command('pvp')
+async def cmd_pvp(message: Message, player: Optional[Dict]):
     if not player:
         await message.answer("❌ Ты еще не создал персонажа! Напиши /start чтобы начать игру.")
         return
 
+    user_id = player['user_id']
+
     # Проверяем здоровье
     if player['health'] < player['max_health'] * 0.5:
         await message.answer(
@@ -973,17 +2313,17 @@ async def cmd_pvp(message: Message):
         return
 
     # Получаем или создаем PvP рейтинг
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT rating, wins, losses FROM pvp_ratings WHERE user_id = ?', (user_id,))
-    pvp_stats = cursor.fetchone()
+    pvp_stats = await db.fetchone('SELECT rating, wins, losses FROM pvp_ratings WHERE user_id = ?', (user_id,))
 
     if not pvp_stats:
-        cursor.execute('INSERT INTO pvp_ratings (user_id) VALUES (?)', (user_id,))
-        db.conn.commit()
+        await db.execute('INSERT INTO pvp_ratings (user_id) VALUES (?)', (user_id,))
         rating, wins, losses = 1000, 0, 0
     else:
         rating, wins, losses = pvp_stats
 
+    if leaderboard.rank(user_id) is None:
+        leaderboard.record(user_id, rating, wins, losses, player['character_name'])
+
     pvp_text = (
         f"⚔️ **PvP Арена**\n\n"
         f"📊 Твоя статистика:\n"
@@ -1003,49 +2343,45 @@ async def cmd_pvp(message: Message):
     await message.answer(pvp_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Поиск противника для PvP
-@router.callback_query(lambda c: c.data == 'pvp_find')
-async def pvp_find_opponent(callback: CallbackQuery):
+@callbacks.route('pvp_find')
+async def pvp_find_opponent(callback: CallbackQuery, player: Optional[Dict]):
     user_id = callback.from_user.id
-    player = db.get_player(user_id)
 
     # Получаем рейтинг игрока
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT rating FROM pvp_ratings WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    player_rating = result[0] if result else 1000
-
-    # Ищем противника с близким рейтингом (±100)
-    cursor.execute('''
-        SELECT user_id, username, rating FROM pvp_ratings
-        JOIN players ON pvp_ratings.user_id = players.user_id
-        WHERE user_id != ? AND rating BETWEEN ? AND ?
-        ORDER BY ABS(rating - ?)
-        LIMIT 1
-    ''', (user_id, player_rating - 100, player_rating + 100, player_rating))
+    player_rating = await get_pvp_rating(user_id)
 
-    opponent = cursor.fetchone()
+    # Ищем среди тех, кто сейчас в поиске; если никого нет — встаем в очередь
+    ticket = MatchTicket(user_id, player_rating, callback.message.chat.id, callback.message.message_id)
+    opponent = matchmaking.match_or_enqueue(ticket)
 
     if opponent:
-        # Нашли противника - начинаем бой
-        opponent_id, opponent_username, opponent_rating = opponent
-        await start_pvp_battle(callback, user_id, opponent_id, opponent_username, opponent_rating)
-    else:
-        # Не нашли противника - предлагаем бота
-        await callback.message.edit_text(
-            "🔍 Поиск противника...\n\n"
-            "❌ Не удалось найти живого противника с близким рейтингом.\n\n"
-            "Хочешь сразиться с ботом для тренировки?",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🤖 Сразиться с ботом", callback_data="pvp_bot")],
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="pvp_back")]
-            ])
-        )
+        await start_pvp_match(opponent, ticket)
+        return
+
+    await editor.edit(
+        callback.message,
+        "🔍 **Поиск противника...**\n\n"
+        f"🏆 Твой рейтинг: {player_rating}\n"
+        f"🎯 Ищем соперника ±{MatchmakingQueue.BASE_WINDOW}, со временем диапазон расширится.\n\n"
+        "Как только противник найдется, бой начнется здесь.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🤖 Сразиться с ботом", callback_data="pvp_bot")],
+            [InlineKeyboardButton(text="❌ Отменить поиск", callback_data="pvp_cancel")]
+        ]),
+        parse_mode='Markdown'
+    )
+
+# Отмена поиска
+@callbacks.route('pvp_cancel')
+async def pvp_cancel_search(callback: CallbackQuery, player: Optional[Dict]):
+    matchmaking.cancel(callback.from_user.id)
+    await cmd_pvp(callback.message, player)
 
 # Тренировка с ботом
-@router.callback_query(lambda c: c.data == 'pvp_bot')
-async def pvp_bot_battle(callback: CallbackQuery):
+@callbacks.route('pvp_bot')
+async def pvp_bot_battle(callback: CallbackQuery, player: Optional[Dict]):
     user_id = callback.from_user.id
-    player = db.get_player(user_id)
+    matchmaking.cancel(user_id)
 
     # Создаем бота-противника на основе уровня игрока
     bot_level = player['level']
@@ -1058,84 +2394,85 @@ async def pvp_bot_battle(callback: CallbackQuery):
         'mana': 60 + bot_level * 3
     }
 
-    # Сохраняем бой в базу
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        INSERT INTO pvp_battles (player1_id, player2_id, player1_health, player2_health, player1_mana, player2_mana)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, 0, player['health'], bot_stats['health'], player['mana'], bot_stats['mana']))
-
-    battle_id = cursor.lastrowid
-    db.conn.commit()
+    bot_fighter = {
+        'character_name': 'Бот-противник',
+        'max_health': bot_stats['health'],
+        'max_mana': bot_stats['mana'],
+        **bot_stats
+    }
+    battle = pvp_battles.create(user_id, 0, player, bot_fighter,
+                                ((callback.message.chat.id, callback.message.message_id), None))
 
-    await start_pvp_battle_display(callback, battle_id, player, bot_stats, is_bot=True)
+    await start_pvp_battle_display(callback, battle.id, player, bot_stats, is_bot=True)
 
 # Топ игроков PvP
-@router.callback_query(lambda c: c.data == 'pvp_top')
+@callbacks.route('pvp_top')
 async def pvp_top_players(callback: CallbackQuery):
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        SELECT p.character_name, pr.rating, pr.wins, pr.losses
-        FROM pvp_ratings pr
-        JOIN players p ON pr.user_id = p.user_id
-        ORDER BY pr.rating DESC
-        LIMIT 10
-    ''')
+    user_id = callback.from_user.id
 
-    top_players = cursor.fetchall()
+    def format_row(place, row_user_id, rating, wins, losses, name):
+        medal = "🥇" if place == 1 else "🥈" if place == 2 else "🥉" if place == 3 else f"{place}."
+        win_rate = (wins / (wins + losses)) * 100 if (wins + losses) > 0 else 0
+        marker = " 👈" if row_user_id == user_id else ""
+        return f"{medal} {name} - {rating} 📊 ({wins}/{losses}, {win_rate:.1f}%){marker}\n"
 
     top_text = "🏆 **Топ 10 игроков PvP**\n\n"
 
-    for i, (name, rating, wins, losses) in enumerate(top_players, 1):
-        medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-        win_rate = (wins / (wins + losses)) * 100 if (wins + losses) > 0 else 0
-        top_text += f"{medal} {name} - {rating} 📊 ({wins}/{losses}, {win_rate:.1f}%)\n"
+    top_players = leaderboard.top(10)
+    for row in top_players:
+        top_text += format_row(*row)
+
+    # Свое место и соседей показываем, если игрок не попал в топ
+    place = leaderboard.rank(user_id)
+    if place is not None and place > len(top_players):
+        top_text += f"\n📍 **Твое место: {place} из {len(leaderboard)}**\n"
+        for row in leaderboard.around(user_id):
+            top_text += format_row(*row)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⚔️ Найти бой", callback_data="pvp_find")],
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="pvp_back")]
     ])
 
-    await callback.message.edit_text(top_text, reply_markup=keyboard, parse_mode='Markdown')
-
-# Начало PvP боя
-async def start_pvp_battle(callback: CallbackQuery, player1_id: int, player2_id: int, opponent_username: str, opponent_rating: int):
-    player1 = db.get_player(player1_id)
-    player2 = db.get_player(player2_id)
-
-    # Сохраняем бой в базу
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        INSERT INTO pvp_battles (player1_id, player2_id, player1_health, player2_health, player1_mana, player2_mana)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (player1_id, player2_id, player1['health'], player2['health'], player1['mana'], player2['mana']))
+    await editor.edit(callback.message, top_text, reply_markup=keyboard, parse_mode='Markdown')
 
-    battle_id = cursor.lastrowid
-    db.conn.commit()
+# Начало PvP боя: оба игрока узнают о нем одновременно, в своих сообщениях поиска
+async def start_pvp_match(first: MatchTicket, second: MatchTicket):
+    player1, player2 = await asyncio.gather(db.get_player(first.user_id), db.get_player(second.user_id))
+    if not player1 or not player2:
+        return
 
-    # Уведомляем обоих игроков
+    battle = pvp_battles.create(first.user_id, second.user_id, player1, player2,
+                                tuple((ticket.chat_id, ticket.message_id) for ticket in (first, second)))
+    battle_text, keyboard = render_pvp_battle(battle)
     battle_text = (
-        f"⚔️ **Дуэль началась!**\n\n"
-        f"🎯 {player1['character_name']} vs {player2['character_name']}\n"
-        f"🏆 Рейтинг: {get_pvp_rating(player1_id)} vs {opponent_rating}\n\n"
-        f"Бой начинается!"
+        f"⚔️ **Дуэль началась!**\n"
+        f"🏆 Рейтинг: {first.rating} vs {second.rating}\n\n"
+        + battle_text
     )
 
-    await callback.message.edit_text(battle_text, parse_mode='Markdown')
+    await asyncio.gather(*(
+        editor.edit_message(ticket.chat_id, ticket.message_id, battle_text,
+                            reply_markup=keyboard, parse_mode='Markdown')
+        for ticket in (first, second)
+    ), return_exceptions=True)  # Игрок может заблокировать бота
 
-    # Отправляем сообщение второму игроку
+# Поиск не дал результата за отведенное время
+async def expire_pvp_search(ticket: MatchTicket):
     try:
-        await bot.send_message(
-            player2_id,
-            f"⚔️ Тебя вызвали на дуэль! {player1['character_name']} бросает тебе вызов!\n\n"
-            f"Напиши 'дуэль' чтобы принять бой!",
-            parse_mode='Markdown'
-        )
-    except:
-        pass  # Игрок может заблокировать бота
-
-    # Запускаем бой
-    await start_pvp_battle_display(callback, battle_id, player1, player2)
+        await editor.edit_message(
+            ticket.chat_id,
+            ticket.message_id,
+            "🔍 Поиск противника...\n\n"
+            "❌ Не удалось найти живого противника с близким рейтингом.\n\n"
+            "Хочешь сразиться с ботом для тренировки?",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🤖 Сразиться с ботом", callback_data="pvp_bot")],
+                [InlineKeyboardButton(text="⬅️ Назад", callback_data="pvp_back")]
+            ])
+        )
+    except Exception:
+        pass  # Сообщение могли удалить
 
 # Отображение PvP боя
 async def start_pvp_battle_display(callback: CallbackQuery, battle_id: int, player1: Dict, player2: Dict, is_bot: bool = False):
@@ -1155,7 +2492,7 @@ async def start_pvp_battle_display(callback: CallbackQuery, battle_id: int, play
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="⚔️ Атака", callback_data=f"pvp_attack_{battle_id}"),
+            InlineKeyboardButton(text="⚔️ Атака", callback_data=pvp_attack.pack(battle_id)),
             InlineKeyboardButton(text="🔮 Магия", callback_data=f"pvp_magic_{battle_id}")
         ],
         [
@@ -1164,91 +2501,85 @@ async def start_pvp_battle_display(callback: CallbackQuery, battle_id: int, play
         ]
     ])
 
-    await callback.message.edit_text(battle_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, battle_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Обработчик PvP атаки
-@router.callback_query(lambda c: c.data.startswith('pvp_attack_'))
-async def pvp_attack(callback: CallbackQuery):
-    battle_id = int(callback.data.split('_')[2])
+@callbacks.route('pvp_attack_{battle_id:int}')
+async def pvp_attack(callback: CallbackQuery, battle_id: int):
     user_id = callback.from_user.id
 
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM pvp_battles WHERE id = ?', (battle_id,))
-    battle = cursor.fetchone()
+    battle = pvp_battles.get(battle_id)
 
     if not battle:
         await callback.answer("❌ Бой не найден!", show_alert=True)
         return
 
     # Определяем кто атакует
-    if battle[1] == user_id:  # player1
-        attacker_id, defender_id = battle[1], battle[2]
-        attacker_health, defender_health = battle[3], battle[4]
-        attacker_mana, defender_mana = battle[5], battle[6]
-    else:  # player2
-        attacker_id, defender_id = battle[2], battle[1]
-        attacker_health, defender_health = battle[4], battle[3]
-        attacker_mana, defender_mana = battle[6], battle[5]
-
-    attacker = db.get_player(attacker_id)
-    defender = db.get_player(defender_id)
+    side = battle.side_of(user_id)
+    if side is None:
+        await callback.answer("❌ Это не твой бой!", show_alert=True)
+        return
+
+    attacker, defender = battle.fighters[side], battle.fighters[1 - side]
+    attacker_id, defender_id = battle.player_ids[side], battle.player_ids[1 - side]
 
     # Атака
     damage = max(1, attacker['damage'] - random.randint(0, defender['defense'] // 2))
-    defender_health -= damage
+    battle.health[1 - side] -= damage
 
-    battle_log = f"⚔️ {attacker['character_name']} атаковал и нанес {damage} урона!\n"
+    battle.log = f"⚔️ {attacker['character_name']} атаковал и нанес {damage} урона!\n"
 
     # Проверяем победу
-    if defender_health <= 0:
-        await finish_pvp_battle(callback, battle_id, attacker_id, defender_id, battle_log)
+    if battle.health[1 - side] <= 0:
+        await finish_pvp_battle(callback, battle_id, attacker_id, defender_id, battle.log)
         return
 
-    # Обновляем бой в базе
-    if battle[1] == user_id:
-        cursor.execute('UPDATE pvp_battles SET player2_health = ?, battle_log = ? WHERE id = ?',
-                     (defender_health, battle_log, battle_id))
-    else:
-        cursor.execute('UPDATE pvp_battles SET player1_health = ?, battle_log = ? WHERE id = ?',
-                     (defender_health, battle_log, battle_id))
-
-    db.conn.commit()
-
     # Передаем ход
-    await continue_pvp_battle(callback, battle_id, is_bot=(defender_id == 0))
+    pvp_battles.touch(battle)
+    await continue_pvp_battle(callback, battle_id)
 
 # Завершение PvP боя
 async def finish_pvp_battle(callback: CallbackQuery, battle_id: int, winner_id: int, loser_id: int, battle_log: str):
-    cursor = db.conn.cursor()
+    # Бой живет только в памяти, в базу попадает лишь итог. Снимаем его до первого await:
+    # повторный клик, пришедший пока читаются рейтинги, уже не найдет бой и не завершит его второй раз
+    battle = pvp_battles.finish(battle_id)
+    if battle is None:
+        return
+    names = {user_id: fighter['character_name'] for user_id, fighter in zip(battle.player_ids, battle.fighters)}
 
     # Обновляем рейтинги
-    winner_rating = get_pvp_rating(winner_id)
-    loser_rating = get_pvp_rating(loser_id)
+    winner_rating = await get_pvp_rating(winner_id)
+    loser_rating = await get_pvp_rating(loser_id)
 
     # Рассчитываем изменение рейтинга
     rating_change = calculate_rating_change(winner_rating, loser_rating)
 
-    # Обновляем статистику
-    cursor.execute('UPDATE pvp_ratings SET rating = rating + ?, wins = wins + 1 WHERE user_id = ?',
-                  (rating_change, winner_id))
-    cursor.execute('UPDATE pvp_ratings SET rating = rating - ?, losses = losses + 1 WHERE user_id = ?',
-                  (rating_change, loser_id))
+    def save_result(cursor):
+        # Обновляем статистику и забираем новые значения для таблицы лидеров
+        cursor.execute('''
+            UPDATE pvp_ratings SET rating = rating + ?, wins = wins + 1 WHERE user_id = ?
+            RETURNING user_id, rating, wins, losses
+        ''', (rating_change, winner_id))
+        rows = cursor.fetchall()
+        cursor.execute('''
+            UPDATE pvp_ratings SET rating = rating - ?, losses = losses + 1 WHERE user_id = ?
+            RETURNING user_id, rating, wins, losses
+        ''', (rating_change, loser_id))
+        return rows + cursor.fetchall()
+
+    for user_id, rating, wins, losses in await db.run(save_result):
+        leaderboard.record(user_id, rating, wins, losses, names.get(user_id))
 
     # Награды за победу
-    winner = db.get_player(winner_id)
     gold_reward = rating_change * 2
     exp_reward = 50
 
-    db.update_player_stats(winner_id, {
-        'gold': winner['gold'] + gold_reward,
-        'experience': winner['experience'] + exp_reward,
-        'health': winner['max_health'],  # Полное восстановление
-        'mana': winner['max_mana']
-    })
-
-    # Удаляем бой из базы
-    cursor.execute('DELETE FROM pvp_battles WHERE id = ?', (battle_id,))
-    db.conn.commit()
+    winner = await db.apply_deltas(winner_id, {'gold': gold_reward, 'experience': exp_reward})
+    if winner:
+        await db.update_player_stats(winner_id, {
+            'health': winner['max_health'],  # Полное восстановление
+            'mana': winner['max_mana']
+        })
 
     victory_text = (
         f"🎉 **Победа в PvP!**\n\n"
@@ -1265,70 +2596,121 @@ async def finish_pvp_battle(callback: CallbackQuery, battle_id: int, winner_id:
         [InlineKeyboardButton(text="👤 В профиль", callback_data="back_to_profile")]
     ])
 
-    await callback.message.edit_text(victory_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, victory_text, reply_markup=keyboard, parse_mode='Markdown')
 
-# Продолжение PvP боя
-async def continue_pvp_battle(callback: CallbackQuery, battle_id: int, is_bot: bool = False):
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM pvp_battles WHERE id = ?', (battle_id,))
-    battle = cursor.fetchone()
+    # Проигравший узнает итог в своем сообщении боя, иначе оно так и осталось бы с кнопками
+    loser_side = battle.side_of(loser_id)
+    loser_message = battle.messages[loser_side] if loser_side is not None else None
+    if loser_message is None:
+        return  # Бот-противник
 
-    if not battle:
-        return
+    defeat_text = (
+        f"💀 **Поражение в PvP**\n\n"
+        f"{battle_log}\n"
+        f"🏆 Победитель: {names.get(winner_id)}\n"
+        f"📉 Рейтинг: -{rating_change}\n\n"
+        f"Восстановись и попробуй снова!"
+    )
+    try:
+        await editor.edit_message(*loser_message, defeat_text, reply_markup=keyboard, parse_mode='Markdown')
+    except Exception:
+        # Сообщение боя могли удалить: присылаем итог отдельным сообщением
+        await outbox.send(loser_id, defeat_text, reply_markup=keyboard, parse_mode='Markdown')
 
-    player1 = db.get_player(battle[1])
-    player2_data = db.get_player(battle[2]) if not is_bot else {'character_name': 'Бот-противник'}
+# Текст и кнопки текущего состояния PvP боя
+def render_pvp_battle(battle: PvPBattle) -> tuple:
+    player1, player2 = battle.fighters
 
     battle_text = (
         f"⚔️ **PvP Дуэль**\n\n"
         f"👤 {player1['character_name']}\n"
-        f"❤️ {battle[3]}/{player1['max_health']} | 🔮 {battle[5]}/{player1['max_mana']}\n\n"
+        f"❤️ {battle.health[0]}/{player1['max_health']} | 🔮 {battle.mana[0]}/{player1['max_mana']}\n\n"
         f"⚡ VS ⚡\n\n"
-        f"👤 {player2_data['character_name']}\n"
-        f"❤️ {battle[4]}/{player2_data.get('max_health', 100)} | 🔮 {battle[6]}/{player2_data.get('max_mana', 100)}\n\n"
+        f"👤 {player2['character_name']}\n"
+        f"❤️ {battle.health[1]}/{player2['max_health']} | 🔮 {battle.mana[1]}/{player2['max_mana']}\n\n"
     )
 
-    if battle[7]:  # battle_log
-        battle_text += f"📜 {battle[7]}\n\n"
+    if battle.log:
+        battle_text += f"📜 {battle.log}\n\n"
 
     battle_text += "Выбери действие:"
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="⚔️ Атака", callback_data=f"pvp_attack_{battle_id}"),
-            InlineKeyboardButton(text="🔮 Магия", callback_data=f"pvp_magic_{battle_id}")
+            InlineKeyboardButton(text="⚔️ Атака", callback_data=pvp_attack.pack(battle.id)),
+            InlineKeyboardButton(text="🔮 Магия", callback_data=f"pvp_magic_{battle.id}")
         ],
         [
-            InlineKeyboardButton(text="🛡️ Защита", callback_data=f"pvp_defend_{battle_id}"),
-            InlineKeyboardButton(text="💥 Ультимейт", callback_data=f"pvp_ultimate_{battle_id}")
+            InlineKeyboardButton(text="🛡️ Защита", callback_data=f"pvp_defend_{battle.id}"),
+            InlineKeyboardButton(text="💥 Ультимейт", callback_data=f"pvp_ultimate_{battle.id}")
         ]
     ])
+    return battle_text, keyboard
 
-    await callback.message.edit_text(battle_text, reply_markup=keyboard, parse_mode='Markdown')
+# Продолжение PvP боя
+async def continue_pvp_battle(callback: CallbackQuery, battle_id: int):
+    battle = pvp_battles.get(battle_id)
+
+    if not battle:
+        return
+
+    # Кнопку могли нажать в другом сообщении с этим же боем: дальше показываем бой в нем
+    side = battle.side_of(callback.from_user.id)
+    if side is not None:
+        battle.messages[side] = (callback.message.chat.id, callback.message.message_id)
+
+    # Ход видят оба игрока, а не только тот, кто нажал кнопку
+    battle_text, keyboard = render_pvp_battle(battle)
+    await asyncio.gather(*(
+        editor.edit_message(chat_id, message_id, battle_text, reply_markup=keyboard, parse_mode='Markdown')
+        for chat_id, message_id in filter(None, battle.messages)
+    ), return_exceptions=True)  # Соперник может заблокировать бота
 
 # Вспомогательные функции PvP
-def get_pvp_rating(user_id: int) -> int:
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT rating FROM pvp_ratings WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    return result[0] if result else 1000
+async def get_pvp_rating(user_id: int) -> int:
+    rating = leaderboard.rating(user_id)
+    if rating is not None:
+        return rating
+    return await db.fetchval('SELECT rating FROM pvp_ratings WHERE user_id = ?', (user_id,), 1000)
 
 def calculate_rating_change(winner_rating: int, loser_rating: int) -> int:
     expected = 1 / (1 + 10 ** ((loser_rating - winner_rating) / 400))
     return int(32 * (1 - expected))
 
 # Назад в PvP меню
-@router.callback_query(lambda c: c.data == 'pvp_back')
-async def pvp_back(callback: CallbackQuery):
-    await cmd_pvp(callback.message)
+@callbacks.route('pvp_back')
+async def pvp_back(callback: CallbackQuery, player: Optional[Dict]):
+    await cmd_pvp(callback.message, player)
 
 # ==============================
 # ЧАСТЬ 5: КЛАНЫ И ШАХТЫ
 # ==============================
 
 # Добавляем таблицы для кланов и шахт
-def create_clan_and_mine_tables():
-    cursor = db.conn.cursor()
+def create_clan_and_mine_tables(cursor):
+    # Таблица кланов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS clans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE,
+            owner_id INTEGER,
+            level INTEGER DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (owner_id) REFERENCES players (user_id)
+        )
+    ''')
+
+    # Участники кланов (игрок состоит не больше чем в одном клане)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS clan_members (
+            user_id INTEGER PRIMARY KEY,
+            clan_id INTEGER,
+            role TEXT DEFAULT 'member',
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES players (user_id),
+            FOREIGN KEY (clan_id) REFERENCES clans (id)
+        )
+    ''')
 
     # Таблица улучшений замка
     cursor.execute('''
@@ -1374,36 +2756,28 @@ def create_clan_and_mine_tables():
         )
     ''')
 
-    db.conn.commit()
-
-# Вызываем создание таблиц
-create_clan_and_mine_tables()
 
 # ==============================
 # СИСТЕМА КЛАНОВ
 # ==============================
 
 @router.message(Command('clan'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'клан')
-async def cmd_clan(message: Message):
+@text_command('clan')
+async def cmd_clan(message: Message, player: Optional[Dict]):
     user_id = message.from_user.id
-    player = db.get_player(user_id)
 
     if not player:
         await message.answer("❌ Ты еще не создал персонажа! Напиши /start чтобы начать игру.")
         return
 
     # Проверяем состоит ли игрок в клане
-    cursor = db.conn.cursor()
-    cursor.execute('''
+    clan_data = await db.fetchone('''
         SELECT c.id, c.name, c.level, cm.role
         FROM clans c
         JOIN clan_members cm ON c.id = cm.clan_id
         WHERE cm.user_id = ?
     ''', (user_id,))
 
-    clan_data = cursor.fetchone()
-
     if clan_data:
         # Игрок в клане - показываем информацию
         clan_id, clan_name, clan_level, role = clan_data
@@ -1413,15 +2787,11 @@ async def cmd_clan(message: Message):
         await show_clan_creation(message)
 
 async def show_clan_info(message: Message, clan_id: int, clan_name: str, clan_level: int, role: str, user_id: int):
-    cursor = db.conn.cursor()
-
     # Получаем количество участников
-    cursor.execute('SELECT COUNT(*) FROM clan_members WHERE clan_id = ?', (clan_id,))
-    member_count = cursor.fetchone()[0]
+    member_count = await db.fetchval('SELECT COUNT(*) FROM clan_members WHERE clan_id = ?', (clan_id,))
 
     # Получаем информацию об улучшениях замка
-    cursor.execute('SELECT * FROM castle_upgrades WHERE clan_id = ?', (clan_id,))
-    upgrades = cursor.fetchone()
+    upgrades = await db.fetchone('SELECT * FROM castle_upgrades WHERE clan_id = ?', (clan_id,))
 
     clan_text = (
         f"🏰 **Клан {clan_name}**\n\n"
@@ -1477,11 +2847,8 @@ async def show_clan_creation(message: Message):
     await message.answer(clan_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Создание клана
-@router.callback_query(lambda c: c.data == 'clan_create')
-async def clan_create_start(callback: CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
-    player = db.get_player(user_id)
-
+@callbacks.route('clan_create')
+async def clan_create_start(callback: CallbackQuery, state: FSMContext, player: Optional[Dict]):
     # Проверяем уровень игрока
     if player['level'] < 10:
         await callback.answer("❌ Для создания клана нужен 10+ уровень!", show_alert=True)
@@ -1492,41 +2859,66 @@ async def clan_create_start(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Для создания клана нужно 5000 золота!", show_alert=True)
         return
 
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         "🏰 **Создание клана**\n\n"
         "Придумай название для своего клана (3-20 символов):"
     )
 
-    await state.set_state("waiting_clan_name")
+    await state.set_state(ClanStates.waiting_clan_name)
 
-@router.message(lambda message: len(message.text) >= 3 and len(message.text) <= 20)
+@router.message(ClanStates.waiting_clan_name, ~F.text.startswith('/'))
 async def process_clan_name(message: Message, state: FSMContext):
-    clan_name = message.text.strip()
+    clan_name = (message.text or '').strip()
     user_id = message.from_user.id
 
-    # Проверяем уникальность имени
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT id FROM clans WHERE name = ?', (clan_name,))
-    if cursor.fetchone():
-        await message.answer("❌ Клан с таким названием уже существует! Выбери другое:")
+    if not 3 <= len(clan_name) <= 20:
+        await message.answer("❌ Название клана должно быть от 3 до 20 символов. Попробуй еще раз:")
         return
 
-    # Создаем клан
-    cursor.execute('INSERT INTO clans (name, owner_id) VALUES (?, ?)', (clan_name, user_id))
-    clan_id = cursor.lastrowid
+    def create_clan(cursor) -> Optional[int]:
+        # Проверяем уникальность имени
+        cursor.execute('SELECT id FROM clans WHERE name = ?', (clan_name,))
+        if cursor.fetchone():
+            return None
 
-    # Добавляем создателя в клан как владельца
-    cursor.execute('INSERT INTO clan_members (clan_id, user_id, role) VALUES (?, ?, ?)',
-                  (clan_id, user_id, 'owner'))
+        # Создаем клан
+        cursor.execute('INSERT INTO clans (name, owner_id) VALUES (?, ?)', (clan_name, user_id))
+        clan_id = cursor.lastrowid
 
-    # Создаем начальные улучшения замка
-    cursor.execute('INSERT INTO castle_upgrades (clan_id) VALUES (?)', (clan_id,))
+        # Добавляем создателя в клан как владельца
+        cursor.execute('INSERT INTO clan_members (clan_id, user_id, role) VALUES (?, ?, ?)',
+                      (clan_id, user_id, 'owner'))
 
-    # Списываем золото
-    player = db.get_player(user_id)
-    db.update_player_stats(user_id, {'gold': player['gold'] - 5000})
+        # Создаем начальные улучшения замка
+        cursor.execute('INSERT INTO castle_upgrades (clan_id) VALUES (?)', (clan_id,))
+        return clan_id
+
+    # Игрок состоит не больше чем в одном клане: проверяем до списания золота
+    if await db.fetchone('SELECT 1 FROM clan_members WHERE user_id = ?', (user_id,)):
+        await message.answer("❌ Ты уже состоишь в клане!")
+        await state.clear()
+        return
+
+    # Списываем золото до создания: повторное сообщение не создаст второй клан бесплатно
+    if await db.apply_deltas(user_id, {'gold': -5000}) is None:
+        await message.answer("❌ Для создания клана нужно 5000 золота!")
+        await state.clear()
+        return
 
-    db.conn.commit()
+    try:
+        clan_id = await db.run(create_clan)
+    except sqlite3.IntegrityError:
+        # Параллельное сообщение успело создать клан этому же игроку
+        await db.apply_deltas(user_id, {'gold': 5000})
+        await message.answer("❌ Ты уже состоишь в клане!")
+        await state.clear()
+        return
+    if clan_id is None:
+        await db.apply_deltas(user_id, {'gold': 5000})
+        await message.answer("❌ Клан с таким названием уже существует! Выбери другое:")
+        return
+    raid_targets.set_clan(user_id, clan_id)
 
     await message.answer(
         f"🎉 Поздравляю! Ты создал клан **{clan_name}**!\n\n"
@@ -1543,58 +2935,328 @@ async def process_clan_name(message: Message, state: FSMContext):
 # СИСТЕМА ШАХТ
 # ==============================
 
-@router.message(Command('mine'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'шахта')
-async def cmd_mine(message: Message):
-    user_id = message.from_user.id
-    player = db.get_player(user_id)
+class MineState:
+    """Шахта игрока: storage — баланс на момент collected_ts, дальше он растет линейно до max_storage"""
+
+    __slots__ = ('user_id', 'level', 'income_per_hour', 'storage', 'max_storage', 'guard_level', 'collected_ts')
+
+    def __init__(self, user_id: int, level: int, income_per_hour: int, storage: int,
+                 max_storage: int, guard_level: int, collected_ts: int):
+        self.user_id = user_id
+        self.level = level
+        self.income_per_hour = income_per_hour
+        self.storage = storage
+        self.max_storage = max_storage
+        self.guard_level = guard_level
+        self.collected_ts = collected_ts
+
+    def balance(self, now: int) -> int:
+        """Баланс в момент now в замкнутом виде, без пошагового начисления"""
+        accrued = self.income_per_hour * max(0, now - self.collected_ts) // 3600
+        return max(self.storage, min(self.max_storage, self.storage + accrued))
+
+    def full_at(self) -> int:
+        """Момент (epoch), когда хранилище заполнится"""
+        missing = self.max_storage - self.storage
+        if missing <= 0 or self.income_per_hour <= 0:
+            return self.collected_ts
+        return self.collected_ts + -(-missing * 3600 // self.income_per_hour)
+
+    def settle(self, now: int):
+        """Фиксирует накопленное в storage перед изменением баланса, дохода или вместимости"""
+        self.storage = self.balance(now)
+        self.collected_ts = now
+
+class RaidTargets:
+    """Пулы целей для набегов по уровню шахты и защите: выборка без сканирования player_mines"""
+
+    GUARD_BANDS = (1, 3)  # защита 0, 1-2 и 3+ — отдельные пулы
+    LEVEL_SPREAD = 1  # сначала ищем шахты не дальше ±1 уровня от шахты атакующего
+    COOLDOWN = 1800  # секунд защиты шахты после успешного набега
+    MIN_BALANCE = 100
+    DRAWS_PER_TARGET = 4
 
-    if not player:
-        await message.answer("❌ Ты еще не создал персонажа! Напиши /start чтобы начать игру.")
-        return
+    def __init__(self):
+        self._pools: Dict[tuple, List[int]] = {}
+        # user_id -> (пул, позиция в нем) для удаления за O(1)
+        self._slots: Dict[int, tuple] = {}
+        self._clans: Dict[int, int] = {}
+        self._raided_at: Dict[int, int] = {}
+
+    async def load(self):
+        """Загружает кланы и набеги, которые еще держат кулдаун"""
+        self._clans = dict(await db.fetchall('SELECT user_id, clan_id FROM clan_members', readonly=True))
+        rows = await db.fetchall('''
+            SELECT target_id, MAX(CAST(strftime('%s', created_at) AS INTEGER))
+            FROM mine_attacks
+            WHERE created_at >= datetime('now', ?) AND success
+            GROUP BY target_id
+        ''', (f'-{self.COOLDOWN} seconds',), readonly=True)
+        self._raided_at = dict(rows)
+
+    def band(self, mine: MineState) -> tuple:
+        return mine.level, bisect.bisect_right(self.GUARD_BANDS, mine.guard_level)
+
+    def place(self, mine: MineState):
+        """Переносит шахту в пул ее текущего уровня и защиты"""
+        band = self.band(mine)
+        slot = self._slots.get(mine.user_id)
+        if slot is not None:
+            if slot[0] == band:
+                return
+            self.remove(mine.user_id)
+        pool = self._pools.setdefault(band, [])
+        self._slots[mine.user_id] = (band, len(pool))
+        pool.append(mine.user_id)
+
+    def remove(self, user_id: int):
+        band, index = self._slots.pop(user_id)
+        pool = self._pools[band]
+        last = pool.pop()
+        if last != user_id:
+            pool[index] = last
+            self._slots[last] = (band, index)
+
+    def set_clan(self, user_id: int, clan_id: Optional[int]):
+        if clan_id is None:
+            self._clans.pop(user_id, None)
+        else:
+            self._clans[user_id] = clan_id
+
+    def same_clan(self, user_id: int, other_id: int) -> bool:
+        clan_id = self._clans.get(user_id)
+        return clan_id is not None and clan_id == self._clans.get(other_id)
+
+    def on_cooldown(self, target_id: int, now: Optional[int] = None) -> bool:
+        raided_at = self._raided_at.get(target_id)
+        return raided_at is not None and raided_at + self.COOLDOWN > (now or int(time.time()))
+
+    def mark_raided(self, target_id: int, now: Optional[int] = None):
+        self._raided_at[target_id] = now or int(time.time())
+
+    def sample(self, attacker_id: int, level: int, mines: Mapping[int, MineState], limit: int = 5) -> List[tuple]:
+        """Случайные подходящие цели: (баланс, шахта), сначала из соседних по уровню пулов"""
+        now = int(time.time())
+        chosen: Dict[int, tuple] = {}
+        for spread in (self.LEVEL_SPREAD, None):
+            pools = [
+                pool for (pool_level, _), pool in self._pools.items()
+                if pool and (spread is None or abs(pool_level - level) <= spread)
+            ]
+            for user_id in self._draw(pools, limit * self.DRAWS_PER_TARGET):
+                if user_id in chosen or user_id == attacker_id:
+                    continue
+                if self.same_clan(attacker_id, user_id) or self.on_cooldown(user_id, now):
+                    continue
+                balance = mines[user_id].balance(now)
+                if balance > self.MIN_BALANCE:
+                    chosen[user_id] = (balance, mines[user_id])
+                    if len(chosen) >= limit:
+                        break
+            if len(chosen) >= limit:
+                break
+
+        return sorted(chosen.values(), key=lambda entry: entry[0], reverse=True)
 
-    # Получаем или создаем шахту игрока
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM player_mines WHERE user_id = ?', (user_id,))
-    mine_data = cursor.fetchone()
+    @staticmethod
+    def _draw(pools: List[List[int]], draws: int):
+        """Равномерная выборка по объединению пулов: пул ищется бинарным поиском по накопленным размерам"""
+        bounds = list(itertools.accumulate(len(pool) for pool in pools))
+        total = bounds[-1] if bounds else 0
+        if total <= draws:
+            # Кандидатов мало — просто перебираем всех в случайном порядке
+            candidates = [user_id for pool in pools for user_id in pool]
+            random.shuffle(candidates)
+            yield from candidates
+            return
+        for _ in range(draws):
+            position = random.randrange(total)
+            index = bisect.bisect_right(bounds, position)
+            offset = position - (bounds[index - 1] if index else 0)
+            yield pools[index][offset]
 
-    if not mine_data:
-        # Создаем начальную шахту
-        cursor.execute('''
-            INSERT INTO player_mines (user_id, level, income_per_hour, max_storage)
-            VALUES (?, 1, 100, 1000)
+    def __len__(self) -> int:
+        return len(self._slots)
+
+raid_targets = RaidTargets()
+
+class MineEconomy:
+    """Все шахты в памяти: куча моментов заполнения для уведомлений, пулы целей для набегов"""
+
+    MAX_SLEEP = 300  # секунд между проверками кучи, даже если ближайшее заполнение позже
+
+    def __init__(self):
+        self._mines: Dict[int, MineState] = {}
+        # (full_at, user_id); после изменения шахты старая запись остается и пропускается при разборе
+        self._full_heap: List[tuple] = []
+        # Шахты, о заполнении которых уже известно
+        self._full: set = set()
+        self._wake = asyncio.Event()
+        self._timer: Optional[asyncio.Task] = None
+
+    async def load(self):
+        """Загружает шахты при запуске; заполнившиеся во время простоя попадают в индекс без уведомлений"""
+        rows = await db.fetchall('''
+            SELECT user_id, level, income_per_hour, storage, max_storage, guard_level, collected_ts
+            FROM player_mines
+        ''', readonly=True)
+        self._mines = {row[0]: MineState(*row) for row in rows}
+        self._full_heap = [(mine.full_at(), user_id) for user_id, mine in self._mines.items()]
+        heapq.heapify(self._full_heap)
+        self._full = set()
+        self._advance(int(time.time()))
+
+        await raid_targets.load()
+        for mine in self._mines.values():
+            raid_targets.place(mine)
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._timer_loop())
+
+    async def get(self, user_id: int) -> Optional[MineState]:
+        mine = self._mines.get(user_id)
+        if mine is not None:
+            return mine
+
+        row = await db.fetchone('''
+            SELECT user_id, level, income_per_hour, storage, max_storage, guard_level, collected_ts
+            FROM player_mines WHERE user_id = ?
         ''', (user_id,))
-        db.conn.commit()
-        mine_data = (user_id, 1, 100, None, 0, 1000, 0)
+        if row is None:
+            return None
+        # Пока шел запрос, шахту мог загрузить другой хендлер
+        if user_id not in self._mines:
+            self._mines[user_id] = MineState(*row)
+            self._schedule(self._mines[user_id])
+        return self._mines[user_id]
+
+    async def create(self, user_id: int) -> MineState:
+        now = int(time.time())
+        await db.execute('''
+            INSERT OR IGNORE INTO player_mines (user_id, level, income_per_hour, max_storage, storage, collected_ts)
+            VALUES (?, 1, 100, 1000, 0, ?)
+        ''', (user_id, now))
+        return await self.get(user_id)
+
+    async def collect(self, mine: MineState) -> int:
+        """Забирает весь баланс шахты и возвращает собранное"""
+        now = int(time.time())
+        amount = mine.balance(now)
+        if amount <= 0:
+            return 0
+        mine.storage, mine.collected_ts = 0, now
+        self._schedule(mine)
+        await self.save(mine)
+        return amount
+
+    async def upgrade(self, mine: MineState, income_per_hour: int, max_storage: int):
+        mine.settle(int(time.time()))
+        mine.level += 1
+        mine.income_per_hour, mine.max_storage = income_per_hour, max_storage
+        self._schedule(mine)
+        await self.save(mine)
+
+    def raid(self, mine: MineState, stolen: int, guard_damage: int):
+        """Применяет успешный набег в памяти; сохранить шахту вызывающий должен в той же транзакции, что и атаку"""
+        mine.settle(int(time.time()))
+        mine.storage -= stolen
+        mine.guard_level = max(0, mine.guard_level - guard_damage)
+        self._schedule(mine)
+
+    async def save(self, mine: MineState):
+        await db.run(self.save_in, mine)
 
-    user_id, level, income_per_hour, last_collected, storage, max_storage, guard_level = mine_data
+    @staticmethod
+    def save_in(cursor, mine: MineState):
+        """Пишет абсолютные значения: память главнее, порядок записей сохраняет очередь писателя"""
+        cursor.execute('''
+            UPDATE player_mines
+            SET level = ?, income_per_hour = ?, storage = ?, max_storage = ?, guard_level = ?, collected_ts = ?
+            WHERE user_id = ?
+        ''', (mine.level, mine.income_per_hour, mine.storage, mine.max_storage, mine.guard_level,
+              mine.collected_ts, mine.user_id))
+
+    def targets(self, attacker_id: int, limit: int = 5) -> List[tuple]:
+        """Цели для набега, подобранные по уровню шахты атакующего"""
+        attacker_mine = self._mines.get(attacker_id)
+        level = attacker_mine.level if attacker_mine else 1
+        return raid_targets.sample(attacker_id, level, self._mines, limit)
+
+    def _schedule(self, mine: MineState):
+        """Ставит в кучу новый момент заполнения шахты и переносит ее в пул ее уровня и защиты"""
+        self._full.discard(mine.user_id)
+        raid_targets.place(mine)
+        full_at = mine.full_at()
+        if self._full_heap and full_at < self._full_heap[0][0]:
+            self._wake.set()
+        heapq.heappush(self._full_heap, (full_at, mine.user_id))
+
+    def _advance(self, now: int) -> List[int]:
+        """Переносит заполнившиеся к моменту now шахты в индекс и возвращает их владельцев"""
+        filled = []
+        while self._full_heap and self._full_heap[0][0] <= now:
+            full_at, user_id = heapq.heappop(self._full_heap)
+            mine = self._mines.get(user_id)
+            if mine is None or user_id in self._full or mine.full_at() != full_at:
+                continue
+            self._full.add(user_id)
+            filled.append(user_id)
+        return filled
+
+    async def _timer_loop(self):
+        while True:
+            now = int(time.time())
+            for user_id in self._advance(now):
+                asyncio.create_task(notify_mine_full(user_id))
+
+            delay = self.MAX_SLEEP
+            if self._full_heap:
+                delay = min(delay, max(1, self._full_heap[0][0] - now))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
 
-    # Рассчитываем накопленные ресурсы
-    if last_collected:
-        last_collected_dt = datetime.fromisoformat(last_collected)
-        hours_passed = (datetime.now() - last_collected_dt).total_seconds() / 3600
-        resources_accumulated = min(int(hours_passed * income_per_hour), max_storage - storage)
-    else:
-        resources_accumulated = 0
+    def __len__(self) -> int:
+        return len(self._mines)
+
+mine_economy = MineEconomy()
+
+@router.message(Command('mine'))
+@text_command('mine')
+async def cmd_mine(message: Message, player: Optional[Dict]):
+    if not player:
+        await message.answer("❌ Ты еще не создал персонажа! Напиши /start чтобы начать игру.")
+        return
+
+    user_id = player['user_id']
+
+    # Получаем или создаем шахту игрока
+    mine = await mine_economy.get(user_id) or await mine_economy.create(user_id)
 
-    total_resources = storage + resources_accumulated
+    # Баланс считается на текущий момент, накопления хранить не нужно
+    now = int(time.time())
+    total_resources = mine.balance(now)
 
     mine_text = (
         f"⛏️ **Твоя шахта**\n\n"
-        f"📊 Уровень: {level}\n"
-        f"💰 Доход в час: {income_per_hour} золота\n"
-        f"📦 Накоплено: {total_resources}/{max_storage} золота\n"
-        f"🛡️ Уровень защиты: {guard_level}\n\n"
+        f"📊 Уровень: {mine.level}\n"
+        f"💰 Доход в час: {mine.income_per_hour} золота\n"
+        f"📦 Накоплено: {total_resources}/{mine.max_storage} золота\n"
+        f"🛡️ Уровень защиты: {mine.guard_level}\n\n"
     )
 
-    if resources_accumulated > 0:
-        mine_text += f"💎 Можно собрать: {resources_accumulated} золота\n\n"
+    if total_resources > 0:
+        mine_text += f"💎 Можно собрать: {total_resources} золота\n"
+    if total_resources < mine.max_storage:
+        minutes_left = (mine.full_at() - now + 59) // 60
+        mine_text += f"⏳ Хранилище заполнится через {minutes_left // 60} ч {minutes_left % 60} мин\n"
 
-    mine_text += "Выбери действие:"
+    mine_text += "\nВыбери действие:"
 
     keyboard_buttons = []
 
-    if resources_accumulated > 0:
+    if total_resources > 0:
         keyboard_buttons.append([InlineKeyboardButton(text="💎 Собрать ресурсы", callback_data="mine_collect")])
 
     keyboard_buttons.extend([
@@ -1609,47 +3271,29 @@ async def cmd_mine(message: Message):
     await message.answer(mine_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Сбор ресурсов с шахты
-@router.callback_query(lambda c: c.data == 'mine_collect')
+@callbacks.route('mine_collect')
 async def mine_collect(callback: CallbackQuery):
     user_id = callback.from_user.id
 
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM player_mines WHERE user_id = ?', (user_id,))
-    mine_data = cursor.fetchone()
+    mine = await mine_economy.get(user_id)
 
-    if not mine_data:
+    if not mine:
         await callback.answer("❌ Шахта не найдена!", show_alert=True)
         return
 
-    user_id, level, income_per_hour, last_collected, storage, max_storage, guard_level = mine_data
-
-    # Рассчитываем накопленные ресурсы
-    if last_collected:
-        last_collected_dt = datetime.fromisoformat(last_collected)
-        hours_passed = (datetime.now() - last_collected_dt).total_seconds() / 3600
-        resources_accumulated = min(int(hours_passed * income_per_hour), max_storage - storage)
-    else:
-        resources_accumulated = 0
+    resources_accumulated = await mine_economy.collect(mine)
 
     if resources_accumulated <= 0:
         await callback.answer("❌ Нечего собирать! Подожди пока накопится больше ресурсов.", show_alert=True)
         return
 
     # Добавляем золото игроку
-    player = db.get_player(user_id)
-    db.update_player_stats(user_id, {'gold': player['gold'] + resources_accumulated})
-
-    # Обновляем шахту
-    cursor.execute('''
-        UPDATE player_mines
-        SET storage = 0, last_collected = CURRENT_TIMESTAMP
-        WHERE user_id = ?
-    ''', (user_id,))
-    db.conn.commit()
+    player = await db.apply_deltas(user_id, {'gold': resources_accumulated})
 
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         f"💎 Ты собрал {resources_accumulated} золота с шахты!\n\n"
-        f"💰 Твой баланс: {player['gold'] + resources_accumulated} золота\n\n"
+        f"💰 Твой баланс: {player['gold']} золота\n\n"
         f"Шахта продолжает работать...",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="⛏️ К шахте", callback_data="mine_back")],
@@ -1658,25 +3302,22 @@ async def mine_collect(callback: CallbackQuery):
     )
 
 # Улучшение шахты
-@router.callback_query(lambda c: c.data == 'mine_upgrade')
-async def mine_upgrade(callback: CallbackQuery):
+@callbacks.route('mine_upgrade')
+async def mine_upgrade(callback: CallbackQuery, player: Optional[Dict]):
     user_id = callback.from_user.id
-    player = db.get_player(user_id)
 
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM player_mines WHERE user_id = ?', (user_id,))
-    mine_data = cursor.fetchone()
+    mine = await mine_economy.get(user_id)
 
-    if not mine_data:
+    if not mine:
         await callback.answer("❌ Шахта не найдена!", show_alert=True)
         return
 
-    user_id, level, income_per_hour, last_collected, storage, max_storage, guard_level = mine_data
+    level = mine.level
 
     # Стоимость улучшения
     upgrade_cost = level * 2000
-    next_income = income_per_hour + 50
-    next_storage = max_storage + 500
+    next_income = mine.income_per_hour + 50
+    next_storage = mine.max_storage + 500
 
     if player['gold'] < upgrade_cost:
         await callback.answer(f"❌ Недостаточно золота! Нужно {upgrade_cost} золота.", show_alert=True)
@@ -1686,18 +3327,22 @@ async def mine_upgrade(callback: CallbackQuery):
         await callback.answer("❌ Достигнут максимальный уровень шахты!", show_alert=True)
         return
 
-    # Улучшаем шахту
-    cursor.execute('''
-        UPDATE player_mines
-        SET level = level + 1, income_per_hour = ?, max_storage = ?
-        WHERE user_id = ?
-    ''', (next_income, next_storage, user_id))
-
     # Списываем золото
-    db.update_player_stats(user_id, {'gold': player['gold'] - upgrade_cost})
-    db.conn.commit()
+    if await db.apply_deltas(user_id, {'gold': -upgrade_cost}) is None:
+        await callback.answer(f"❌ Недостаточно золота! Нужно {upgrade_cost} золота.", show_alert=True)
+        return
+
+    # Пока шло списание, шахту мог улучшить повторный клик
+    if mine.level != level:
+        await db.apply_deltas(user_id, {'gold': upgrade_cost})
+        await callback.answer("⏳ Шахта уже улучшается!", show_alert=True)
+        return
+
+    # Улучшаем шахту: накопленное по старому доходу фиксируется до смены уровня
+    await mine_economy.upgrade(mine, next_income, next_storage)
 
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         f"🆙 Шахта улучшена до уровня {level + 1}!\n\n"
         f"📈 Новый доход: {next_income} золота/час\n"
         f"📦 Вместимость: {next_storage} золота\n"
@@ -1710,43 +3355,38 @@ async def mine_upgrade(callback: CallbackQuery):
     )
 
 # Атака на шахту другого игрока
-@router.callback_query(lambda c: c.data == 'mine_attack')
-async def mine_attack(callback: CallbackQuery):
+@callbacks.route('mine_attack')
+async def mine_attack(callback: CallbackQuery, player: Optional[Dict]):
     user_id = callback.from_user.id
-    player = db.get_player(user_id)
 
     # Проверяем уровень игрока
     if player['level'] < 5:
         await callback.answer("❌ Для атак на шахты нужен 5+ уровень!", show_alert=True)
         return
 
-    # Ищем цели для атаки (игроки с ресурсами и не в нашем клане)
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        SELECT pm.user_id, p.character_name, pm.level, pm.storage, pm.guard_level
-        FROM player_mines pm
-        JOIN players p ON pm.user_id = p.user_id
-        WHERE pm.user_id != ? AND pm.storage > 100
-        ORDER BY pm.storage DESC
-        LIMIT 5
-    ''', (user_id,))
-
-    targets = cursor.fetchall()
+    # Ищем цели для атаки: случайные шахты близкого уровня, без соклановцев и недавно ограбленных
+    targets = mine_economy.targets(user_id, 5)
 
     if not targets:
         await callback.answer("❌ Нет подходящих целей для атаки!", show_alert=True)
         return
 
+    target_ids = [mine.user_id for _, mine in targets]
+    names = dict(await db.fetchall(
+        f'SELECT user_id, character_name FROM players WHERE user_id IN ({", ".join("?" * len(target_ids))})',
+        tuple(target_ids), readonly=True
+    ))
+
     attack_text = "⚔️ **Выбери цель для атаки:**\n\n"
 
     keyboard_buttons = []
-    for target in targets:
-        target_id, target_name, target_level, target_storage, target_guard = target
-        attack_text += f"👤 {target_name} | ⛏️ Ур.{target_level} | 💰 {target_storage} | 🛡️ {target_guard}\n"
+    for target_storage, mine in targets:
+        target_name = names.get(mine.user_id, "Неизвестный")
+        attack_text += f"👤 {target_name} | ⛏️ Ур.{mine.level} | 💰 {target_storage} | 🛡️ {mine.guard_level}\n"
         keyboard_buttons.append([
             InlineKeyboardButton(
                 text=f"⚔️ Атаковать {target_name}",
-                callback_data=f"mine_attack_{target_id}"
+                callback_data=mine_attack_target.pack(mine.user_id)
             )
         ])
 
@@ -1754,66 +3394,71 @@ async def mine_attack(callback: CallbackQuery):
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
-    await callback.message.edit_text(attack_text, reply_markup=keyboard)
+    await editor.edit(callback.message, attack_text, reply_markup=keyboard)
 
 # Обработка атаки на конкретную шахту
-@router.callback_query(lambda c: c.data.startswith('mine_attack_'))
-async def mine_attack_target(callback: CallbackQuery):
+@callbacks.route('mine_attack_{target_id:int}')
+async def mine_attack_target(callback: CallbackQuery, target_id: int, player: Optional[Dict]):
     attacker_id = callback.from_user.id
-    target_id = int(callback.data.split('_')[2])
 
-    attacker = db.get_player(attacker_id)
-    target_mine = get_player_mine(target_id)
+    attacker = player
+    target_mine = await mine_economy.get(target_id)
 
-    if not target_mine:
+    if not target_mine or target_id == attacker_id:
         await callback.answer("❌ Цель не найдена!", show_alert=True)
         return
 
+    if raid_targets.same_clan(attacker_id, target_id):
+        await callback.answer("❌ Нельзя атаковать шахту соклановца!", show_alert=True)
+        return
+
+    if raid_targets.on_cooldown(target_id):
+        await callback.answer("🛡️ Эту шахту недавно ограбили, выбери другую цель.", show_alert=True)
+        return
+
     # Расчет шанса успеха
-    guard_protection = target_mine[6] * 10  # Каждый уровень защиты дает +10% защиты
+    guard_protection = target_mine.guard_level * 10  # Каждый уровень защиты дает +10% защиты
     success_chance = max(10, 70 - guard_protection)
 
     if random.randint(1, 100) <= success_chance:
         # Успешная атака
-        stolen_resources = min(target_mine[4] // 3, 500)  # Крадем до 33% но не более 500
+        stolen_resources = min(target_mine.balance(int(time.time())) // 3, 500)  # Крадем до 33% но не более 500
         damage_to_guard = random.randint(1, 3)
+        mine_economy.raid(target_mine, stolen_resources, damage_to_guard)
+        raid_targets.mark_raided(target_id)
 
-        # Обновляем шахту цели
-        cursor = db.conn.cursor()
-        cursor.execute('''
-            UPDATE player_mines
-            SET storage = storage - ?, guard_level = GREATEST(0, guard_level - ?)
-            WHERE user_id = ?
-        ''', (stolen_resources, damage_to_guard, target_id))
+        def save_raid(cursor):
+            # Обновляем шахту цели
+            MineEconomy.save_in(cursor, target_mine)
 
-        # Даем ресурсы атакующему
-        db.update_player_stats(attacker_id, {'gold': attacker['gold'] + stolen_resources})
+            # Записываем атаку
+            cursor.execute('''
+                INSERT INTO mine_attacks (attacker_id, target_id, success, resources_stolen, guard_damage)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (attacker_id, target_id, True, stolen_resources, damage_to_guard))
 
-        # Записываем атаку
-        cursor.execute('''
-            INSERT INTO mine_attacks (attacker_id, target_id, success, resources_stolen, guard_damage)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (attacker_id, target_id, True, stolen_resources, damage_to_guard))
+        await db.run(save_raid)
+
+        # Даем ресурсы атакующему
+        attacker = await db.apply_deltas(attacker_id, {'gold': stolen_resources})
 
         result_text = (
             f"🎉 **Успешная атака!**\n\n"
             f"💰 Украдено: {stolen_resources} золота\n"
             f"🛡️ Нанесен урон защите: -{damage_to_guard} уровня\n"
-            f"💎 Твой баланс: {attacker['gold'] + stolen_resources} золота"
+            f"💎 Твой баланс: {attacker['gold']} золота"
         )
     else:
         # Неудачная атака
-        cursor = db.conn.cursor()
-        cursor.execute('''
+        await db.execute('''
             INSERT INTO mine_attacks (attacker_id, target_id, success, resources_stolen, guard_damage)
             VALUES (?, ?, ?, ?, ?)
         ''', (attacker_id, target_id, False, 0, 0))
 
         result_text = "❌ **Атака отражена!** Защита шахты оказалась слишком сильной."
 
-    db.conn.commit()
-
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         result_text,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="⛏️ К шахте", callback_data="mine_back")],
@@ -1831,24 +3476,27 @@ def get_role_icon(role: str) -> str:
     }
     return icons.get(role, '👤')
 
-def get_player_mine(user_id: int):
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM player_mines WHERE user_id = ?', (user_id,))
-    return cursor.fetchone()
+async def notify_mine_full(user_id: int):
+    """Сообщает владельцу, что хранилище шахты заполнилось и доход больше не копится"""
+    await outbox.send(
+        user_id,
+        "⛏️ Хранилище шахты заполнено! Собери золото, пока его не украли.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="💎 Собрать ресурсы", callback_data="mine_collect")]
+        ])
+    )
 
 # Назад к шахте
-@router.callback_query(lambda c: c.data == 'mine_back')
-async def mine_back(callback: CallbackQuery):
-    await cmd_mine(callback.message)
+@callbacks.route('mine_back')
+async def mine_back(callback: CallbackQuery, player: Optional[Dict]):
+    await cmd_mine(callback.message, player)
 
 ## ==============================
 # ЧАСТЬ 6: МАГАЗИН, КЕЙСЫ И ЭКОНОМИКА
 # ==============================
 
 # Добавляем таблицы для магазина и кейсов
-def create_shop_and_case_tables():
-    cursor = db.conn.cursor()
-
+def create_shop_and_case_tables(cursor):
     # Таблица товаров в магазине
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS shop_items (
@@ -1889,17 +3537,8 @@ def create_shop_and_case_tables():
         )
     ''')
 
-    # Заполняем начальные данные
-    initialize_shop_data(cursor)
-    initialize_cases_data(cursor)
-
-    db.conn.commit()
-
 def initialize_shop_data(cursor):
-    # Очищаем старые данные
-    cursor.execute('DELETE FROM shop_items')
-
-    # Добавляем товары в магазин
+    # Добавляем товары в магазин; существующие строки сохраняют id и остаток
     shop_items = [
         # Зелья за золото
         ("🧪 Зелье здоровья", "potion", "common", 50, 0, 1, -1),
@@ -1920,17 +3559,19 @@ def initialize_shop_data(cursor):
         ("** Kopоля мага", "armor", "legendary", 0, 50, 40, 1),  # Ограниченное количество
     ]
 
-    for item in shop_items:
-        cursor.execute('''
-            INSERT INTO shop_items (item_name, item_type, rarity, cost_gold, cost_sapphires, required_level, quantity_available)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', item)
+    cursor.executemany('''
+        INSERT INTO shop_items (item_name, item_type, rarity, cost_gold, cost_sapphires, required_level, quantity_available)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (item_name) DO UPDATE SET
+            item_type = excluded.item_type,
+            rarity = excluded.rarity,
+            cost_gold = excluded.cost_gold,
+            cost_sapphires = excluded.cost_sapphires,
+            required_level = excluded.required_level
+    ''', shop_items)
 
 def initialize_cases_data(cursor):
-    # Очищаем старые данные
-    cursor.execute('DELETE FROM cases')
-
-    # Добавляем кейсы
+    # Добавляем кейсы; существующие строки сохраняют id
     cases = [
         ("⚪ Обычный кейс", 500, 0, '{"common": 70, "uncommon": 25, "rare": 5}'),
         ("🟢 Необычный кейс", 1500, 1, '{"common": 40, "uncommon": 40, "rare": 15, "epic": 5}'),
@@ -1938,21 +3579,107 @@ def initialize_cases_data(cursor):
         ("🟣 Эпический кейс", 0, 15, '{"rare": 40, "epic": 45, "legendary": 15}'),
     ]
 
-    for case in cases:
-        cursor.execute('''
-            INSERT INTO cases (name, cost_gold, cost_sapphires, rarity_distribution)
-            VALUES (?, ?, ?, ?)
-        ''', case)
+    cursor.executemany('''
+        INSERT INTO cases (name, cost_gold, cost_sapphires, rarity_distribution)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET
+            cost_gold = excluded.cost_gold,
+            cost_sapphires = excluded.cost_sapphires,
+            rarity_distribution = excluded.rarity_distribution
+    ''', cases)
+
+
+def initialize_items_data(cursor):
+    # Заводим все известные заранее предметы; варианты с бонусом за уровень монстра появятся при первом выпадении
+    cursor.execute('''
+        INSERT OR IGNORE INTO items (name, item_type, rarity)
+        SELECT item_name, item_type, rarity FROM shop_items
+    ''')
+    static_items = [item for items in CASE_ITEMS_BY_RARITY.values() for item in items]
+    static_items.extend(MONSTER_DROP_TABLE.outcomes)
+    for item in static_items:
+        ItemRegistry.register(cursor, ItemRegistry.key(item), item)
+
+
+# ==============================
+# КАТАЛОГ МАГАЗИНА
+# ==============================
+
+class ShopItem(NamedTuple):
+    id: int
+    name: str
+    item_type: str
+    rarity: str
+    cost_gold: int
+    cost_sapphires: int
+    required_level: int
+    limited: bool  # остаток ведется в shop_items.quantity_available
+
+class CaseEntry(NamedTuple):
+    id: int
+    name: str
+    cost_gold: int
+    cost_sapphires: int
+    loot: 'LootTable'
+
+class ShopCatalog:
+    """Неизменяемый снимок товаров и кейсов в памяти; заменяется целиком через reload с новой версией"""
+
+    def __init__(self):
+        self.version = 0
+        self.items: Mapping[int, ShopItem] = MappingProxyType({})
+        self.by_type: Mapping[str, tuple] = MappingProxyType({})
+        self.cases: Mapping[int, CaseEntry] = MappingProxyType({})
+        # Отрисованные страницы: ключ -> (текст, клавиатура) или None; живут до следующей версии
+        self._pages: Dict[str, Optional[tuple]] = {}
+
+    async def reload(self) -> int:
+        """Перечитывает каталог из базы; вызывать после любого изменения shop_items или cases"""
+        item_rows = await db.fetchall('''
+            SELECT id, item_name, item_type, rarity, cost_gold, cost_sapphires, required_level, quantity_available
+            FROM shop_items
+            WHERE is_available = TRUE
+            ORDER BY id
+        ''', readonly=True)
+        case_rows = await db.fetchall('''
+            SELECT id, name, cost_gold, cost_sapphires, rarity_distribution
+            FROM cases
+            WHERE is_available = TRUE
+            ORDER BY id
+        ''', readonly=True)
+
+        items = {row[0]: ShopItem(*row[:7], limited=row[7] >= 0) for row in item_rows}
+        by_type: Dict[str, list] = {}
+        for item in items.values():
+            by_type.setdefault(item.item_type, []).append(item)
+        cases = {
+            case_id: CaseEntry(case_id, name, cost_gold, cost_sapphires, compile_case_loot(json.loads(distribution)))
+            for case_id, name, cost_gold, cost_sapphires, distribution in case_rows
+        }
+
+        # Между присваиваниями нет await: хендлеры не увидят наполовину обновленный каталог
+        self.items = MappingProxyType(items)
+        self.by_type = MappingProxyType({item_type: tuple(group) for item_type, group in by_type.items()})
+        self.cases = MappingProxyType(cases)
+        self._pages = {}
+        self.version += 1
+        return self.version
+
+    def page(self, key: str, render: Callable[['ShopCatalog'], Optional[tuple]]) -> Optional[tuple]:
+        """Страница из кэша; render вызывается один раз на версию каталога"""
+        if key not in self._pages:
+            self._pages[key] = render(self)
+        return self._pages[key]
+
+shop_catalog = ShopCatalog()
 
-# Вызываем создание таблиц
-create_shop_and_case_tables()
 
 # ==============================
 # СИСТЕМА МАГАЗИНА
 # ==============================
 
 @router.message(Command('shop'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'магазин')
+@text_command('shop')
 async def cmd_shop(message: Message):
     shop_text = (
         "🛍️ **Магический магазин**\n\n"
@@ -1981,70 +3708,66 @@ async def cmd_shop(message: Message):
 
     await message.answer(shop_text, reply_markup=keyboard, parse_mode='Markdown')
 
-# Показ зелий в магазине
-@router.callback_query(lambda c: c.data == 'shop_potions')
-async def shop_show_potions(callback: CallbackQuery):
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        SELECT id, item_name, cost_gold, cost_sapphires, required_level, quantity_available
-        FROM shop_items
-        WHERE item_type = 'potion' AND is_available = TRUE
-        ORDER BY cost_gold, cost_sapphires
-    ''')
+# Разделы магазина по типу товара: callback_data раздела -> (item_type, заголовок)
+SHOP_CATEGORIES = {
+    'potions': ('potion', "🧪 **Зелья и расходники**"),
+    'weapons': ('weapon', "⚔️ **Оружие**"),
+    'armor': ('armor', "🛡️ **Броня**"),
+}
 
-    potions = cursor.fetchall()
+def render_shop_category(catalog: 'ShopCatalog', category: str) -> Optional[tuple]:
+    item_type, title = SHOP_CATEGORIES[category]
+    items = sorted(catalog.by_type.get(item_type, ()), key=lambda item: (item.cost_gold, item.cost_sapphires))
 
-    if not potions:
-        await callback.answer("❌ В этой категории пока нет товаров!", show_alert=True)
-        return
+    if not items:
+        return None
 
-    shop_text = "🧪 **Зелья и расходники**\n\n"
+    shop_text = f"{title}\n\n"
 
     keyboard_buttons = []
-    for potion in potions:
-        item_id, name, cost_gold, cost_sapphires, level, quantity = potion
-
-        if cost_gold > 0:
-            cost_text = f"{cost_gold}💰"
+    for item in items:
+        if item.cost_gold > 0:
+            cost_text = f"{item.cost_gold}💰"
         else:
-            cost_text = f"{cost_sapphires}💎"
+            cost_text = f"{item.cost_sapphires}💎"
 
-        shop_text += f"{name} - {cost_text} | Ур. {level}\n"
+        shop_text += f"{item.name} - {cost_text} | Ур. {item.required_level}\n"
 
         keyboard_buttons.append([
             InlineKeyboardButton(
-                text=f"Купить {name}",
-                callback_data=f"shop_buy_{item_id}"
+                text=f"Купить {item.name}",
+                callback_data=shop_buy_item.pack(item.id)
             )
         ])
 
     keyboard_buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="shop_back")])
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    return shop_text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
-    await callback.message.edit_text(shop_text, reply_markup=keyboard)
+# Показ товаров раздела
+@callbacks.route('shop_{category:potions|weapons|armor}')
+async def shop_show_category(callback: CallbackQuery, category: str):
+    page = shop_catalog.page(category, lambda catalog: render_shop_category(catalog, category))
+
+    if not page:
+        await callback.answer("❌ В этой категории пока нет товаров!", show_alert=True)
+        return
+
+    shop_text, keyboard = page
+    await editor.edit(callback.message, shop_text, reply_markup=keyboard)
 
 # Покупка товара
-@router.callback_query(lambda c: c.data.startswith('shop_buy_'))
-async def shop_buy_item(callback: CallbackQuery):
-    item_id = int(callback.data.split('_')[2])
+@callbacks.route('shop_buy_{item_id:int}')
+async def shop_buy_item(callback: CallbackQuery, item_id: int, player: Optional[Dict]):
     user_id = callback.from_user.id
 
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        SELECT item_name, item_type, rarity, cost_gold, cost_sapphires, required_level, quantity_available
-        FROM shop_items
-        WHERE id = ? AND is_available = TRUE
-    ''', (item_id,))
-
-    item = cursor.fetchone()
+    item = shop_catalog.items.get(item_id)
 
     if not item:
         await callback.answer("❌ Товар не найден!", show_alert=True)
         return
 
-    name, item_type, rarity, cost_gold, cost_sapphires, level, quantity = item
-    player = db.get_player(user_id)
+    name, cost_gold, cost_sapphires, level = item.name, item.cost_gold, item.cost_sapphires, item.required_level
 
     # Проверяем уровень
     if player['level'] < level:
@@ -2060,46 +3783,45 @@ async def shop_buy_item(callback: CallbackQuery):
         await callback.answer(f"❌ Недостаточно сапфиров! Нужно {cost_sapphires}💎", show_alert=True)
         return
 
-    # Проверяем количество
-    if quantity == 0:
-        await callback.answer("❌ Товар закончился!", show_alert=True)
-        return
+    # Остаток ограниченного товара ведет база: списываем его условно, последний экземпляр не продастся дважды
+    if item.limited:
+        reserved = await db.run(lambda cursor: cursor.execute(
+            'UPDATE shop_items SET quantity_available = quantity_available - 1 WHERE id = ? AND quantity_available > 0',
+            (item_id,)
+        ).rowcount)
+        if not reserved:
+            await callback.answer("❌ Товар закончился!", show_alert=True)
+            return
 
     # Списываем валюту
-    updates = {}
-    if cost_gold > 0:
-        updates['gold'] = player['gold'] - cost_gold
-    if cost_sapphires > 0:
-        updates['sapphires'] = player['sapphires'] - cost_sapphires
-
-    db.update_player_stats(user_id, updates)
-
-    # Уменьшаем количество товара если нужно
-    if quantity > 0:
-        cursor.execute('UPDATE shop_items SET quantity_available = quantity_available - 1 WHERE id = ?', (item_id,))
+    player = await db.apply_deltas(user_id, {'gold': -cost_gold, 'sapphires': -cost_sapphires})
+    if player is None:
+        if item.limited:
+            await db.execute('UPDATE shop_items SET quantity_available = quantity_available + 1 WHERE id = ?', (item_id,))
+        await callback.answer("❌ Недостаточно средств!", show_alert=True)
+        return
 
     # Добавляем предмет в инвентарь
-    add_item_to_inventory(user_id, {
+    await add_item_to_inventory(user_id, {
         'name': name,
-        'type': item_type,
-        'rarity': rarity
+        'type': item.item_type,
+        'rarity': item.rarity
     })
 
-    db.conn.commit()
-
     # Показываем подтверждение
     if cost_gold > 0:
         cost_text = f"{cost_gold} золота"
     else:
         cost_text = f"{cost_sapphires} сапфиров"
 
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         f"🎉 **Покупка успешна!**\n\n"
         f"📦 Ты купил: {name}\n"
         f"💳 Потрачено: {cost_text}\n"
         f"📦 Предмет добавлен в инвентарь!\n\n"
         f"💰 Твой баланс:\n"
-        f"Золото: {updates.get('gold', player['gold'])} | Сапфиры: {updates.get('sapphires', player['sapphires'])}",
+        f"Золото: {player['gold']} | Сапфиры: {player['sapphires']}",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🛍️ Продолжить покупки", callback_data="shop_back")],
             [InlineKeyboardButton(text="📦 Инвентарь", callback_data="inventory")]
@@ -2110,58 +3832,59 @@ async def shop_buy_item(callback: CallbackQuery):
 # СИСТЕМА КЕЙСОВ
 # ==============================
 
-@router.callback_query(lambda c: c.data == 'shop_cases')
-async def shop_show_cases(callback: CallbackQuery):
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT id, name, cost_gold, cost_sapphires FROM cases WHERE is_available = TRUE')
-    cases = cursor.fetchall()
-
-    if not cases:
-        await callback.answer("❌ В этой категории пока нет кейсов!", show_alert=True)
-        return
+def render_cases_page(catalog: 'ShopCatalog') -> Optional[tuple]:
+    if not catalog.cases:
+        return None
 
     cases_text = "🎁 **Кейсы с сюрпризом**\n\n"
 
     keyboard_buttons = []
-    for case in cases:
-        case_id, name, cost_gold, cost_sapphires = case
-
-        if cost_gold > 0:
-            cost_text = f"{cost_gold}💰"
+    for case in catalog.cases.values():
+        if case.cost_gold > 0:
+            cost_text = f"{case.cost_gold}💰"
         else:
-            cost_text = f"{cost_sapphires}💎"
+            cost_text = f"{case.cost_sapphires}💎"
 
-        cases_text += f"{name} - {cost_text}\n"
+        cases_text += f"{case.name} - {cost_text}\n"
 
         keyboard_buttons.append([
             InlineKeyboardButton(
-                text=f"Открыть {name}",
-                callback_data=f"case_open_{case_id}"
+                text=f"Открыть {case.name}",
+                callback_data=case_open.pack(case.id)
             )
         ])
+        keyboard_buttons.append([
+            InlineKeyboardButton(text="×10", callback_data=case_open_x10.pack(case.id)),
+            InlineKeyboardButton(text="×100", callback_data=case_open_x100.pack(case.id))
+        ])
 
     keyboard_buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="shop_back")])
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    return cases_text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
-    await callback.message.edit_text(cases_text, reply_markup=keyboard)
+@callbacks.route('shop_cases')
+async def shop_show_cases(callback: CallbackQuery):
+    page = shop_catalog.page('cases', render_cases_page)
+
+    if not page:
+        await callback.answer("❌ В этой категории пока нет кейсов!", show_alert=True)
+        return
+
+    cases_text, keyboard = page
+    await editor.edit(callback.message, cases_text, reply_markup=keyboard)
 
 # Открытие кейса
-@router.callback_query(lambda c: c.data.startswith('case_open_'))
-async def case_open(callback: CallbackQuery):
-    case_id = int(callback.data.split('_')[2])
+@callbacks.route('case_open_{case_id:int}')
+async def case_open(callback: CallbackQuery, case_id: int, player: Optional[Dict]):
     user_id = callback.from_user.id
 
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT name, cost_gold, cost_sapphires, rarity_distribution FROM cases WHERE id = ?', (case_id,))
-    case = cursor.fetchone()
+    case = shop_catalog.cases.get(case_id)
 
     if not case:
         await callback.answer("❌ Кейс не найден!", show_alert=True)
         return
 
-    case_name, cost_gold, cost_sapphires, distribution_json = case
-    player = db.get_player(user_id)
+    cost_gold, cost_sapphires = case.cost_gold, case.cost_sapphires
 
     # Проверяем валюту
     if cost_gold > 0 and player['gold'] < cost_gold:
@@ -2173,47 +3896,42 @@ async def case_open(callback: CallbackQuery):
         return
 
     # Списываем валюту
-    updates = {}
-    if cost_gold > 0:
-        updates['gold'] = player['gold'] - cost_gold
-    if cost_sapphires > 0:
-        updates['sapphires'] = player['sapphires'] - cost_sapphires
-
-    db.update_player_stats(user_id, updates)
+    player = await db.apply_deltas(user_id, {'gold': -cost_gold, 'sapphires': -cost_sapphires})
+    if player is None:
+        await callback.answer("❌ Недостаточно средств!", show_alert=True)
+        return
 
     # Генерируем предмет из кейса
-    distribution = json.loads(distribution_json)
-    item = generate_item_from_case(distribution)
+    item = case.loot.sample()
 
     # Добавляем предмет в инвентарь
-    add_item_to_inventory(user_id, item)
+    await add_item_to_inventory(user_id, item)
 
     # Записываем открытие кейса
-    cursor.execute('''
+    await db.execute('''
         INSERT INTO opened_cases (user_id, case_id, item_name, rarity)
         VALUES (?, ?, ?, ?)
     ''', (user_id, case_id, item['name'], item['rarity']))
 
-    db.conn.commit()
-
     # Анимация открытия кейса
-    await callback.message.edit_text("🎁 Открываем кейс...")
+    await editor.edit(callback.message, "🎁 Открываем кейс...")
     await asyncio.sleep(1)
 
-    await callback.message.edit_text("🎁 Открываем кейс... ✨")
+    await editor.edit(callback.message, "🎁 Открываем кейс... ✨")
     await asyncio.sleep(1)
 
     # Показываем результат
     rarity_icon = get_rarity_icon(item['rarity'])
 
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         f"🎉 **Кейс открыт!**\n\n"
         f"{rarity_icon} **{item['name']}**\n"
         f"📊 Редкость: {item['rarity']}\n"
         f"🎯 Тип: {item['type']}\n\n"
         f"📦 Предмет добавлен в инвентарь!\n\n"
         f"💰 Твой баланс:\n"
-        f"Золото: {updates.get('gold', player['gold'])} | Сапфиры: {updates.get('sapphires', player['sapphires'])}",
+        f"Золото: {player['gold']} | Сапфиры: {player['sapphires']}",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🎁 Открыть еще", callback_data="shop_cases")],
             [InlineKeyboardButton(text="📦 Инвентарь", callback_data="inventory")],
@@ -2221,98 +3939,171 @@ async def case_open(callback: CallbackQuery):
         ])
     )
 
-# Генерация предмета из кейса
-def generate_item_from_case(distribution: Dict) -> Dict:
-    # Создаем список редкостей согласно распределению
-    rarities = []
-    for rarity, chance in distribution.items():
-        rarities.extend([rarity] * chance)
+# Массовое открытие кейсов
+@callbacks.route('case_open10_{case_id:int}')
+async def case_open_x10(callback: CallbackQuery, case_id: int, player: Optional[Dict]):
+    await open_cases_bulk(callback, case_id, 10, player)
 
-    # Выбираем случайную редкость
-    selected_rarity = random.choice(rarities)
+@callbacks.route('case_open100_{case_id:int}')
+async def case_open_x100(callback: CallbackQuery, case_id: int, player: Optional[Dict]):
+    await open_cases_bulk(callback, case_id, 100, player)
 
-    # Генерируем предмет в зависимости от редкости
-    items_by_rarity = {
-        'common': [
-            {"name": "⚔️ Ржавый меч", "type": "weapon", "rarity": "common", "damage": 5},
-            {"name": "🛡️ Кожаный щит", "type": "armor", "rarity": "common", "defense": 3},
-            {"name": "🧪 Слабое зелье", "type": "potion", "rarity": "common", "effect": "heal_30"}
-        ],
-        'uncommon': [
-            {"name": "⚔️ Стальной меч", "type": "weapon", "rarity": "uncommon", "damage": 8},
-            {"name": "🛡️ Кольчужный доспех", "type": "armor", "rarity": "uncommon", "defense": 6},
-            {"name": "🏹 Охотничий лук", "type": "weapon", "rarity": "uncommon", "damage": 7, "agility": 2}
-        ],
-        'rare': [
-            {"name": "⚔️ Зачарованный меч", "type": "weapon", "rarity": "rare", "damage": 12, "intellect": 3},
-            {"name": "🛡️ Мифриловая броня", "type": "armor", "rarity": "rare", "defense": 10, "health": 20},
-            {"name": "🔮 Посох мага", "type": "weapon", "rarity": "rare", "damage": 8, "intellect": 5}
-        ],
-        'epic': [
-            {"name": "🔥 Огненный клинок", "type": "weapon", "rarity": "epic", "damage": 18, "intellect": 5},
-            {"name": "❄️ Ледяной доспех", "type": "armor", "rarity": "epic", "defense": 15, "health": 30},
-            {"name": "⚡ Молниевый посох", "type": "weapon", "rarity": "epic", "damage": 15, "intellect": 8}
-        ],
-        'legendary': [
-            {"name": "🐉 Драконий меч", "type": "weapon", "rarity": "legendary", "damage": 25, "strength": 10},
-            {"name": "👑 Доспех короля", "type": "armor", "rarity": "legendary", "defense": 20, "health": 50},
-            {"name": "🌟 Посох вечности", "type": "weapon", "rarity": "legendary", "damage": 20, "intellect": 15}
-        ]
-    }
+async def open_cases_bulk(callback: CallbackQuery, case_id: int, count: int, player: Optional[Dict]):
+    """Открывает count кейсов разом: одно списание, одна транзакция и одно итоговое сообщение"""
+    user_id = callback.from_user.id
+
+    case = shop_catalog.cases.get(case_id)
 
-    return random.choice(items_by_rarity.get(selected_rarity, items_by_rarity['common']))
+    if not case or not player:
+        await callback.answer("❌ Кейс не найден!", show_alert=True)
+        return
+
+    total_gold, total_sapphires = case.cost_gold * count, case.cost_sapphires * count
+
+    # Проверяем валюту сразу за все кейсы
+    if total_gold > 0 and player['gold'] < total_gold:
+        await callback.answer(f"❌ Недостаточно золота! Нужно {total_gold}💰", show_alert=True)
+        return
+
+    if total_sapphires > 0 and player['sapphires'] < total_sapphires:
+        await callback.answer(f"❌ Недостаточно сапфиров! Нужно {total_sapphires}💎", show_alert=True)
+        return
+
+    items = case.loot.sample_many(count)
+
+    def save_openings(cursor):
+        new_ids = _add_items_to_inventory(cursor, user_id, items)
+        cursor.executemany('''
+            INSERT INTO opened_cases (user_id, case_id, item_name, rarity)
+            VALUES (?, ?, ?, ?)
+        ''', [(user_id, case_id, item['name'], item['rarity']) for item in items])
+        return new_ids
+
+    # Оплата, предметы и история открытий — одна транзакция: нельзя заплатить без предметов и наоборот
+    charged = await db.run_with_charge(user_id, {'gold': total_gold, 'sapphires': total_sapphires}, save_openings)
+    if charged is None:
+        await callback.answer("❌ Недостаточно средств!", show_alert=True)
+        return
+    player, new_ids = charged
+    item_registry.remember(new_ids)
+
+    # Итог: одинаковые предметы вместе, редкие выше
+    rarity_order = ('mythic', 'legendary', 'epic', 'rare', 'uncommon', 'common')
+    counts = Counter(item['name'] for item in items)
+    by_name = {item['name']: item for item in items}
+    summary = sorted(
+        counts.items(),
+        key=lambda entry: (rarity_order.index(by_name[entry[0]]['rarity']), -entry[1], entry[0])
+    )
+
+    result_text = f"🎉 **Открыто кейсов: {count}** ({case.name})\n\n"
+    for name, quantity in summary:
+        result_text += f"{get_rarity_icon(by_name[name]['rarity'])} {name} ×{quantity}\n"
+    result_text += (
+        f"\n📦 Все предметы добавлены в инвентарь!\n\n"
+        f"💰 Твой баланс:\n"
+        f"Золото: {player['gold']} | Сапфиры: {player['sapphires']}"
+    )
+
+    await editor.edit(
+        callback.message,
+        result_text,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"🎁 Открыть еще ×{count}", callback_data=callback.data)],
+            [InlineKeyboardButton(text="🎁 К кейсам", callback_data="shop_cases")],
+            [InlineKeyboardButton(text="📦 Инвентарь", callback_data="inventory")]
+        ]),
+        parse_mode='Markdown'
+    )
+
+# Предметы из кейсов по редкостям; словари общие для всех выпадений
+CASE_ITEMS_BY_RARITY = {
+    'common': [
+        {"name": "⚔️ Ржавый меч", "type": "weapon", "rarity": "common", "damage": 5},
+        {"name": "🛡️ Кожаный щит", "type": "armor", "rarity": "common", "defense": 3},
+        {"name": "🧪 Слабое зелье", "type": "potion", "rarity": "common", "effect": "heal_30"}
+    ],
+    'uncommon': [
+        {"name": "⚔️ Стальной меч", "type": "weapon", "rarity": "uncommon", "damage": 8},
+        {"name": "🛡️ Кольчужный доспех", "type": "armor", "rarity": "uncommon", "defense": 6},
+        {"name": "🏹 Охотничий лук", "type": "weapon", "rarity": "uncommon", "damage": 7, "agility": 2}
+    ],
+    'rare': [
+        {"name": "⚔️ Зачарованный меч", "type": "weapon", "rarity": "rare", "damage": 12, "intellect": 3},
+        {"name": "🛡️ Мифриловая броня", "type": "armor", "rarity": "rare", "defense": 10, "health": 20},
+        {"name": "🔮 Посох мага", "type": "weapon", "rarity": "rare", "damage": 8, "intellect": 5}
+    ],
+    'epic': [
+        {"name": "🔥 Огненный клинок", "type": "weapon", "rarity": "epic", "damage": 18, "intellect": 5},
+        {"name": "❄️ Ледяной доспех", "type": "armor", "rarity": "epic", "defense": 15, "health": 30},
+        {"name": "⚡ Молниевый посох", "type": "weapon", "rarity": "epic", "damage": 15, "intellect": 8}
+    ],
+    'legendary': [
+        {"name": "🐉 Драконий меч", "type": "weapon", "rarity": "legendary", "damage": 25, "strength": 10},
+        {"name": "👑 Доспех короля", "type": "armor", "rarity": "legendary", "defense": 20, "health": 50},
+        {"name": "🌟 Посох вечности", "type": "weapon", "rarity": "legendary", "damage": 20, "intellect": 15}
+    ]
+}
+
+def compile_case_loot(distribution: Dict) -> LootTable:
+    """Шанс редкости делится поровну между ее предметами; неизвестная редкость дает обычные предметы"""
+    weighted = []
+    for rarity, chance in distribution.items():
+        items = CASE_ITEMS_BY_RARITY.get(rarity, CASE_ITEMS_BY_RARITY['common'])
+        weighted.extend((item, chance / len(items)) for item in items)
+    return LootTable(weighted)
 
 # ==============================
 # ПРЕМИУМ МАГАЗИН
 # ==============================
 
-@router.callback_query(lambda c: c.data == 'shop_premium')
-async def shop_show_premium(callback: CallbackQuery):
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        SELECT id, item_name, cost_sapphires, required_level
-        FROM shop_items
-        WHERE cost_sapphires > 0 AND is_available = TRUE
-        ORDER BY cost_sapphires
-    ''')
-
-    premium_items = cursor.fetchall()
+def render_premium_page(catalog: 'ShopCatalog') -> Optional[tuple]:
+    premium_items = sorted(
+        (item for item in catalog.items.values() if item.cost_sapphires > 0),
+        key=lambda item: item.cost_sapphires
+    )
 
     if not premium_items:
-        await callback.answer("❌ В этой категории пока нет товаров!", show_alert=True)
-        return
+        return None
 
     premium_text = "💎 **Премиум товары**\n\n"
     premium_text += "Эксклюзивные предметы только за сапфиры!\n\n"
 
     keyboard_buttons = []
     for item in premium_items:
-        item_id, name, cost_sapphires, level = item
-        premium_text += f"{name} - {cost_sapphires}💎 | Ур. {level}\n"
+        premium_text += f"{item.name} - {item.cost_sapphires}💎 | Ур. {item.required_level}\n"
 
         keyboard_buttons.append([
             InlineKeyboardButton(
-                text=f"Купить {name}",
-                callback_data=f"shop_buy_{item_id}"
+                text=f"Купить {item.name}",
+                callback_data=shop_buy_item.pack(item.id)
             )
         ])
 
     keyboard_buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="shop_back")])
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    return premium_text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@callbacks.route('shop_premium')
+async def shop_show_premium(callback: CallbackQuery):
+    page = shop_catalog.page('premium', render_premium_page)
 
-    await callback.message.edit_text(premium_text, reply_markup=keyboard)
+    if not page:
+        await callback.answer("❌ В этой категории пока нет товаров!", show_alert=True)
+        return
+
+    premium_text, keyboard = page
+    await editor.edit(callback.message, premium_text, reply_markup=keyboard)
 
 # ==============================
 # МОИ ПОКУПКИ
 # ==============================
 
-@router.callback_query(lambda c: c.data == 'shop_my_items')
+@callbacks.route('shop_my_items')
 async def shop_my_items(callback: CallbackQuery):
     user_id = callback.from_user.id
 
-    cursor = db.conn.cursor()
-    cursor.execute('''
+    opened_cases = await db.fetchall('''
         SELECT oc.item_name, oc.rarity, oc.opened_at, c.name
         FROM opened_cases oc
         LEFT JOIN cases c ON oc.case_id = c.id
@@ -2321,8 +4112,6 @@ async def shop_my_items(callback: CallbackQuery):
         LIMIT 10
     ''', (user_id,))
 
-    opened_cases = cursor.fetchall()
-
     items_text = "📦 **Моя история покупок**\n\n"
 
     if not opened_cases:
@@ -2339,10 +4128,10 @@ async def shop_my_items(callback: CallbackQuery):
         [InlineKeyboardButton(text="🎁 Открыть кейс", callback_data="shop_cases")]
     ])
 
-    await callback.message.edit_text(items_text, reply_markup=keyboard)
+    await editor.edit(callback.message, items_text, reply_markup=keyboard)
 
 # Назад в магазин
-@router.callback_query(lambda c: c.data == 'shop_back')
+@callbacks.route('shop_back')
 async def shop_back(callback: CallbackQuery):
     await cmd_shop(callback.message)
 
@@ -2351,9 +4140,7 @@ async def shop_back(callback: CallbackQuery):
 # ==============================
 
 # Добавляем таблицы для боссов и событий
-def create_boss_and_events_tables():
-    cursor = db.conn.cursor()
-
+def create_boss_and_events_tables(cursor):
     # Таблица ежедневных боссов
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS daily_bosses (
@@ -2409,51 +4196,166 @@ def create_boss_and_events_tables():
         )
     ''')
 
-    # Заполняем боссов
-    initialize_bosses_data(cursor)
-
-    db.conn.commit()
-
 def initialize_bosses_data(cursor):
-    # Очищаем старые данные
-    cursor.execute('DELETE FROM daily_bosses')
-
-    # Добавляем ежедневных боссов
+    # Добавляем ежедневных боссов; id закреплен за днем недели и не меняется между запусками,
+    # на него ссылаются boss_battles и boss_current_status
     bosses = [
-        ("🧙‍♂️ Архимаг Вейлон", "mage", 5000, 50, 1000, 10, 1),  # Понедельник
-        ("⚔️ Варлорд Краг", "warrior", 6000, 60, 1200, 15, 2),  # Вторник
-        ("🏹 Теневой лучник", "archer", 4500, 65, 900, 12, 3),   # Среда
-        ("🙏 Верховный жрец", "priest", 4000, 45, 800, 8, 4),   # Четверг
-        ("🔮 Некромант Заракс", "dark_mage", 5500, 70, 1100, 20, 5),  # Пятница
-        ("🐲 Древний дракон", "dragon", 8000, 80, 2000, 25, 6), # Суббота
-        ("🌟 Случайный босс", "random", 3000, 40, 700, 5, 7)    # Воскресенье
+        (1, "🧙‍♂️ Архимаг Вейлон", "mage", 5000, 50, 1000, 10, 1),  # Понедельник
+        (2, "⚔️ Варлорд Краг", "warrior", 6000, 60, 1200, 15, 2),  # Вторник
+        (3, "🏹 Теневой лучник", "archer", 4500, 65, 900, 12, 3),   # Среда
+        (4, "🙏 Верховный жрец", "priest", 4000, 45, 800, 8, 4),   # Четверг
+        (5, "🔮 Некромант Заракс", "dark_mage", 5500, 70, 1100, 20, 5),  # Пятница
+        (6, "🐲 Древний дракон", "dragon", 8000, 80, 2000, 25, 6), # Суббота
+        (7, "🌟 Случайный босс", "random", 3000, 40, 700, 5, 7)    # Воскресенье
     ]
 
-    for boss in bosses:
-        cursor.execute('''
-            INSERT INTO daily_bosses (boss_name, boss_type, health, damage, gold_reward, sapphire_chance, spawn_day)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', boss)
+    cursor.executemany('''
+        INSERT INTO daily_bosses (id, boss_name, boss_type, health, damage, gold_reward, sapphire_chance, spawn_day)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            boss_name = excluded.boss_name,
+            boss_type = excluded.boss_type,
+            health = excluded.health,
+            damage = excluded.damage,
+            gold_reward = excluded.gold_reward,
+            sapphire_chance = excluded.sapphire_chance,
+            spawn_day = excluded.spawn_day
+    ''', bosses)
+
+
+# ==============================
+# ЗДОРОВЬЕ БОССОВ В ПАМЯТИ
+# ==============================
+
+class BossState:
+    """Текущее здоровье босса; меняется только в памяти и периодически сбрасывается в boss_current_status"""
+
+    __slots__ = ('boss_id', 'current_health', 'total_damage', 'is_alive')
+
+    def __init__(self, boss_id: int, current_health: int, total_damage: int, is_alive: bool):
+        self.boss_id = boss_id
+        self.current_health = current_health
+        self.total_damage = total_damage
+        self.is_alive = bool(is_alive)
+
+def boss_battle_day() -> str:
+    """Ключ дня для boss_battles.battle_day — в UTC, как DATE('now') в SQLite"""
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+class BossHealthTracker:
+    """Удары по боссу применяются в памяти без ожиданий, поэтому убийство фиксируется ровно один раз"""
+
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self):
+        self._bosses: Dict[int, BossState] = {}
+        self._dirty: set = set()
+        self._flusher: Optional[asyncio.Task] = None
+        # (boss_id, battle_day) -> user_id всех, кто уже бил босса в этот день
+        self._fighters: Dict[tuple, set] = {}
+
+    async def get(self, boss_id: int, max_health: Optional[int] = None) -> Optional[BossState]:
+        """Состояние босса; если в базе его еще нет и известно полное здоровье — заводит запись"""
+        state = self._bosses.get(boss_id)
+        if state is not None:
+            return state
+
+        row = await db.fetchone(
+            'SELECT current_health, total_damage, is_alive FROM boss_current_status WHERE boss_id = ?', (boss_id,)
+        )
+        if row is None:
+            if max_health is None:
+                return None
+            await db.execute(
+                'INSERT OR IGNORE INTO boss_current_status (boss_id, current_health) VALUES (?, ?)',
+                (boss_id, max_health)
+            )
+            row = (max_health, 0, True)
+
+        # Пока шел запрос, босса мог загрузить и уже ударить другой хендлер — его состояние главнее
+        return self._bosses.setdefault(boss_id, BossState(boss_id, *row))
+
+    async def fighters(self, boss_id: int, day: Optional[str] = None) -> set:
+        """Кто уже сражался с боссом в этот день; при первом обращении читается по уникальному индексу"""
+        day = day or boss_battle_day()
+        key = (boss_id, day)
+        fighters = self._fighters.get(key)
+        if fighters is not None:
+            return fighters
+
+        rows = await db.fetchall(
+            'SELECT user_id FROM boss_battles WHERE boss_id = ? AND battle_day = ?', (boss_id, day)
+        )
+        for stale in [k for k in self._fighters if k[1] != day]:
+            del self._fighters[stale]
+        return self._fighters.setdefault(key, {user_id for user_id, in rows})
+
+    def hit(self, state: BossState, damage: int) -> bool:
+        """Наносит урон и возвращает True только для удара, который убил босса"""
+        state.current_health = max(0, state.current_health - damage)
+        state.total_damage += damage
+        killed = state.is_alive and state.current_health == 0
+        if killed:
+            state.is_alive = False
+
+        self._dirty.add(state.boss_id)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+        return killed
+
+    async def flush(self):
+        """Записывает измененных боссов одной пачкой"""
+        if not self._dirty:
+            return
+
+        rows = [
+            (state.current_health, state.total_damage, state.is_alive, state.boss_id)
+            for state in (self._bosses[boss_id] for boss_id in self._dirty if boss_id in self._bosses)
+        ]
+        dirty, self._dirty = self._dirty, set()
+        try:
+            await db.run(lambda cursor: cursor.executemany('''
+                UPDATE boss_current_status
+                SET current_health = ?, total_damage = ?, is_alive = ?
+                WHERE boss_id = ?
+            ''', rows))
+        except Exception:
+            # Повторим при следующем сбросе
+            self._dirty |= dirty
+            raise
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Не удалось сохранить здоровье боссов")
+
+    def reset(self):
+        """Забывает всех боссов после ежедневного сброса boss_current_status"""
+        self._bosses.clear()
+        self._dirty.clear()
+        self._fighters.clear()
+
+boss_health = BossHealthTracker()
 
-# Вызываем создание таблиц
-create_boss_and_events_tables()
 
 # ==============================
 # СИСТЕМА ЕЖЕДНЕВНЫХ БОССОВ
 # ==============================
 
 @router.message(Command('boss'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'босс')
-async def cmd_boss(message: Message):
-    user_id = message.from_user.id
-    player = db.get_player(user_id)
-
+@text_command('boss')
+async def cmd_boss(message: Message, player: Optional[Dict]):
     if not player:
         await message.answer("❌ Ты еще не создал персонажа! Напиши /start чтобы начать игру.")
         return
 
+    user_id = player['user_id']
+
     # Получаем текущего босса
-    current_boss = get_current_daily_boss()
+    current_boss = await get_current_daily_boss()
 
     if not current_boss:
         await message.answer("❌ На этой неделе все боссы побеждены! Заходи завтра.")
@@ -2461,127 +4363,97 @@ async def cmd_boss(message: Message):
 
     boss_id, boss_name, boss_type, health, damage, gold_reward, sapphire_chance, spawn_day = current_boss
 
-    # Получаем текущее состояние босса
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT current_health, is_alive FROM boss_current_status WHERE boss_id = ?', (boss_id,))
-    boss_status = cursor.fetchone()
-
-    if not boss_status:
-        # Инициализируем босса
-        cursor.execute('INSERT INTO boss_current_status (boss_id, current_health) VALUES (?, ?)', (boss_id, health))
-        db.conn.commit()
-        current_health, is_alive = health, True
-    else:
-        current_health, is_alive = boss_status
+    # Получаем текущее состояние босса, при первом обращении за день оно заводится с полным здоровьем
+    boss_state = await boss_health.get(boss_id, health)
 
-    if not is_alive:
+    if not boss_state.is_alive:
         await message.answer(
             f"🎉 **{boss_name} уже побежден!**\n\n"
             f"Приходи завтра для нового босса!\n"
-            f"Следующий босс: {get_tomorrow_boss_name()}"
+            f"Следующий босс: {await get_tomorrow_boss_name()}"
         )
         return
 
     boss_text = (
         f"🐉 **Ежедневный босс: {boss_name}**\n\n"
-        f"❤️ Здоровье: {current_health}/{health}\n"
+        f"❤️ Здоровье: {boss_state.current_health}/{health}\n"
         f"⚔️ Урон: {damage}\n"
         f"💰 Награда: {gold_reward} золота\n"
         f"💎 Шанс сапфира: {sapphire_chance}%\n\n"
-        f"🏆 Общий нанесенный урон: {get_boss_total_damage(boss_id)}\n\n"
+        f"🏆 Общий нанесенный урон: {boss_state.total_damage}\n\n"
     )
 
     # Проверяем участвовал ли игрок сегодня
-    cursor.execute('''
-        SELECT COUNT(*) FROM boss_battles
-        WHERE user_id = ? AND boss_id = ? AND DATE(battled_at) = DATE('now')
-    ''', (user_id, boss_id))
-
-    already_battled = cursor.fetchone()[0] > 0
+    already_battled = user_id in await boss_health.fighters(boss_id)
 
     if already_battled:
         boss_text += "⚠️ Ты уже сражался с этим боссом сегодня.\n"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📊 Статистика боя", callback_data=f"boss_stats_{boss_id}")],
+            [InlineKeyboardButton(text="📊 Статистика боя", callback_data=boss_stats.pack(boss_id))],
             [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_profile")]
         ])
     else:
         boss_text += "⚔️ Ты можешь атаковать босса один раз в день!"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⚔️ Атаковать босса", callback_data=f"boss_attack_{boss_id}")],
-            [InlineKeyboardButton(text="📊 Статистика", callback_data=f"boss_stats_{boss_id}")]
+            [InlineKeyboardButton(text="⚔️ Атаковать босса", callback_data=boss_attack.pack(boss_id))],
+            [InlineKeyboardButton(text="📊 Статистика", callback_data=boss_stats.pack(boss_id))]
         ])
 
     await message.answer(boss_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Атака на босса
-@router.callback_query(lambda c: c.data.startswith('boss_attack_'))
-async def boss_attack(callback: CallbackQuery):
-    boss_id = int(callback.data.split('_')[2])
+@callbacks.route('boss_attack_{boss_id:int}')
+async def boss_attack(callback: CallbackQuery, boss_id: int, player: Optional[Dict]):
     user_id = callback.from_user.id
-
-    player = db.get_player(user_id)
-    boss_data = get_boss_data(boss_id)
+    boss_data = await get_boss_data(boss_id)
 
     if not boss_data or not player:
         await callback.answer("❌ Ошибка данных!", show_alert=True)
         return
 
-    # Проверяем участвовал ли игрок сегодня
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        SELECT COUNT(*) FROM boss_battles
-        WHERE user_id = ? AND boss_id = ? AND DATE(battled_at) = DATE('now')
-    ''', (user_id, boss_id))
-
-    if cursor.fetchone()[0] > 0:
-        await callback.answer("❌ Ты уже сражался с этим боссом сегодня!", show_alert=True)
-        return
-
     boss_id, boss_name, boss_type, health, damage, gold_reward, sapphire_chance, spawn_day = boss_data
 
-    # Получаем текущее здоровье босса
-    cursor.execute('SELECT current_health FROM boss_current_status WHERE boss_id = ?', (boss_id,))
-    result = cursor.fetchone()
+    # Получаем текущее здоровье босса и тех, кто уже бил его сегодня
+    battle_day = boss_battle_day()
+    boss_state = await boss_health.get(boss_id)
 
-    if not result:
+    if boss_state is None:
         await callback.answer("❌ Босс не найден!", show_alert=True)
         return
 
-    current_health = result[0]
+    fighters = await boss_health.fighters(boss_id, battle_day)
 
-    # Игрок атакует босса
+    # Дальше до записи боя без await: двойное нажатие не пройдет проверку дважды
+    if user_id in fighters:
+        await callback.answer("❌ Ты уже сражался с этим боссом сегодня!", show_alert=True)
+        return
+
+    if not boss_state.is_alive:
+        await callback.answer("🎉 Этот босс уже побежден!", show_alert=True)
+        return
+
+    # Игрок атакует босса: здоровье меняется в памяти, в базу его сбросит boss_health
+    fighters.add(user_id)
     player_damage = calculate_boss_damage(player, boss_type)
-    new_health = current_health - player_damage
+    boss_defeated = boss_health.hit(boss_state, player_damage)
+    new_health = boss_state.current_health
+
+    # Записываем бой
+    await db.execute('''
+        INSERT INTO boss_battles (user_id, boss_id, damage_dealt, battle_day)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, boss_id, player_damage, battle_day))
+
+    if boss_defeated:
+        # Бой убийцы уже записан, а удары до него стояли в очереди записи раньше
+        await boss_health.flush()
+        asyncio.create_task(GameMaster.on_boss_defeated(boss_id))
 
     # Босс атакует игрока (игрок теряет 10% здоровья)
     player_health_loss = max(1, player['health'] // 10)
-    new_player_health = player['health'] - player_health_loss
 
     # Обновляем здоровье игрока
-    db.update_player_stats(user_id, {'health': new_player_health})
-
-    # Обновляем здоровье босса и общий урон
-    cursor.execute('''
-        UPDATE boss_current_status
-        SET current_health = ?, total_damage = total_damage + ?
-        WHERE boss_id = ?
-    ''', (new_health, player_damage, boss_id))
-
-    # Записываем бой
-    cursor.execute('''
-        INSERT INTO boss_battles (user_id, boss_id, damage_dealt)
-        VALUES (?, ?, ?)
-    ''', (user_id, boss_id, player_damage))
-
-    # Проверяем победу над боссом
-    if new_health <= 0:
-        cursor.execute('UPDATE boss_current_status SET is_alive = FALSE WHERE boss_id = ?', (boss_id,))
-        boss_defeated = True
-    else:
-        boss_defeated = False
-
-    db.conn.commit()
+    await db.apply_deltas(user_id, {'health': -player_health_loss})
 
     # Награждаем игрока
     reward_text = await give_boss_rewards(user_id, boss_data, player_damage, boss_defeated)
@@ -2599,17 +4471,16 @@ async def boss_attack(callback: CallbackQuery):
         result_text += f"\n🎉 **{boss_name} ПОБЕЖДЕН!** Все участники получат бонусные награды!"
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Статистика босса", callback_data=f"boss_stats_{boss_id}")],
+        [InlineKeyboardButton(text="📊 Статистика босса", callback_data=boss_stats.pack(boss_id))],
         [InlineKeyboardButton(text="🐉 К боссам", callback_data="boss_back")],
         [InlineKeyboardButton(text="👤 В профиль", callback_data="back_to_profile")]
     ])
 
-    await callback.message.edit_text(result_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, result_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Награды за босса
 async def give_boss_rewards(user_id: int, boss_data: tuple, damage: int, boss_defeated: bool) -> str:
-    boss_id, boss_name, boss_type, health, gold_reward, sapphire_chance, spawn_day = boss_data
-    player = db.get_player(user_id)
+    boss_id, boss_name, boss_type, health, _, gold_reward, sapphire_chance, spawn_day = boss_data
 
     # Базовые награды
     base_gold = max(100, (damage * gold_reward) // health)
@@ -2628,15 +4499,11 @@ async def give_boss_rewards(user_id: int, boss_data: tuple, damage: int, boss_de
             sapphire_reward += 1
 
     # Обновляем статистику игрока
-    updates = {
-        'gold': player['gold'] + base_gold,
-        'experience': player['experience'] + exp_reward
-    }
-
-    if sapphire_reward > 0:
-        updates['sapphires'] = player['sapphires'] + sapphire_reward
-
-    db.update_player_stats(user_id, updates)
+    await db.apply_deltas(user_id, {
+        'gold': base_gold,
+        'experience': exp_reward,
+        'sapphires': sapphire_reward
+    })
 
     # Формируем текст наград
     reward_text = f"🏆 Награды:\n💰 +{base_gold} золота\n⭐ +{exp_reward} опыта"
@@ -2647,36 +4514,30 @@ async def give_boss_rewards(user_id: int, boss_data: tuple, damage: int, boss_de
     return reward_text
 
 # Статистика босса
-@router.callback_query(lambda c: c.data.startswith('boss_stats_'))
-async def boss_stats(callback: CallbackQuery):
-    boss_id = int(callback.data.split('_')[2])
+@callbacks.route('boss_stats_{boss_id:int}')
+async def boss_stats(callback: CallbackQuery, boss_id: int):
 
-    boss_data = get_boss_data(boss_id)
+    boss_data = await get_boss_data(boss_id)
     if not boss_data:
         await callback.answer("❌ Босс не найден!", show_alert=True)
         return
 
-    cursor = db.conn.cursor()
-
     # Топ 5 игроков по урону к этому боссу
-    cursor.execute('''
+    top_damagers = await db.fetchall('''
         SELECT p.character_name, bb.damage_dealt
         FROM boss_battles bb
         JOIN players p ON bb.user_id = p.user_id
-        WHERE bb.boss_id = ? AND DATE(bb.battled_at) = DATE('now')
+        WHERE bb.boss_id = ? AND bb.battle_day = ?
         ORDER BY bb.damage_dealt DESC
         LIMIT 5
-    ''', (boss_id,))
-
-    top_damagers = cursor.fetchall()
+    ''', (boss_id, boss_battle_day()), readonly=True)
 
     # Общая статистика
-    cursor.execute('SELECT total_damage, current_health FROM boss_current_status WHERE boss_id = ?', (boss_id,))
-    total_damage, current_health = cursor.fetchone()
+    boss_state = await boss_health.get(boss_id, boss_data[3])
 
     stats_text = f"📊 **Статистика {boss_data[1]}**\n\n"
-    stats_text += f"🎯 Общий урон: {total_damage}\n"
-    stats_text += f"❤️ Осталось здоровья: {current_health}\n\n"
+    stats_text += f"🎯 Общий урон: {boss_state.total_damage}\n"
+    stats_text += f"❤️ Осталось здоровья: {boss_state.current_health}\n\n"
     stats_text += "🏆 Топ бойцов:\n"
 
     for i, (name, damage) in enumerate(top_damagers, 1):
@@ -2687,24 +4548,21 @@ async def boss_stats(callback: CallbackQuery):
         [InlineKeyboardButton(text="👤 В профиль", callback_data="back_to_profile")]
     ])
 
-    await callback.message.edit_text(stats_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, stats_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # ==============================
 # СИСТЕМА СОБЫТИЙ
 # ==============================
 
 @router.message(Command('events'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'события')
+@text_command('events')
 async def cmd_events(message: Message):
-    cursor = db.conn.cursor()
-    cursor.execute('''
+    active_events = await db.fetchall('''
         SELECT event_name, event_type, start_time, end_time, multiplier_gold, multiplier_exp, description
         FROM game_events
         WHERE is_active = TRUE AND end_time > CURRENT_TIMESTAMP
     ''')
 
-    active_events = cursor.fetchall()
-
     events_text = "🎪 **Активные события**\n\n"
 
     if not active_events:
@@ -2754,29 +4612,35 @@ async def cmd_admin(message: Message):
         [InlineKeyboardButton(text="🐉 Управление боссами", callback_data="admin_manage_bosses")],
         [InlineKeyboardButton(text="🎪 Управление событиями", callback_data="admin_manage_events")],
         [InlineKeyboardButton(text="📊 Статистика сервера", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🔄 Сброс боссов", callback_data="admin_reset_bosses")]
+        [InlineKeyboardButton(text="🔄 Сброс боссов", callback_data="admin_reset_bosses")],
+        [InlineKeyboardButton(text="🛍️ Обновить магазин", callback_data="admin_reload_shop")]
     ])
 
     await message.answer(admin_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Выдача валюты
-@router.callback_query(lambda c: c.data == 'admin_give_currency')
+@callbacks.route('admin_give_currency')
 async def admin_give_currency(callback: CallbackQuery, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Нет доступа!", show_alert=True)
         return
 
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         "💰 **Выдача валюты**\n\n"
         "Введи данные в формате:\n"
         "`ID_игрока золото сапфиры`\n\n"
         "Пример: `123456789 1000 5`"
     )
 
-    await state.set_state("admin_give_currency")
+    await state.set_state(AdminStates.admin_give_currency)
 
-@router.message(lambda message: message.text and message.from_user.id in ADMIN_IDS)
+@router.message(AdminStates.admin_give_currency, ~F.text.startswith('/'))
 async def process_admin_currency(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS or not message.text:
+        await state.clear()
+        return
+
     try:
         parts = message.text.split()
         if len(parts) != 3:
@@ -2787,15 +4651,12 @@ async def process_admin_currency(message: Message, state: FSMContext):
         gold = int(parts[1])
         sapphires = int(parts[2])
 
-        player = db.get_player(target_id)
+        player = await db.get_player(target_id)
         if not player:
             await message.answer("❌ Игрок не найден!")
             return
 
-        db.update_player_stats(target_id, {
-            'gold': player['gold'] + gold,
-            'sapphires': player['sapphires'] + sapphires
-        })
+        await db.apply_deltas(target_id, {'gold': gold, 'sapphires': sapphires})
 
         await message.answer(
             f"✅ Валюта выдана игроку {player['character_name']}!\n"
@@ -2808,27 +4669,28 @@ async def process_admin_currency(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
+# Перечитать каталог магазина после правки товаров или остатков в базе
+@callbacks.route('admin_reload_shop')
+async def admin_reload_shop(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Нет доступа!", show_alert=True)
+        return
+
+    version = await shop_catalog.reload()
+    await callback.answer(f"✅ Каталог обновлен, версия {version}", show_alert=True)
+
 # Статистика сервера
-@router.callback_query(lambda c: c.data == 'admin_stats')
+@callbacks.route('admin_stats')
 async def admin_stats(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Нет доступа!", show_alert=True)
         return
 
-    cursor = db.conn.cursor()
-
     # Общая статистика
-    cursor.execute('SELECT COUNT(*) FROM players')
-    total_players = cursor.fetchone()[0]
-
-    cursor.execute('SELECT COUNT(*) FROM players WHERE DATE(created_at) = DATE("now")')
-    new_today = cursor.fetchone()[0]
-
-    cursor.execute('SELECT SUM(gold) FROM players')
-    total_gold = cursor.fetchone()[0] or 0
-
-    cursor.execute('SELECT SUM(sapphires) FROM players')
-    total_sapphires = cursor.fetchone()[0] or 0
+    total_players = await db.fetchval('SELECT COUNT(*) FROM players', readonly=True)
+    new_today = await db.fetchval("SELECT COUNT(*) FROM players WHERE created_at >= DATE('now')", readonly=True)
+    total_gold = await db.fetchval('SELECT SUM(gold) FROM players', default=0, readonly=True)
+    total_sapphires = await db.fetchval('SELECT SUM(sapphires) FROM players', default=0, readonly=True)
 
     stats_text = (
         f"📊 **Статистика сервера**\n\n"
@@ -2836,32 +4698,31 @@ async def admin_stats(callback: CallbackQuery):
         f"🆕 Новых сегодня: {new_today}\n"
         f"💰 Всего золота: {total_gold}\n"
         f"💎 Всего сапфиров: {total_sapphires}\n"
-        f"🐉 Активных боссов: {get_active_bosses_count()}\n"
-        f"🏰 Создано кланов: {get_clans_count()}"
+        f"🐉 Активных боссов: {await get_active_bosses_count()}\n"
+        f"🏰 Создано кланов: {await get_clans_count()}"
     )
 
-    await callback.message.edit_text(stats_text, parse_mode='Markdown')
+    await editor.edit(callback.message, stats_text, parse_mode='Markdown')
 
 # ==============================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ==============================
 
-def get_current_daily_boss():
+async def get_current_daily_boss():
     """Получает текущего босса по дню недели"""
     current_day = datetime.now().isoweekday()  # 1-7 (понедельник-воскресенье)
 
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        SELECT * FROM daily_bosses
+    return await db.fetchone('''
+        SELECT id, boss_name, boss_type, health, damage, gold_reward, sapphire_chance, spawn_day
+        FROM daily_bosses
         WHERE spawn_day = ? AND is_active = TRUE
     ''', (current_day,))
 
-    return cursor.fetchone()
-
-def get_boss_data(boss_id: int):
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM daily_bosses WHERE id = ?', (boss_id,))
-    return cursor.fetchone()
+async def get_boss_data(boss_id: int):
+    return await db.fetchone('''
+        SELECT id, boss_name, boss_type, health, damage, gold_reward, sapphire_chance, spawn_day
+        FROM daily_bosses WHERE id = ?
+    ''', (boss_id,))
 
 def calculate_boss_damage(player: Dict, boss_type: str) -> int:
     """Рассчитывает урон игрока по боссу"""
@@ -2881,42 +4742,31 @@ def calculate_boss_damage(player: Dict, boss_type: str) -> int:
     bonus = type_bonus.get(boss_type, 0)
     return int(base_damage + bonus + random.randint(5, 15))
 
-def get_boss_total_damage(boss_id: int) -> int:
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT total_damage FROM boss_current_status WHERE boss_id = ?', (boss_id,))
-    result = cursor.fetchone()
-    return result[0] if result else 0
+async def get_boss_total_damage(boss_id: int) -> int:
+    boss_state = await boss_health.get(boss_id)
+    return boss_state.total_damage if boss_state else 0
 
-def get_tomorrow_boss_name() -> str:
+async def get_tomorrow_boss_name() -> str:
     tomorrow_day = (datetime.now().isoweekday() % 7) + 1
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT boss_name FROM daily_bosses WHERE spawn_day = ?', (tomorrow_day,))
-    result = cursor.fetchone()
-    return result[0] if result else "Неизвестный босс"
+    return await db.fetchval('SELECT boss_name FROM daily_bosses WHERE spawn_day = ?', (tomorrow_day,), "Неизвестный босс")
 
-def get_active_bosses_count() -> int:
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM boss_current_status WHERE is_alive = TRUE')
-    return cursor.fetchone()[0]
+async def get_active_bosses_count() -> int:
+    return await db.fetchval('SELECT COUNT(*) FROM boss_current_status WHERE is_alive = TRUE', readonly=True)
 
-def get_clans_count() -> int:
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM clans')
-    return cursor.fetchone()[0]
+async def get_clans_count() -> int:
+    return await db.fetchval('SELECT COUNT(*) FROM clans', readonly=True)
 
 # Назад к боссам
-@router.callback_query(lambda c: c.data == 'boss_back')
-async def boss_back(callback: CallbackQuery):
-    await cmd_boss(callback.message)
+@callbacks.route('boss_back')
+async def boss_back(callback: CallbackQuery, player: Optional[Dict]):
+    await cmd_boss(callback.message, player)
 
     # ==============================
 # ЧАСТЬ 8: РЕЖИМЫ И УЛУЧШЕНИЯ
 # ==============================
 
 # Добавляем таблицы для новых режимов
-def create_game_modes_tables():
-    cursor = db.conn.cursor()
-
+def create_game_modes_tables(cursor):
     # Таблица королевских битв
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS royal_battles (
@@ -2974,17 +4824,220 @@ def create_game_modes_tables():
         )
     ''')
 
-    db.conn.commit()
-
-# Вызываем создание таблиц
-create_game_modes_tables()
 
 # ==============================
 # КОРОЛЕВСКАЯ БИТВА
 # ==============================
 
+class RoyalFighter:
+    """Участник идущей королевской битвы"""
+
+    __slots__ = ('user_id', 'name', 'x', 'y', 'health', 'max_health', 'damage', 'defense', 'kills', 'place', 'ready_tick')
+
+    def __init__(self, user_id: int, name: str, health: int, max_health: int, damage: int, defense: int):
+        self.user_id = user_id
+        self.name = name
+        self.x = self.y = 0
+        self.health = health
+        self.max_health = max_health
+        self.damage = damage
+        self.defense = defense
+        self.kills = 0
+        self.place: Optional[int] = None  # место после выбывания, None — еще жив
+        self.ready_tick = 0
+
+class RoyalMatch:
+    """Один матч: позиции в пространственном хеше по клеткам CELL_SIZE×CELL_SIZE, квадратная зона вокруг центра"""
+
+    MAP_SIZE = 10
+    CELL_SIZE = 2
+    ATTACK_RANGE = 1
+    VISION = 2  # не больше CELL_SIZE: соседи ищутся только в соседних клетках хеша
+
+    __slots__ = ('id', 'fighters', 'cells', 'alive', 'tick', 'zone_center', 'zone_radius', '_zone_rows')
+
+    def __init__(self, battle_id: int, fighters: List[RoyalFighter], zone_center: tuple, zone_radius: int):
+        self.id = battle_id
+        self.fighters = {fighter.user_id: fighter for fighter in fighters}
+        self.cells: Dict[tuple, set] = {}
+        for fighter in fighters:
+            self.cells.setdefault(self.cell(fighter.x, fighter.y), set()).add(fighter.user_id)
+        self.alive = len(fighters)
+        self.tick = 0
+        self.zone_center = zone_center
+        self.zone_radius = zone_radius
+        self._zone_rows = None  # (радиус, строки карты без игроков)
+
+    @classmethod
+    def cell(cls, x: int, y: int) -> tuple:
+        return x // cls.CELL_SIZE, y // cls.CELL_SIZE
+
+    def nearby(self, fighter: RoyalFighter, radius: int) -> List[RoyalFighter]:
+        """Живые соперники на расстоянии radius: просматриваются только 9 соседних клеток хеша"""
+        cx, cy = self.cell(fighter.x, fighter.y)
+        found = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for user_id in self.cells.get((cx + dx, cy + dy), ()):
+                    other = self.fighters[user_id]
+                    if other is not fighter and max(abs(other.x - fighter.x), abs(other.y - fighter.y)) <= radius:
+                        found.append(other)
+        return found
+
+    def move(self, fighter: RoyalFighter, dx: int, dy: int) -> bool:
+        x = min(max(fighter.x + dx, 0), self.MAP_SIZE - 1)
+        y = min(max(fighter.y + dy, 0), self.MAP_SIZE - 1)
+        if (x, y) == (fighter.x, fighter.y):
+            return False
+        old_cell, new_cell = self.cell(fighter.x, fighter.y), self.cell(x, y)
+        if old_cell != new_cell:
+            self._unlink(fighter)
+            self.cells.setdefault(new_cell, set()).add(fighter.user_id)
+        fighter.x, fighter.y = x, y
+        return True
+
+    def in_zone(self, x: int, y: int) -> bool:
+        return max(abs(x - self.zone_center[0]), abs(y - self.zone_center[1])) <= self.zone_radius
+
+    def eliminate(self, fighter: RoyalFighter):
+        fighter.place = self.alive
+        self.alive -= 1
+        self._unlink(fighter)
+
+    def survivors(self) -> List[RoyalFighter]:
+        return [fighter for fighter in self.fighters.values() if fighter.place is None]
+
+    def _unlink(self, fighter: RoyalFighter):
+        key = self.cell(fighter.x, fighter.y)
+        members = self.cells[key]
+        members.discard(fighter.user_id)
+        if not members:
+            del self.cells[key]
+
+    def render(self, fighter: RoyalFighter) -> str:
+        """Карта глазами игрока: строки зоны кэшируются до ее сжатия, перерисовываются только строки с игроками"""
+        if self._zone_rows is None or self._zone_rows[0] != self.zone_radius:
+            rows = tuple(
+                tuple('⬜' if self.in_zone(x, y) else '🟥' for x in range(self.MAP_SIZE))
+                for y in range(self.MAP_SIZE)
+            )
+            self._zone_rows = (self.zone_radius, rows, tuple(''.join(row) for row in rows))
+        _, rows, lines = self._zone_rows
+
+        marks: Dict[int, Dict[int, str]] = {}
+        if fighter.place is None:
+            for other in self.nearby(fighter, self.VISION):
+                marks.setdefault(other.y, {})[other.x] = '🔴'
+            marks.setdefault(fighter.y, {})[fighter.x] = '👤'
+
+        rendered = list(lines)
+        for y, row_marks in marks.items():
+            row = list(rows[y])
+            for x, mark in row_marks.items():
+                row[x] = mark
+            rendered[y] = ''.join(row)
+        return '\n'.join(rendered)
+
+class RoyalBattleEngine:
+    """Идущие королевские битвы в памяти: один цикл тиков на все матчи, в базу пишутся только итоги"""
+
+    TICK = 5  # секунд
+    ZONE_DELAY = 24  # тиков до первого сжатия зоны (2 минуты)
+    ZONE_SHRINK_EVERY = 6
+    ZONE_DAMAGE = 15
+    MAX_TICKS = 240  # через 20 минут побеждает самый здоровый
+    ATTACK_COOLDOWN = 1  # тиков между атаками одного игрока
+    MOVES = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}
+
+    def __init__(self):
+        self._matches: Dict[int, RoyalMatch] = {}
+        self._ticker: Optional[asyncio.Task] = None
+
+    def get(self, battle_id: int) -> Optional[RoyalMatch]:
+        return self._matches.get(battle_id)
+
+    def start(self, battle_id: int, fighters: List[RoyalFighter]) -> RoyalMatch:
+        size = RoyalMatch.MAP_SIZE
+        for fighter, spot in zip(fighters, random.sample(range(size * size), len(fighters))):
+            fighter.x, fighter.y = divmod(spot, size)
+        # Центр зоны не у края, начальная зона накрывает всю карту
+        zone_center = (random.randint(3, size - 4), random.randint(3, size - 4))
+        match = RoyalMatch(battle_id, fighters, zone_center, size // 2 + 1)
+        self._matches[battle_id] = match
+
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._tick_loop())
+        return match
+
+    def attack(self, match: RoyalMatch, fighter: RoyalFighter) -> Optional[tuple]:
+        """Бьет самого раненого соседа; возвращает (цель, урон) или None, если рядом никого"""
+        targets = match.nearby(fighter, RoyalMatch.ATTACK_RANGE)
+        if not targets:
+            return None
+
+        target = min(targets, key=lambda other: other.health)
+        damage = max(1, fighter.damage + random.randint(-3, 3) - target.defense // 2)
+        target.health = max(0, target.health - damage)
+        fighter.ready_tick = match.tick + self.ATTACK_COOLDOWN
+
+        if target.health == 0:
+            fighter.kills += 1
+            self._eliminate(match, target, f"⚔️ Тебя победил {fighter.name}")
+        return target, damage
+
+    def leave(self, match: RoyalMatch, fighter: RoyalFighter):
+        fighter.health = 0
+        self._eliminate(match, fighter, None)
+
+    def advance(self, match: RoyalMatch):
+        """Один тик матча: сжатие зоны и урон тем, кто остался снаружи"""
+        match.tick += 1
+        since_delay = match.tick - self.ZONE_DELAY
+        if since_delay >= 0 and since_delay % self.ZONE_SHRINK_EVERY == 0 and match.zone_radius > 0:
+            match.zone_radius -= 1
+
+        # Самые слабые выбывают первыми, даже если зона добивает нескольких за один тик
+        outside = [fighter for fighter in match.survivors() if not match.in_zone(fighter.x, fighter.y)]
+        for fighter in sorted(outside, key=lambda fighter: fighter.health):
+            if match.alive <= 1:
+                break
+            fighter.health = max(0, fighter.health - self.ZONE_DAMAGE)
+            if fighter.health == 0:
+                self._eliminate(match, fighter, "🔥 Тебя поглотила зона")
+
+        if match.id in self._matches and match.tick >= self.MAX_TICKS:
+            self.finish(match)
+
+    def finish(self, match: RoyalMatch):
+        """Распределяет места оставшихся по здоровью и сохраняет итоги"""
+        if self._matches.pop(match.id, None) is None:
+            return
+        for fighter in sorted(match.survivors(), key=lambda fighter: fighter.health):
+            match.eliminate(fighter)
+        asyncio.create_task(save_royal_results(match))
+
+    def _eliminate(self, match: RoyalMatch, fighter: RoyalFighter, reason: Optional[str]):
+        match.eliminate(fighter)
+        if reason:
+            asyncio.create_task(outbox.send(
+                fighter.user_id, f"💀 {reason}! Ты занял {fighter.place} место. Итоги придут после окончания битвы."
+            ))
+        if match.alive <= 1:
+            self.finish(match)
+
+    async def _tick_loop(self):
+        while self._matches:
+            await asyncio.sleep(self.TICK)
+            for match in list(self._matches.values()):
+                self.advance(match)
+
+    def __len__(self) -> int:
+        return len(self._matches)
+
+royal_engine = RoyalBattleEngine()
+
 @router.message(Command('royal'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'королевская битва')
+@text_command('royal')
 async def cmd_royal_battle(message: Message):
     royal_text = (
         "👑 **Королевская битва**\n\n"
@@ -3007,26 +5060,22 @@ async def cmd_royal_battle(message: Message):
     await message.answer(royal_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Быстрый поиск королевской битвы
-@router.callback_query(lambda c: c.data == 'royal_quick_join')
-async def royal_quick_join(callback: CallbackQuery):
+@callbacks.route('royal_quick_join')
+async def royal_quick_join(callback: CallbackQuery, player: Optional[Dict]):
     user_id = callback.from_user.id
-    player = db.get_player(user_id)
 
     if not player:
         await callback.answer("❌ Сначала создай персонажа!", show_alert=True)
         return
 
     # Ищем активную битву с свободными местами
-    cursor = db.conn.cursor()
-    cursor.execute('''
+    battle = await db.fetchone('''
         SELECT id, battle_code, current_players, max_players
         FROM royal_battles
         WHERE is_active = TRUE AND is_started = FALSE AND current_players < max_players
         LIMIT 1
     ''')
 
-    battle = cursor.fetchone()
-
     if battle:
         # Присоединяемся к существующей битве
         battle_id, battle_code, current_players, max_players = battle
@@ -3034,38 +5083,39 @@ async def royal_quick_join(callback: CallbackQuery):
     else:
         # Создаем новую битву
         battle_code = generate_battle_code()
-        cursor.execute('''
+        battle_id = await db.execute('''
             INSERT INTO royal_battles (battle_code, max_players, is_active)
             VALUES (?, 10, TRUE)
         ''', (battle_code,))
-        battle_id = cursor.lastrowid
-        db.conn.commit()
 
         await join_royal_battle(callback, battle_id, user_id, player)
 
 async def join_royal_battle(callback: CallbackQuery, battle_id: int, user_id: int, player: Dict):
-    cursor = db.conn.cursor()
+    def join(cursor):
+        # Проверяем не присоединился ли уже
+        cursor.execute('SELECT 1 FROM royal_battle_players WHERE battle_id = ? AND user_id = ?', (battle_id, user_id))
+        if cursor.fetchone():
+            return None
 
-    # Проверяем не присоединился ли уже
-    cursor.execute('SELECT 1 FROM royal_battle_players WHERE battle_id = ? AND user_id = ?', (battle_id, user_id))
-    if cursor.fetchone():
-        await callback.answer("❌ Ты уже в этой битве!", show_alert=True)
-        return
+        # Добавляем игрока в битву
+        cursor.execute('''
+            INSERT INTO royal_battle_players (battle_id, user_id, health)
+            VALUES (?, ?, ?)
+        ''', (battle_id, user_id, player['health']))
 
-    # Добавляем игрока в битву
-    cursor.execute('''
-        INSERT INTO royal_battle_players (battle_id, user_id, health)
-        VALUES (?, ?, ?)
-    ''', (battle_id, user_id, player['health']))
+        # Обновляем счетчик игроков
+        cursor.execute('UPDATE royal_battles SET current_players = current_players + 1 WHERE id = ?', (battle_id,))
 
-    # Обновляем счетчик игроков
-    cursor.execute('UPDATE royal_battles SET current_players = current_players + 1 WHERE id = ?', (battle_id,))
+        # Получаем обновленную информацию о битве
+        cursor.execute('SELECT battle_code, current_players, max_players FROM royal_battles WHERE id = ?', (battle_id,))
+        return cursor.fetchone()
 
-    # Получаем обновленную информацию о битве
-    cursor.execute('SELECT battle_code, current_players, max_players FROM royal_battles WHERE id = ?', (battle_id,))
-    battle_code, current_players, max_players = cursor.fetchone()
+    battle = await db.run(join)
+    if battle is None:
+        await callback.answer("❌ Ты уже в этой битве!", show_alert=True)
+        return
 
-    db.conn.commit()
+    battle_code, current_players, max_players = battle
 
     battle_text = (
         f"🎮 **Королевская битва #{battle_code}**\n\n"
@@ -3075,27 +5125,26 @@ async def join_royal_battle(callback: CallbackQuery, battle_id: int, user_id: in
     )
 
     # Получаем список игроков
-    cursor.execute('''
+    players = await db.fetchall('''
         SELECT p.character_name
         FROM royal_battle_players rbp
         JOIN players p ON rbp.user_id = p.user_id
         WHERE rbp.battle_id = ?
     ''', (battle_id,))
 
-    players = cursor.fetchall()
     for i, (name,) in enumerate(players, 1):
         battle_text += f"{i}. {name}\n"
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data=f"royal_refresh_{battle_id}")],
-        [InlineKeyboardButton(text="🚪 Покинуть", callback_data=f"royal_leave_{battle_id}")]
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=royal_refresh.pack(battle_id))],
+        [InlineKeyboardButton(text="🚪 Покинуть", callback_data=royal_leave.pack(battle_id))]
     ])
 
     # Проверяем можно ли начинать
     if current_players >= 3:
-        keyboard.inline_keyboard.append([InlineKeyboardButton(text="🎬 Начать битву", callback_data=f"royal_start_{battle_id}")])
+        keyboard.inline_keyboard.append([InlineKeyboardButton(text="🎬 Начать битву", callback_data=royal_start.pack(battle_id))])
 
-    await callback.message.edit_text(battle_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, battle_text, reply_markup=keyboard, parse_mode='Markdown')
 
     # Автоматически начинаем при заполнении
     if current_players >= max_players:
@@ -3104,96 +5153,206 @@ async def join_royal_battle(callback: CallbackQuery, battle_id: int, user_id: in
 
 # Начало королевской битвы
 async def start_royal_battle(battle_id: int):
-    cursor = db.conn.cursor()
-    cursor.execute('UPDATE royal_battles SET is_started = TRUE WHERE id = ?', (battle_id,))
-    db.conn.commit()
+    def claim(cursor) -> Optional[list]:
+        # Битву запускает только первый, кто успел: кнопка и автозапуск могут сработать одновременно
+        cursor.execute('UPDATE royal_battles SET is_started = TRUE WHERE id = ? AND is_started = FALSE', (battle_id,))
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute('SELECT user_id, health FROM royal_battle_players WHERE battle_id = ?', (battle_id,))
+        return cursor.fetchall()
+
+    participants = await db.run(claim)
+    if participants is None:
+        return
 
-    # Получаем всех игроков
-    cursor.execute('''
-        SELECT rbp.user_id, p.character_name
-        FROM royal_battle_players rbp
-        JOIN players p ON rbp.user_id = p.user_id
-        WHERE rbp.battle_id = ?
-    ''', (battle_id,))
+    # Характеристики берутся из кэша игроков, в бою база больше не читается
+    fighters = []
+    for user_id, health in participants:
+        player = await db.get_player(user_id)
+        if player:
+            fighters.append(RoyalFighter(
+                user_id, player['character_name'], min(health, player['max_health']), player['max_health'],
+                player['damage'], player['defense']
+            ))
+    royal_engine.start(battle_id, fighters)
+
+    # Отправляем сообщение о начале всем игрокам: рассылка идет через очередь, а не по одному
+    for fighter in fighters:
+        await outbox.send(
+            fighter.user_id,
+            "🎬 **Королевская битва началась!**\n\n"
+            "🏃‍♂️ Беги к центру карты!\n"
+            "🔥 Зона начинает уменьшаться через 2 минуты!\n"
+            "⚔️ Сражайся с другими игроками!\n\n"
+            "Последний выживший получит легендарные награды!",
+            parse_mode='Markdown'
+        )
 
-    players = cursor.fetchall()
+        # Отправляем карту боя
+        await send_royal_battle_map(fighter.user_id, battle_id)
 
-    # Отправляем сообщение о начале всем игрокам
-    for user_id, character_name in players:
-        try:
-            await bot.send_message(
-                user_id,
-                "🎬 **Королевская битва началась!**\n\n"
-                "🏃‍♂️ Беги к центру карты!\n"
-                "🔥 Зона начинает уменьшаться через 2 минуты!\n"
-                "⚔️ Сражайся с другими игроками!\n\n"
-                "Последний выживший получит легендарные награды!",
-                parse_mode='Markdown'
-            )
+def render_royal_battle_map(match: RoyalMatch, fighter: RoyalFighter) -> tuple:
+    """Текст и кнопки карты для игрока"""
+    map_text = f"🗺️ Карта битвы\n\n{match.render(fighter)}\n\n"
 
-            # Отправляем карту боя
-            await send_royal_battle_map(user_id, battle_id)
+    if match.tick < RoyalBattleEngine.ZONE_DELAY:
+        zone_text = f"сжатие через {(RoyalBattleEngine.ZONE_DELAY - match.tick) * RoyalBattleEngine.TICK} с"
+    else:
+        zone_text = f"радиус {match.zone_radius}"
+    map_text += (
+        f"❤️ Здоровье: {fighter.health}/{fighter.max_health}\n"
+        f"🎯 Позиция: ({fighter.x}, {fighter.y})\n"
+        f"💀 Убийств: {fighter.kills}\n"
+        f"👥 Живых: {match.alive}\n"
+        f"🔥 Зона: {zone_text}"
+    )
+    if not match.in_zone(fighter.x, fighter.y):
+        map_text += f"\n⚠️ Ты вне зоны: -{RoyalBattleEngine.ZONE_DAMAGE} ❤️ каждые {RoyalBattleEngine.TICK} с"
 
-        except Exception as e:
-            print(f"Не удалось отправить сообщение игроку {user_id}: {e}")
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="⬆️", callback_data=royal_move.pack(match.id, 'up')),
+            InlineKeyboardButton(text="⬇️", callback_data=royal_move.pack(match.id, 'down'))
+        ],
+        [
+            InlineKeyboardButton(text="⬅️", callback_data=royal_move.pack(match.id, 'left')),
+            InlineKeyboardButton(text="➡️", callback_data=royal_move.pack(match.id, 'right'))
+        ],
+        [InlineKeyboardButton(text="⚔️ Атаковать рядом", callback_data=royal_attack.pack(match.id))],
+        [InlineKeyboardButton(text="🔄 Обновить карту", callback_data=royal_refresh.pack(match.id))]
+    ])
+    return map_text, keyboard
 
 # Карта королевской битвы
 async def send_royal_battle_map(user_id: int, battle_id: int):
-    cursor = db.conn.cursor()
+    match = royal_engine.get(battle_id)
+    fighter = match.fighters.get(user_id) if match else None
+
+    if not fighter:
+        return
 
-    # Получаем позицию игрока
-    cursor.execute('SELECT position_x, position_y, health FROM royal_battle_players WHERE battle_id = ? AND user_id = ?', (battle_id, user_id))
-    player_pos = cursor.fetchone()
+    map_text, keyboard = render_royal_battle_map(match, fighter)
+    await outbox.send(user_id, map_text, reply_markup=keyboard)
 
-    if not player_pos:
+async def get_royal_fighter(callback: CallbackQuery, battle_id: int) -> Optional[tuple]:
+    """Матч и живой участник для кнопок боя; иначе отвечает игроку и возвращает None"""
+    match = royal_engine.get(battle_id)
+    fighter = match.fighters.get(callback.from_user.id) if match else None
+
+    if not fighter:
+        await callback.answer("❌ Битва уже закончилась!", show_alert=True)
+        return None
+    if fighter.place is not None:
+        await callback.answer(f"💀 Ты выбыл и занял {fighter.place} место.", show_alert=True)
+        return None
+    return match, fighter
+
+# Кнопка запуска битвы в комнате ожидания
+@callbacks.route('royal_start_{battle_id:int}')
+async def royal_start(callback: CallbackQuery, battle_id: int):
+    battle = await db.fetchone('''
+        SELECT rb.current_players, rb.is_started
+        FROM royal_battles rb
+        JOIN royal_battle_players rbp ON rbp.battle_id = rb.id
+        WHERE rb.id = ? AND rbp.user_id = ?
+    ''', (battle_id, callback.from_user.id))
+
+    if not battle:
+        await callback.answer("❌ Ты не участвуешь в этой битве!", show_alert=True)
         return
 
-    player_x, player_y, health = player_pos
+    current_players, is_started = battle
+    if is_started:
+        await callback.answer("🎬 Битва уже началась!", show_alert=True)
+        return
+    if current_players < 3:
+        await callback.answer("❌ Для начала нужно минимум 3 игрока!", show_alert=True)
+        return
 
-    # Создаем простую текстовую карту
-    map_size = 10
-    map_text = "🗺️ **Карта битвы**\n\n"
+    await callback.answer("🎬 Битва начинается!")
+    await start_royal_battle(battle_id)
 
-    for y in range(map_size):
-        for x in range(map_size):
-            if x == player_x and y == player_y:
-                map_text += "👤"  # Игрок
-            elif abs(x - player_x) <= 1 and abs(y - player_y) <= 1:
-                map_text += "🌳"  # Ближайшие клетки
-            else:
-                map_text += "⬜"  # Пустая клетка
-        map_text += "\n"
+# Перемещение по карте
+@callbacks.route(f"royal_move_{{battle_id:int}}_{{direction:{'|'.join(RoyalBattleEngine.MOVES)}}}")
+async def royal_move(callback: CallbackQuery, battle_id: int, direction: str):
+    found = await get_royal_fighter(callback, battle_id)
+    if not found:
+        return
+    match, fighter = found
 
-    map_text += f"\n❤️ Здоровье: {health}\n🎯 Позиция: ({player_x}, {player_y})"
+    if not match.move(fighter, *RoyalBattleEngine.MOVES[direction]):
+        await callback.answer("🚧 Дальше края карты не пройти!")
+        return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="⬆️", callback_data=f"royal_move_{battle_id}_up"),
-            InlineKeyboardButton(text="⬇️", callback_data=f"royal_move_{battle_id}_down")
-        ],
-        [
-            InlineKeyboardButton(text="⬅️", callback_data=f"royal_move_{battle_id}_left"),
-            InlineKeyboardButton(text="➡️", callback_data=f"royal_move_{battle_id}_right")
-        ],
-        [InlineKeyboardButton(text="⚔️ Атаковать рядом", callback_data=f"royal_attack_{battle_id}")],
-        [InlineKeyboardButton(text="🔄 Обновить карту", callback_data=f"royal_refresh_{battle_id}")]
-    ])
+    map_text, keyboard = render_royal_battle_map(match, fighter)
+    await editor.edit(callback.message, map_text, reply_markup=keyboard)
 
-    try:
-        await bot.send_message(user_id, map_text, reply_markup=keyboard)
-    except Exception as e:
-        print(f"Ошибка отправки карты: {e}")
+# Атака ближайшего соперника
+@callbacks.route('royal_attack_{battle_id:int}')
+async def royal_attack(callback: CallbackQuery, battle_id: int):
+    found = await get_royal_fighter(callback, battle_id)
+    if not found:
+        return
+    match, fighter = found
+
+    if fighter.ready_tick > match.tick:
+        await callback.answer("⏳ Оружие еще не готово, подожди пару секунд!")
+        return
+
+    result = royal_engine.attack(match, fighter)
+    if result is None:
+        await callback.answer("🌳 Рядом никого нет! Подойди к сопернику вплотную.", show_alert=True)
+        return
+
+    target, damage = result
+    if target.place is not None:
+        await callback.answer(f"💀 Ты победил {target.name}!")
+    else:
+        await callback.answer(f"⚔️ {target.name}: -{damage} ❤️ (осталось {target.health})")
+
+    # После последнего убийства матч уже завершен, итоги придут отдельным сообщением
+    if royal_engine.get(battle_id):
+        map_text, keyboard = render_royal_battle_map(match, fighter)
+        await editor.edit(callback.message, map_text, reply_markup=keyboard)
+
+async def save_royal_results(match: RoyalMatch):
+    """Сохраняет итоги матча одной транзакцией и раздает награды за призовые места"""
+    fighters = sorted(match.fighters.values(), key=lambda fighter: fighter.place)
+
+    def save(cursor):
+        cursor.executemany('''
+            UPDATE royal_battle_players
+            SET health = ?, position_x = ?, position_y = ?, kills = ?, is_alive = ?
+            WHERE battle_id = ? AND user_id = ?
+        ''', [
+            (fighter.health, fighter.x, fighter.y, fighter.kills, fighter.place == 1, match.id, fighter.user_id)
+            for fighter in fighters
+        ])
+        cursor.execute('UPDATE royal_battles SET is_active = FALSE WHERE id = ?', (match.id,))
+
+    await db.run(save)
+
+    standings = "\n".join(
+        f"{fighter.place}. {fighter.name} — 💀 {fighter.kills}" for fighter in fighters
+    )
+    for fighter in fighters:
+        reward = FinalConfig.ROYAL_BATTLE_REWARDS.get(fighter.place)
+        result_text = f"🏁 **Королевская битва окончена!**\n\n{standings}\n\n🎯 Твое место: {fighter.place}"
+        if reward:
+            await db.apply_deltas(fighter.user_id, {'gold': reward['gold'], 'sapphires': reward['sapphires']})
+            result_text += f"\n{reward['title']}\n💰 +{reward['gold']} золота\n💎 +{reward['sapphires']} сапфиров"
+        if fighter.place == 1:
+            await AchievementSystem.check_achievements(fighter.user_id, 'royal_wins', 1)
+
+        await outbox.send(fighter.user_id, result_text, parse_mode='Markdown')
 
 # ==============================
 # ТЁМНАЯ ОХОТА
 # ==============================
 
 @router.message(Command('hunt_dark'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'тёмная охота')
-async def cmd_dark_hunt(message: Message):
-    user_id = message.from_user.id
-    player = db.get_player(user_id)
-
+@text_command('hunt_dark')
+async def cmd_dark_hunt(message: Message, player: Optional[Dict]):
     if not player:
         await message.answer("❌ Сначала создай персонажа!", show_alert=True)
         return
@@ -3225,9 +5384,8 @@ async def cmd_dark_hunt(message: Message):
     await message.answer(hunt_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Начало тёмной охоты
-@router.callback_query(lambda c: c.data.startswith('dark_hunt_'))
-async def start_dark_hunt(callback: CallbackQuery):
-    difficulty = callback.data.replace('dark_hunt_', '')
+@callbacks.route('dark_hunt_{difficulty:easy|medium|hard|expert}')
+async def start_dark_hunt(callback: CallbackQuery, difficulty: str):
     user_id = callback.from_user.id
 
     # Настройки сложности
@@ -3241,15 +5399,11 @@ async def start_dark_hunt(callback: CallbackQuery):
     settings = difficulty_settings.get(difficulty, difficulty_settings['medium'])
 
     # Создаем сессию охоты
-    cursor = db.conn.cursor()
-    cursor.execute('''
+    session_id = await db.execute('''
         INSERT INTO dark_hunt_sessions (user_id, difficulty, hunter_count, time_remaining)
         VALUES (?, ?, ?, ?)
     ''', (user_id, difficulty, settings['hunters'], settings['time']))
 
-    session_id = cursor.lastrowid
-    db.conn.commit()
-
     hunt_text = (
         f"🌑 **Тёмная охота началась!**\n\n"
         f"🎯 Сложность: {difficulty.upper()}\n"
@@ -3266,35 +5420,31 @@ async def start_dark_hunt(callback: CallbackQuery):
         [InlineKeyboardButton(text="🚪 Сбежать", callback_data="dark_hunt_cancel")]
     ])
 
-    await callback.message.edit_text(hunt_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, hunt_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # ==============================
 # СИСТЕМА УЛУЧШЕНИЙ ПЕРСОНАЖА
 # ==============================
 
 @router.message(Command('upgrade'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'улучшить')
-async def cmd_upgrade(message: Message):
-    user_id = message.from_user.id
-    player = db.get_player(user_id)
-
+@text_command('upgrade')
+async def cmd_upgrade(message: Message, player: Optional[Dict]):
     if not player:
         await message.answer("❌ Сначала создай персонажа!", show_alert=True)
         return
 
+    user_id = player['user_id']
+
     # Получаем или создаем запись улучшений
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM character_upgrades WHERE user_id = ?', (user_id,))
-    upgrades = cursor.fetchone()
+    upgrades = await db.fetchone('SELECT * FROM character_upgrades WHERE user_id = ?', (user_id,))
 
     if not upgrades:
         # Даем начальные очки за уровень
         available_points = max(0, player['level'] - 1) * 2
-        cursor.execute('''
+        await db.execute('''
             INSERT INTO character_upgrades (user_id, available_points)
             VALUES (?, ?)
         ''', (user_id, available_points))
-        db.conn.commit()
         upgrades = (user_id, 0, 0, 0, 0, available_points)
 
     user_id, strength, intellect, agility, stamina, available_points = upgrades
@@ -3328,14 +5478,11 @@ async def cmd_upgrade(message: Message):
     await message.answer(upgrade_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Улучшение характеристики
-@router.callback_query(lambda c: c.data.startswith('upgrade_'))
-async def process_upgrade(callback: CallbackQuery):
-    upgrade_type = callback.data.replace('upgrade_', '')
+@callbacks.route('upgrade_{upgrade_type:strength|intellect|agility|stamina}')
+async def process_upgrade(callback: CallbackQuery, upgrade_type: str):
     user_id = callback.from_user.id
 
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT * FROM character_upgrades WHERE user_id = ?', (user_id,))
-    upgrades = cursor.fetchone()
+    upgrades = await db.fetchone('SELECT * FROM character_upgrades WHERE user_id = ?', (user_id,))
 
     if not upgrades or upgrades[5] <= 0:  # available_points
         await callback.answer("❌ Нет доступных очков улучшения!", show_alert=True)
@@ -3345,36 +5492,25 @@ async def process_upgrade(callback: CallbackQuery):
 
     # Обновляем характеристику
     if upgrade_type == 'strength':
-        cursor.execute('UPDATE character_upgrades SET strength = strength + 1, available_points = available_points - 1 WHERE user_id = ?', (user_id,))
+        await db.execute('UPDATE character_upgrades SET strength = strength + 1, available_points = available_points - 1 WHERE user_id = ?', (user_id,))
         # Обновляем урон игрока
-        player = db.get_player(user_id)
-        db.update_player_stats(user_id, {'damage': player['damage'] + 2})
+        await db.apply_deltas(user_id, {'damage': 2})
 
     elif upgrade_type == 'intellect':
-        cursor.execute('UPDATE character_upgrades SET intellect = intellect + 1, available_points = available_points - 1 WHERE user_id = ?', (user_id,))
+        await db.execute('UPDATE character_upgrades SET intellect = intellect + 1, available_points = available_points - 1 WHERE user_id = ?', (user_id,))
         # Обновляем ману игрока
-        player = db.get_player(user_id)
-        db.update_player_stats(user_id, {
-            'max_mana': player['max_mana'] + 10,
-            'mana': min(player['mana'] + 10, player['max_mana'] + 10)
-        })
+        await db.apply_deltas(user_id, {'max_mana': 10, 'mana': 10})
 
     elif upgrade_type == 'agility':
-        cursor.execute('UPDATE character_upgrades SET agility = agility + 1, available_points = available_points - 1 WHERE user_id = ?', (user_id,))
+        await db.execute('UPDATE character_upgrades SET agility = agility + 1, available_points = available_points - 1 WHERE user_id = ?', (user_id,))
 
     elif upgrade_type == 'stamina':
-        cursor.execute('UPDATE character_upgrades SET stamina = stamina + 1, available_points = available_points - 1 WHERE user_id = ?', (user_id,))
+        await db.execute('UPDATE character_upgrades SET stamina = stamina + 1, available_points = available_points - 1 WHERE user_id = ?', (user_id,))
         # Обновляем здоровье игрока
-        player = db.get_player(user_id)
-        db.update_player_stats(user_id, {
-            'max_health': player['max_health'] + 15,
-            'health': min(player['health'] + 15, player['max_health'] + 15)
-        })
-
-    db.conn.commit()
+        await db.apply_deltas(user_id, {'max_health': 15, 'health': 15})
 
     await callback.answer(f"✅ {upgrade_type.capitalize()} улучшена!", show_alert=True)
-    await cmd_upgrade(callback.message)
+    await cmd_upgrade(callback.message, await db.get_player(user_id))
 
 # ==============================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
@@ -3387,13 +5523,10 @@ def generate_battle_code() -> str:
     return ''.join(random.choice(characters) for _ in range(6))
 
 # Обновление королевской битвы
-@router.callback_query(lambda c: c.data.startswith('royal_refresh_'))
-async def royal_refresh(callback: CallbackQuery):
-    battle_id = int(callback.data.split('_')[2])
+@callbacks.route('royal_refresh_{battle_id:int}')
+async def royal_refresh(callback: CallbackQuery, battle_id: int):
 
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT battle_code, current_players, max_players, is_started FROM royal_battles WHERE id = ?', (battle_id,))
-    battle_data = cursor.fetchone()
+    battle_data = await db.fetchone('SELECT battle_code, current_players, max_players, is_started FROM royal_battles WHERE id = ?', (battle_id,))
 
     if not battle_data:
         await callback.answer("❌ Битва не найдена!", show_alert=True)
@@ -3402,44 +5535,65 @@ async def royal_refresh(callback: CallbackQuery):
     battle_code, current_players, max_players, is_started = battle_data
 
     if is_started:
-        await callback.answer("🎬 Битва уже началась!", show_alert=True)
+        match = royal_engine.get(battle_id)
+        fighter = match.fighters.get(callback.from_user.id) if match else None
+        if not fighter:
+            await callback.answer("🎬 Битва уже началась!" if match else "🏁 Битва уже закончилась!", show_alert=True)
+            return
+        map_text, keyboard = render_royal_battle_map(match, fighter)
+        await editor.edit(callback.message, map_text, reply_markup=keyboard)
         return
 
     battle_text = f"🎮 **Королевская битва #{battle_code}**\n\n👥 Игроков: {current_players}/{max_players}\n\n"
 
-    cursor.execute('''
+    players = await db.fetchall('''
         SELECT p.character_name
         FROM royal_battle_players rbp
         JOIN players p ON rbp.user_id = p.user_id
         WHERE rbp.battle_id = ?
     ''', (battle_id,))
-
-    players = cursor.fetchall()
     for i, (name,) in enumerate(players, 1):
         battle_text += f"{i}. {name}\n"
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data=f"royal_refresh_{battle_id}")],
-        [InlineKeyboardButton(text="🚪 Покинуть", callback_data=f"royal_leave_{battle_id}")]
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=royal_refresh.pack(battle_id))],
+        [InlineKeyboardButton(text="🚪 Покинуть", callback_data=royal_leave.pack(battle_id))]
     ])
 
     if current_players >= 3:
-        keyboard.inline_keyboard.append([InlineKeyboardButton(text="🎬 Начать битву", callback_data=f"royal_start_{battle_id}")])
+        keyboard.inline_keyboard.append([InlineKeyboardButton(text="🎬 Начать битву", callback_data=royal_start.pack(battle_id))])
 
-    await callback.message.edit_text(battle_text, reply_markup=keyboard, parse_mode='Markdown')
+    await editor.edit(callback.message, battle_text, reply_markup=keyboard, parse_mode='Markdown')
 
 # Выход из королевской битвы
-@router.callback_query(lambda c: c.data.startswith('royal_leave_'))
-async def royal_leave(callback: CallbackQuery):
-    battle_id = int(callback.data.split('_')[2])
+@callbacks.route('royal_leave_{battle_id:int}')
+async def royal_leave(callback: CallbackQuery, battle_id: int):
     user_id = callback.from_user.id
 
-    cursor = db.conn.cursor()
-    cursor.execute('DELETE FROM royal_battle_players WHERE battle_id = ? AND user_id = ?', (battle_id, user_id))
-    cursor.execute('UPDATE royal_battles SET current_players = current_players - 1 WHERE id = ?', (battle_id,))
-    db.conn.commit()
+    # Из идущей битвы выходят поражением: место и итоги сохранятся вместе с остальными
+    match = royal_engine.get(battle_id)
+    if match and user_id in match.fighters:
+        fighter = match.fighters[user_id]
+        if fighter.place is None:
+            royal_engine.leave(match, fighter)
+        await editor.edit(
+            callback.message,
+            f"🏳️ Ты сдался и занял {fighter.place} место.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="👑 Новая битва", callback_data="royal_quick_join")],
+                [InlineKeyboardButton(text="👤 В профиль", callback_data="back_to_profile")]
+            ])
+        )
+        return
+
+    def leave(cursor):
+        cursor.execute('DELETE FROM royal_battle_players WHERE battle_id = ? AND user_id = ?', (battle_id, user_id))
+        cursor.execute('UPDATE royal_battles SET current_players = current_players - 1 WHERE id = ?', (battle_id,))
+
+    await db.run(leave)
 
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         "🚪 Ты покинул королевскую битву.",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="👑 Новая битва", callback_data="royal_quick_join")],
@@ -3448,14 +5602,15 @@ async def royal_leave(callback: CallbackQuery):
     )
 
 # Обновление улучшений
-@router.callback_query(lambda c: c.data == 'upgrade_refresh')
-async def upgrade_refresh(callback: CallbackQuery):
-    await cmd_upgrade(callback.message)
+@callbacks.route('upgrade_refresh')
+async def upgrade_refresh(callback: CallbackQuery, player: Optional[Dict]):
+    await cmd_upgrade(callback.message, player)
 
 # Отмена тёмной охоты
-@router.callback_query(lambda c: c.data == 'dark_hunt_cancel')
+@callbacks.route('dark_hunt_cancel')
 async def dark_hunt_cancel(callback: CallbackQuery):
-    await callback.message.edit_text(
+    await editor.edit(
+        callback.message,
         "🌑 Ты сбежал из тёмной охоты...",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔄 Попробовать снова", callback_data="dark_hunt_back")],
@@ -3464,18 +5619,16 @@ async def dark_hunt_cancel(callback: CallbackQuery):
     )
 
 # Назад к тёмной охоте
-@router.callback_query(lambda c: c.data == 'dark_hunt_back')
-async def dark_hunt_back(callback: CallbackQuery):
-    await cmd_dark_hunt(callback.message)
+@callbacks.route('dark_hunt_back')
+async def dark_hunt_back(callback: CallbackQuery, player: Optional[Dict]):
+    await cmd_dark_hunt(callback.message, player)
 
     # ==============================
 # ЧАСТЬ 9: ЗАВЕРШАЮЩИЕ СИСТЕМЫ И ОПТИМИЗАЦИЯ
 # ==============================
 
 # Добавляем завершающие таблицы
-def create_final_tables():
-    cursor = db.conn.cursor()
-
+def create_final_tables(cursor):
     # Таблица достижений
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS achievements (
@@ -3501,16 +5654,6 @@ def create_final_tables():
         )
     ''')
 
-    # Таблица энергетической системы
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS energy_system (
-            user_id INTEGER PRIMARY KEY,
-            last_energy_check DATETIME DEFAULT CURRENT_TIMESTAMP,
-            energy_accumulated INTEGER DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES players (user_id)
-        )
-    ''')
-
     # Таблица глобальных настроек
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS global_settings (
@@ -3521,11 +5664,6 @@ def create_final_tables():
         )
     ''')
 
-    # Инициализируем настройки
-    initialize_global_settings(cursor)
-
-    db.conn.commit()
-
 def initialize_global_settings(cursor):
     settings = [
         ('game_version', '1.0.0', 'Версия игры'),
@@ -3541,56 +5679,194 @@ def initialize_global_settings(cursor):
             VALUES (?, ?, ?)
         ''', (key, value, description))
 
-# Вызываем создание таблиц
-create_final_tables()
-
 # ==============================
-# СИСТЕМА ЭНЕРГИИ И ВОССТАНОВЛЕНИЯ
+# МИГРАЦИИ СХЕМЫ
 # ==============================
 
-async def update_energy_system():
-    """Обновляет энергию всех игроков (вызывается периодически)"""
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT user_id, last_energy_check, energy_accumulated FROM energy_system')
-    energy_data = cursor.fetchall()
-
-    for user_id, last_check_str, accumulated in energy_data:
-        if not last_check_str:
-            continue
-
-        last_check = datetime.fromisoformat(last_check_str)
-        now = datetime.now()
-        minutes_passed = int((now - last_check).total_seconds() / 60)
+def migration_initial_schema(cursor):
+    """Версия 1: все таблицы игры"""
+    Database.create_tables(cursor)
+    create_pvp_tables(cursor)
+    create_clan_and_mine_tables(cursor)
+    create_shop_and_case_tables(cursor)
+    create_boss_and_events_tables(cursor)
+    create_game_modes_tables(cursor)
+    create_final_tables(cursor)
+
+def migration_hot_indexes(cursor):
+    """Версия 2: индексы под горячие запросы"""
+    indexes = [
+        'CREATE INDEX IF NOT EXISTS idx_inventory_user_item ON inventory (user_id, item_name)',
+        'CREATE INDEX IF NOT EXISTS idx_pvp_ratings_rating ON pvp_ratings (rating)',
+        'CREATE INDEX IF NOT EXISTS idx_boss_battles_user_boss_time ON boss_battles (user_id, boss_id, battled_at)',
+        'CREATE INDEX IF NOT EXISTS idx_player_mines_storage ON player_mines (storage)',
+        'CREATE INDEX IF NOT EXISTS idx_players_created_at ON players (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_achievements_user_achievement ON achievements (user_id, achievement_id)',
+        'CREATE INDEX IF NOT EXISTS idx_clan_members_clan ON clan_members (clan_id)',
+    ]
+    for statement in indexes:
+        cursor.execute(statement)
+
+def migration_lazy_energy(cursor):
+    """Версия 3: энергия считается при чтении, таблица energy_system больше не нужна"""
+    cursor.execute('ALTER TABLE players ADD COLUMN energy_ts INTEGER DEFAULT 0')
+    cursor.execute("UPDATE players SET energy_ts = CAST(strftime('%s', 'now') AS INTEGER)")
+    cursor.execute('DROP TABLE IF EXISTS energy_system')
+
+def migration_memory_pvp_battles(cursor):
+    """Версия 4: PvP бои хранятся в памяти, в базе остаются только рейтинги"""
+    cursor.execute('DROP TABLE IF EXISTS pvp_battles')
+
+def migration_boss_battle_day(cursor):
+    """Версия 5: день боя с боссом хранится отдельно, один бой на игрока в день закреплен уникальным индексом"""
+    cursor.execute('ALTER TABLE boss_battles ADD COLUMN battle_day TEXT')
+    cursor.execute('UPDATE boss_battles SET battle_day = DATE(battled_at)')
+    # Повторные бои, которые успели проскочить из-за гонки, уникальный индекс не пропустит
+    cursor.execute('''
+        DELETE FROM boss_battles
+        WHERE id NOT IN (SELECT MIN(id) FROM boss_battles GROUP BY boss_id, battle_day, user_id)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_boss_battles_day_user
+        ON boss_battles (boss_id, battle_day, user_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_boss_battles_day_damage
+        ON boss_battles (boss_id, battle_day, damage_dealt DESC)
+    ''')
 
-        if minutes_passed > 0:
-            # Восстанавливаем энергию
-            energy_gained = min(minutes_passed, GameConfig.ENERGY_MAX - accumulated)
-            new_accumulated = accumulated + energy_gained
+def migration_catalog_keys(cursor):
+    """Версия 6: товары и кейсы уникальны по имени, справочники обновляются на месте без смены id"""
+    for table, column in (('shop_items', 'item_name'), ('cases', 'name')):
+        cursor.execute(f'DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY {column})')
+        cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})')
 
-            # Обновляем энергию в системе
-            cursor.execute('''
-                UPDATE energy_system
-                SET energy_accumulated = ?, last_energy_check = ?
-                WHERE user_id = ?
-            ''', (new_accumulated, now.isoformat(), user_id))
+def migration_item_catalog(cursor):
+    """Версия 7: справочник items с числовыми id, инвентарь хранит (user_id, item_id, quantity)"""
+    cursor.execute('''
+        CREATE TABLE items (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            item_type TEXT,
+            rarity TEXT,
+            stats TEXT NOT NULL DEFAULT '{}', -- JSON с характеристиками: урон, защита и т.д.
+            UNIQUE (name, stats)
+        )
+    ''')
+    # Старые строки инвентаря характеристик не хранили
+    cursor.execute('''
+        INSERT OR IGNORE INTO items (name, item_type, rarity)
+        SELECT item_name, item_type, rarity FROM inventory ORDER BY id
+    ''')
+    cursor.execute('''
+        CREATE TABLE inventory_new (
+            user_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, item_id),
+            FOREIGN KEY (user_id) REFERENCES players (user_id),
+            FOREIGN KEY (item_id) REFERENCES items (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT INTO inventory_new (user_id, item_id, quantity)
+        SELECT inv.user_id, i.id, SUM(inv.quantity)
+        FROM inventory inv
+        JOIN items i ON i.name = inv.item_name AND i.stats = '{}'
+        GROUP BY inv.user_id, i.id
+    ''')
+    cursor.execute('DROP TABLE inventory')
+    cursor.execute('ALTER TABLE inventory_new RENAME TO inventory')
 
-            # Обновляем энергию игрока если нужно
-            if energy_gained > 0:
-                player = db.get_player(user_id)
-                if player:
-                    new_energy = min(player['energy'] + energy_gained, GameConfig.ENERGY_MAX)
-                    db.update_player_stats(user_id, {'energy': new_energy})
+def migration_mine_epoch(cursor):
+    """Версия 8: время последнего сбора в шахте хранится как epoch, баланс считается в замкнутом виде"""
+    cursor.execute('ALTER TABLE player_mines ADD COLUMN collected_ts INTEGER')
+    cursor.execute('''
+        UPDATE player_mines
+        SET collected_ts = COALESCE(CAST(strftime('%s', last_collected) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))
+    ''')
+    # Хранимый storage больше не отражает богатство шахты, индекс по нему бесполезен
+    cursor.execute('DROP INDEX IF EXISTS idx_player_mines_storage')
+
+def migration_mine_attack_cooldowns(cursor):
+    """Версия 9: кулдауны набегов при запуске читаются по свежим атакам, а не по всей истории"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mine_attacks_created ON mine_attacks (created_at)')
+
+def migration_boss_stable_ids(cursor):
+    """Версия 10: id босса равен дню его появления и не меняется при перезапуске"""
+    # Раньше боссы пересоздавались при каждом запуске, но всегда всемером по порядку дней,
+    # поэтому и по id уже удаленного босса его день восстанавливается однозначно.
+    # Ссылки сначала переводятся в отрицательные id, чтобы не столкнуться со строками 1-7.
+    cursor.execute('DELETE FROM boss_current_status WHERE boss_id NOT IN (SELECT id FROM daily_bosses)')
+    for table in ('boss_current_status', 'boss_battles'):
+        cursor.execute(f'''
+            UPDATE OR IGNORE {table} SET boss_id = -COALESCE(
+                (SELECT spawn_day FROM daily_bosses WHERE daily_bosses.id = {table}.boss_id),
+                ({table}.boss_id - 1) % 7 + 1
+            )
+        ''')
+        # Не перенеслись только повторы: бой того же игрока с тем же боссом в тот же день
+        cursor.execute(f'DELETE FROM {table} WHERE boss_id > 0')
+        cursor.execute(f'UPDATE {table} SET boss_id = -boss_id')
+    cursor.execute('UPDATE OR IGNORE daily_bosses SET id = -spawn_day')
+    cursor.execute('DELETE FROM daily_bosses WHERE id > 0')
+    cursor.execute('UPDATE daily_bosses SET id = -id')
+
+# Порядок важен: номер версии = позиция в списке, новые миграции только дописываются в конец
+MIGRATIONS = [
+    migration_initial_schema,
+    migration_hot_indexes,
+    migration_lazy_energy,
+    migration_memory_pvp_battles,
+    migration_boss_battle_day,
+    migration_catalog_keys,
+    migration_item_catalog,
+    migration_mine_epoch,
+    migration_mine_attack_cooldowns,
+    migration_boss_stable_ids,
+]
+
+def seed_game_data(cursor):
+    """Справочные данные: магазин, кейсы, предметы, боссы и глобальные настройки"""
+    initialize_shop_data(cursor)
+    initialize_cases_data(cursor)
+    initialize_items_data(cursor)
+    initialize_bosses_data(cursor)
+    initialize_global_settings(cursor)
 
-    db.conn.commit()
+# Горячие запросы и индексы, по которым они обязаны идти
+HOT_QUERY_PLANS = [
+    ('SELECT item_id, quantity FROM inventory WHERE user_id = ?', 'PRIMARY KEY (user_id=?)'),
+    ('SELECT user_id FROM boss_battles WHERE boss_id = ? AND battle_day = ?', 'idx_boss_battles_day_user'),
+    ('SELECT user_id, damage_dealt FROM boss_battles WHERE boss_id = ? AND battle_day = ? ORDER BY damage_dealt DESC',
+     'idx_boss_battles_day_damage'),
+    ('SELECT COUNT(DISTINCT boss_id) FROM boss_battles WHERE user_id = ?', 'idx_boss_battles_user_boss_time'),
+    ("SELECT COUNT(*) FROM players WHERE created_at >= DATE('now')", 'idx_players_created_at'),
+    ('SELECT 1 FROM achievements WHERE user_id = ? AND achievement_id = ?', 'idx_achievements_user_achievement'),
+]
+
+async def verify_query_plans() -> bool:
+    """Проверяет через EXPLAIN QUERY PLAN, что горячие запросы используют свои индексы"""
+    all_indexed = True
+    for query, index in HOT_QUERY_PLANS:
+        plan = await db.fetchall(f'EXPLAIN QUERY PLAN {query}', (None,) * query.count('?'))
+        details = ' | '.join(row[3] for row in plan)
+        if index not in details:
+            all_indexed = False
+            logging.warning(f"Запрос не использует {index}: {query} -> {details}")
+    return all_indexed
+
+async def initialize_storage():
+    """Доводит схему до актуальной версии и заполняет справочники"""
+    await db.migrate(MIGRATIONS)
+    await db.run(seed_game_data)
+    if await verify_query_plans():
+        print("✅ Индексы горячих запросов на месте")
+    await load_pvp_leaderboard()
+    await shop_catalog.reload()
+    await item_registry.load()
+    await mine_economy.load()
 
-def initialize_player_energy(user_id: int):
-    """Инициализирует систему энергии для нового игрока"""
-    cursor = db.conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO energy_system (user_id, energy_accumulated)
-        VALUES (?, ?)
-    ''', (user_id, GameConfig.ENERGY_MAX))
-    db.conn.commit()
 
 # ==============================
 # СИСТЕМА ДОСТИЖЕНИЙ
@@ -3649,42 +5925,37 @@ class AchievementSystem:
     }
 
     @classmethod
-    def check_achievements(cls, user_id: int, achievement_type: str, progress: int = 1):
+    async def check_achievements(cls, user_id: int, achievement_type: str, progress: int = 1):
         """Проверяет и выдает достижения"""
-        cursor = db.conn.cursor()
-
         if achievement_type == 'first_kill' and progress >= 1:
-            cls.grant_achievement(user_id, 'first_blood')
+            await cls.grant_achievement(user_id, 'first_blood')
 
         elif achievement_type == 'pvp_wins' and progress >= 10:
-            cls.grant_achievement(user_id, 'pvp_master')
+            await cls.grant_achievement(user_id, 'pvp_master')
 
         elif achievement_type == 'boss_kills' and progress >= 5:
-            cls.grant_achievement(user_id, 'boss_slayer')
+            await cls.grant_achievement(user_id, 'boss_slayer')
 
         elif achievement_type == 'mine_level' and progress >= 5:
-            cls.grant_achievement(user_id, 'mine_tycoon')
+            await cls.grant_achievement(user_id, 'mine_tycoon')
 
         elif achievement_type == 'clan_created' and progress >= 1:
-            cls.grant_achievement(user_id, 'clan_leader')
+            await cls.grant_achievement(user_id, 'clan_leader')
 
         elif achievement_type == 'gold_accumulated' and progress >= 100000:
-            cls.grant_achievement(user_id, 'rich_player')
+            await cls.grant_achievement(user_id, 'rich_player')
 
         elif achievement_type == 'player_level' and progress >= 50:
-            cls.grant_achievement(user_id, 'level_50')
+            await cls.grant_achievement(user_id, 'level_50')
 
         elif achievement_type == 'royal_wins' and progress >= 1:
-            cls.grant_achievement(user_id, 'royal_champion')
+            await cls.grant_achievement(user_id, 'royal_champion')
 
     @classmethod
-    def grant_achievement(cls, user_id: int, achievement_id: str):
+    async def grant_achievement(cls, user_id: int, achievement_id: str):
         """Выдает достижение игроку"""
-        cursor = db.conn.cursor()
-
         # Проверяем не получено ли уже достижение
-        cursor.execute('SELECT 1 FROM achievements WHERE user_id = ? AND achievement_id = ?', (user_id, achievement_id))
-        if cursor.fetchone():
+        if await db.fetchone('SELECT 1 FROM achievements WHERE user_id = ? AND achievement_id = ?', (user_id, achievement_id)):
             return
 
         achievement = cls.ACHIEVEMENTS.get(achievement_id)
@@ -3692,46 +5963,38 @@ class AchievementSystem:
             return
 
         # Добавляем достижение
-        cursor.execute('''
+        await db.execute('''
             INSERT INTO achievements (user_id, achievement_id, achievement_name, achievement_description)
             VALUES (?, ?, ?, ?)
         ''', (user_id, achievement_id, achievement['name'], achievement['description']))
 
-        db.conn.commit()
-
         # Уведомляем игрока
         asyncio.create_task(notify_achievement(user_id, achievement))
 
 async def notify_achievement(user_id: int, achievement: Dict):
     """Уведомляет игрока о новом достижении"""
-    try:
-        await bot.send_message(
-            user_id,
-            f"🎉 **Новое достижение!**\n\n"
-            f"🏆 {achievement['name']}\n"
-            f"📝 {achievement['description']}\n\n"
-            f"Награда: {achievement.get('reward_gold', 0)}💰 + {achievement.get('reward_sapphires', 0)}💎\n\n"
-            f"Напиши 'достижения' чтобы посмотреть все свои достижения!",
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        print(f"Не удалось уведомить о достижении: {e}")
+    await outbox.send(
+        user_id,
+        f"🎉 **Новое достижение!**\n\n"
+        f"🏆 {achievement['name']}\n"
+        f"📝 {achievement['description']}\n\n"
+        f"Награда: {achievement.get('reward_gold', 0)}💰 + {achievement.get('reward_sapphires', 0)}💎\n\n"
+        f"Напиши 'достижения' чтобы посмотреть все свои достижения!",
+        parse_mode='Markdown'
+    )
 
 @router.message(Command('achievements'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'достижения')
+@text_command('achievements')
 async def cmd_achievements(message: Message):
     user_id = message.from_user.id
 
-    cursor = db.conn.cursor()
-    cursor.execute('''
+    achievements = await db.fetchall('''
         SELECT achievement_name, achievement_description, achieved_at, reward_claimed
         FROM achievements
         WHERE user_id = ?
         ORDER BY achieved_at DESC
     ''', (user_id,))
 
-    achievements = cursor.fetchall()
-
     if not achievements:
         await message.answer(
             "🏆 **Достижения**\n\n"
@@ -3767,18 +6030,15 @@ async def cmd_achievements(message: Message):
 # ==============================
 
 @router.message(Command('daily'))
-@router.message(lambda message: NaturalLanguageProcessor.process_text(message.text) == 'ежедневная награда')
-async def cmd_daily(message: Message):
+@text_command('daily')
+async def cmd_daily(message: Message, player: Optional[Dict]):
     user_id = message.from_user.id
-    player = db.get_player(user_id)
 
     if not player:
         await message.answer("❌ Сначала создай персонажа!", show_alert=True)
         return
 
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT last_reward_date, streak_count FROM daily_rewards WHERE user_id = ?', (user_id,))
-    daily_data = cursor.fetchone()
+    daily_data = await db.fetchone('SELECT last_reward_date, streak_count FROM daily_rewards WHERE user_id = ?', (user_id,))
 
     today = datetime.now().date()
 
@@ -3824,28 +6084,21 @@ async def claim_daily_reward(message: Message, user_id: int, streak: int, reset_
     total_sapphires = base_sapphires + sapphire_bonus
 
     # Выдаем награду
-    player = db.get_player(user_id)
-    db.update_player_stats(user_id, {
-        'gold': player['gold'] + total_gold,
-        'sapphires': player['sapphires'] + total_sapphires
-    })
+    await db.apply_deltas(user_id, {'gold': total_gold, 'sapphires': total_sapphires})
 
     # Обновляем запись
-    cursor = db.conn.cursor()
     if reset_streak:
-        cursor.execute('''
+        await db.execute('''
             INSERT OR REPLACE INTO daily_rewards (user_id, last_reward_date, streak_count, total_rewards)
             VALUES (?, DATE('now'), ?, COALESCE((SELECT total_rewards FROM daily_rewards WHERE user_id = ?), 0) + 1)
         ''', (user_id, streak, user_id))
     else:
-        cursor.execute('''
+        await db.execute('''
             UPDATE daily_rewards
             SET last_reward_date = DATE('now'), streak_count = ?, total_rewards = total_rewards + 1
             WHERE user_id = ?
         ''', (streak, user_id))
 
-    db.conn.commit()
-
     reward_text = (
         f"🎁 **Ежедневная награда получена!**\n\n"
         f"💰 Золото: +{total_gold}\n"
@@ -3886,33 +6139,19 @@ class GameUtils:
         }
 
     @staticmethod
-    def apply_global_multipliers(base_value: int, value_type: str) -> int:
+    async def apply_global_multipliers(base_value: int, value_type: str) -> int:
         """Применяет глобальные множители"""
-        cursor = db.conn.cursor()
-
         if value_type == 'gold':
-            cursor.execute('SELECT value FROM global_settings WHERE key = ?', ('gold_drop_multiplier',))
+            key = 'gold_drop_multiplier'
         elif value_type == 'exp':
-            cursor.execute('SELECT value FROM global_settings WHERE key = ?', ('exp_multiplier',))
+            key = 'exp_multiplier'
         else:
             return base_value
 
-        result = cursor.fetchone()
-        multiplier = float(result[0]) if result else 1.0
+        multiplier = float(await db.fetchval('SELECT value FROM global_settings WHERE key = ?', (key,), 1.0))
 
         return int(base_value * multiplier)
 
-# Автоматическое обновление энергии
-async def energy_update_task():
-    """Фоновая задача для обновления энергии"""
-    while True:
-        try:
-            await update_energy_system()
-            await asyncio.sleep(60)  # Обновляем каждую минуту
-        except Exception as e:
-            print(f"Ошибка в задаче обновления энергии: {e}")
-            await asyncio.sleep(60)
-
 # Автоматический сброс боссов
 async def boss_reset_task():
     """Фоновая задача для сброса боссов"""
@@ -3928,10 +6167,12 @@ async def reset_daily_bosses():
     """Сбрасывает боссов в полночь"""
     now = datetime.now()
     if now.hour == 0 and now.minute == 0:
-        cursor = db.conn.cursor()
-        cursor.execute('DELETE FROM boss_current_status')
-        cursor.execute('UPDATE boss_battles SET reward_received = TRUE')
-        db.conn.commit()
+        def reset(cursor):
+            cursor.execute('DELETE FROM boss_current_status')
+            cursor.execute('UPDATE boss_battles SET reward_received = TRUE')
+
+        await db.run(reset)
+        boss_health.reset()
         print("✅ Боссы сброшены!")
 
 # ==============================
@@ -3941,24 +6182,15 @@ async def reset_daily_bosses():
 @router.message(Command('status'))
 async def cmd_status(message: Message):
     """Показывает статус игры и онлайн статистику"""
-    cursor = db.conn.cursor()
-
     # Статистика сервера
-    cursor.execute('SELECT COUNT(*) FROM players')
-    total_players = cursor.fetchone()[0]
-
-    cursor.execute('SELECT COUNT(*) FROM players WHERE DATE(created_at) = DATE("now")')
-    new_today = cursor.fetchone()[0]
-
-    cursor.execute('SELECT COUNT(*) FROM clans')
-    total_clans = cursor.fetchone()[0]
-
-    cursor.execute('SELECT COUNT(*) FROM royal_battles WHERE is_active = TRUE')
-    active_battles = cursor.fetchone()[0]
+    total_players = await db.fetchval('SELECT COUNT(*) FROM players', readonly=True)
+    new_today = await db.fetchval("SELECT COUNT(*) FROM players WHERE created_at >= DATE('now')", readonly=True)
+    total_clans = await db.fetchval('SELECT COUNT(*) FROM clans', readonly=True)
+    active_battles = await db.fetchval('SELECT COUNT(*) FROM royal_battles WHERE is_active = TRUE', readonly=True)
 
     # Глобальные настройки
-    cursor.execute('SELECT key, value FROM global_settings WHERE key IN ("game_version", "maintenance_mode")')
-    settings = {key: value for key, value in cursor.fetchall()}
+    settings = {key: value for key, value in await db.fetchall(
+        'SELECT key, value FROM global_settings WHERE key IN ("game_version", "maintenance_mode")', readonly=True)}
 
     status_text = (
         f"🎮 **Статус Magic RPG**\n\n"
@@ -3979,16 +6211,15 @@ async def cmd_status(message: Message):
 # ОБНОВЛЕНИЕ БАЗОВЫХ ФУНКЦИЙ
 # ==============================
 
-# Обновляем функцию создания игрока для инициализации энергии
+# Обновляем функцию создания игрока для проверки достижений
 def update_create_player():
     """Обновленная функция создания игрока"""
     original_create_player = db.create_player
 
-    def new_create_player(user_id: int, username: str, character_name: str, character_class: str):
-        original_create_player(user_id, username, character_name, character_class)
-        initialize_player_energy(user_id)
+    async def new_create_player(user_id: int, username: str, character_name: str, character_class: str):
+        await original_create_player(user_id, username, character_name, character_class)
         # Проверяем достижение за создание персонажа
-        AchievementSystem.check_achievements(user_id, 'player_level', 1)
+        await AchievementSystem.check_achievements(user_id, 'player_level', 1)
 
     db.create_player = new_create_player
 
@@ -3999,8 +6230,8 @@ async def update_hunt_victory(callback: CallbackQuery, state: FSMContext, player
     # ... существующий код победы ...
 
     # Проверяем достижения
-    AchievementSystem.check_achievements(player['user_id'], 'first_kill', 1)
-    AchievementSystem.check_achievements(player['user_id'], 'player_level', player['level'])
+    await AchievementSystem.check_achievements(player['user_id'], 'first_kill', 1)
+    await AchievementSystem.check_achievements(player['user_id'], 'player_level', player['level'])
 
 # Инициализируем обновления
 update_create_player()
@@ -4008,7 +6239,6 @@ update_create_player()
 # Запускаем фоновые задачи при старте
 async def on_startup():
     """Запускается при старте бота"""
-    asyncio.create_task(energy_update_task())
     asyncio.create_task(boss_reset_task())
     print("✅ Фоновые задачи запущены!")
 
@@ -4058,7 +6288,6 @@ async def cmd_guide(message: Message):
 # ==============================
 
 # Добавляем недостающие импорты в начало файла
-import time
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
@@ -4101,14 +6330,6 @@ async def schedule_background_tasks():
         id='daily_reset'
     )
 
-    # Проверка энергии каждую минуту
-    scheduler.add_job(
-        update_energy_system,
-        'interval',
-        minutes=1,
-        id='energy_update'
-    )
-
     # Резервное копирование базы данных каждые 24 часа
     scheduler.add_job(
         backup_database,
@@ -4130,55 +6351,57 @@ async def schedule_background_tasks():
 
 async def reset_daily_activities():
     """Сбрасывает ежедневные активности"""
-    cursor = db.conn.cursor()
-
-    # Сбрасываем боссов
-    cursor.execute('DELETE FROM boss_current_status')
-    cursor.execute('DELETE FROM boss_battles')
+    def reset(cursor):
+        # Сбрасываем боссов
+        cursor.execute('DELETE FROM boss_current_status')
+        cursor.execute('DELETE FROM boss_battles')
 
-    # Сбрасываем лимиты PvP
-    cursor.execute('UPDATE pvp_ratings SET last_pvp_date = NULL')
+        # Сбрасываем лимиты PvP
+        cursor.execute('UPDATE pvp_ratings SET last_pvp_date = NULL')
 
-    # Обновляем ежедневные награды для всех
-    cursor.execute('''
-        UPDATE daily_rewards
-        SET last_reward_date = NULL
-        WHERE last_reward_date < DATE('now', '-1 day')
-    ''')
+        # Обновляем ежедневные награды для всех
+        cursor.execute('''
+            UPDATE daily_rewards
+            SET last_reward_date = NULL
+            WHERE last_reward_date < DATE('now', '-1 day')
+        ''')
 
-    db.conn.commit()
+    await db.run(reset)
+    boss_health.reset()
     print("✅ Ежедневные активности сброшены!")
 
 async def backup_database():
     """Создает резервную копию базы данных"""
     try:
         backup_name = f"backup_{int(time.time())}.db"
-        import shutil
-        shutil.copy2('magic_rpg.db', f'backups/{backup_name}')
+        os.makedirs('backups', exist_ok=True)
+        # Несохраненные изменения игроков из кэша должны попасть в копию
+        await db.flush_players()
+        await db.backup(f'backups/{backup_name}')
         print(f"✅ Резервная копия создана: {backup_name}")
     except Exception as e:
         print(f"❌ Ошибка резервного копирования: {e}")
 
 async def check_events():
     """Проверяет и обновляет события"""
-    cursor = db.conn.cursor()
     now = datetime.now()
 
-    # Активируем новые события
-    cursor.execute('''
-        UPDATE game_events
-        SET is_active = TRUE
-        WHERE start_time <= ? AND end_time > ? AND is_active = FALSE
-    ''', (now.isoformat(), now.isoformat()))
+    def update_events(cursor):
+        # Активируем новые события
+        cursor.execute('''
+            UPDATE game_events
+            SET is_active = TRUE
+            WHERE start_time <= ? AND end_time > ? AND is_active = FALSE
+        ''', (now.isoformat(), now.isoformat()))
 
-    # Деактивируем завершенные события
-    cursor.execute('''
-        UPDATE game_events
-        SET is_active = FALSE
-        WHERE end_time <= ? AND is_active = TRUE
-    ''', (now.isoformat(),))
+        # Деактивируем завершенные события
+        cursor.execute('''
+            UPDATE game_events
+            SET is_active = FALSE
+            WHERE end_time <= ? AND is_active = TRUE
+        ''', (now.isoformat(),))
 
-    db.conn.commit()
+    await db.run(update_events)
 
 # ==============================
 # ФИНАЛЬНАЯ ИНТЕГРАЦИЯ СИСТЕМ
@@ -4190,27 +6413,25 @@ class GameMaster:
     @staticmethod
     async def on_player_level_up(user_id: int, old_level: int, new_level: int):
         """Обрабатывает повышение уровня игрока"""
-        player = db.get_player(user_id)
-
         # Выдаем награды за уровень
         rewards = GameUtils.calculate_level_up_rewards(new_level)
 
-        db.update_player_stats(user_id, {
-            'gold': player['gold'] + rewards['gold'],
-            'sapphires': player['sapphires'] + rewards['sapphires'],
-            'energy': GameConfig.ENERGY_MAX
+        # Энергия упирается в потолок ENERGY_MAX, то есть восстанавливается полностью
+        await db.apply_deltas(user_id, {
+            'gold': rewards['gold'],
+            'sapphires': rewards['sapphires'],
+            'energy': rewards['energy']
         })
 
         # Даем очки улучшений
-        cursor = db.conn.cursor()
-        cursor.execute('''
+        await db.execute('''
             UPDATE character_upgrades
             SET available_points = available_points + ?
             WHERE user_id = ?
         ''', (rewards['skill_points'], user_id))
 
         # Проверяем достижения
-        AchievementSystem.check_achievements(user_id, 'player_level', new_level)
+        await AchievementSystem.check_achievements(user_id, 'player_level', new_level)
 
         # Уведомляем игрока
         await notify_level_up(user_id, new_level, rewards)
@@ -4219,102 +6440,93 @@ class GameMaster:
     async def on_pvp_victory(winner_id: int, loser_id: int):
         """Обрабатывает победу в PvP"""
         # Обновляем рейтинги
-        cursor = db.conn.cursor()
-        cursor.execute('SELECT rating FROM pvp_ratings WHERE user_id = ?', (winner_id,))
-        winner_rating = cursor.fetchone()[0] if cursor.fetchone() else 1000
-
-        cursor.execute('SELECT rating FROM pvp_ratings WHERE user_id = ?', (loser_id,))
-        loser_rating = cursor.fetchone()[0] if cursor.fetchone() else 1000
+        winner_rating = await get_pvp_rating(winner_id)
+        loser_rating = await get_pvp_rating(loser_id)
 
         rating_change = calculate_rating_change(winner_rating, loser_rating)
 
-        cursor.execute('''
-            UPDATE pvp_ratings
-            SET rating = rating + ?, wins = wins + 1, last_pvp_date = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        ''', (rating_change, winner_id))
+        def save_ratings(cursor):
+            cursor.execute('''
+                UPDATE pvp_ratings
+                SET rating = rating + ?, wins = wins + 1, last_pvp_date = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+                RETURNING user_id, rating, wins, losses
+            ''', (rating_change, winner_id))
+            rows = cursor.fetchall()
 
-        cursor.execute('''
-            UPDATE pvp_ratings
-            SET rating = rating - ?, losses = losses + 1, last_pvp_date = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        ''', (rating_change, loser_id))
+            cursor.execute('''
+                UPDATE pvp_ratings
+                SET rating = rating - ?, losses = losses + 1, last_pvp_date = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+                RETURNING user_id, rating, wins, losses
+            ''', (rating_change, loser_id))
+            return rows + cursor.fetchall()
+
+        rows = await db.run(save_ratings)
+        wins = 0
+        for user_id, rating, user_wins, losses in rows:
+            if leaderboard.rank(user_id) is None:
+                player = await db.get_player(user_id)
+                leaderboard.record(user_id, rating, user_wins, losses, player['character_name'] if player else None)
+            else:
+                leaderboard.record(user_id, rating, user_wins, losses)
+            if user_id == winner_id:
+                wins = user_wins
 
         # Проверяем достижения
-        cursor.execute('SELECT wins FROM pvp_ratings WHERE user_id = ?', (winner_id,))
-        wins = cursor.fetchone()[0]
-        AchievementSystem.check_achievements(winner_id, 'pvp_wins', wins)
-
-        db.conn.commit()
+        await AchievementSystem.check_achievements(winner_id, 'pvp_wins', wins)
 
     @staticmethod
     async def on_boss_defeated(boss_id: int):
         """Обрабатывает победу над боссом"""
-        cursor = db.conn.cursor()
-
         # Находим всех участников боя с этим боссом сегодня
-        cursor.execute('''
+        participants = await db.fetchall('''
             SELECT user_id, damage_dealt
             FROM boss_battles
-            WHERE boss_id = ? AND DATE(battled_at) = DATE('now')
+            WHERE boss_id = ? AND battle_day = ?
             ORDER BY damage_dealt DESC
-        ''', (boss_id,))
-
-        participants = cursor.fetchall()
+        ''', (boss_id, boss_battle_day()))
 
         # Выдаем бонусные награды топ-3 участникам
         for i, (user_id, damage) in enumerate(participants[:3], 1):
             bonus_gold = 1000 // i  # 1000, 500, 333...
             bonus_sapphires = max(1, 3 - i)  # 3, 2, 1
 
-            player = db.get_player(user_id)
-            db.update_player_stats(user_id, {
-                'gold': player['gold'] + bonus_gold,
-                'sapphires': player['sapphires'] + bonus_sapphires
-            })
+            await db.apply_deltas(user_id, {'gold': bonus_gold, 'sapphires': bonus_sapphires})
 
             # Уведомляем игроков
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"🎉 **Бонус за босса!**\n\n"
-                    f"Ты занял {i} место по урону и получаешь:\n"
-                    f"💰 +{bonus_gold} золота\n"
-                    f"💎 +{bonus_sapphires} сапфиров",
-                    parse_mode='Markdown'
-                )
-            except:
-                pass
+            await outbox.send(
+                user_id,
+                f"🎉 **Бонус за босса!**\n\n"
+                f"Ты занял {i} место по урону и получаешь:\n"
+                f"💰 +{bonus_gold} золота\n"
+                f"💎 +{bonus_sapphires} сапфиров",
+                parse_mode='Markdown'
+            )
 
         # Проверяем достижения
         for user_id, damage in participants:
-            cursor.execute('''
+            boss_kills = await db.fetchval('''
                 SELECT COUNT(DISTINCT boss_id)
                 FROM boss_battles
                 WHERE user_id = ?
             ''', (user_id,))
-            boss_kills = cursor.fetchone()[0]
-            AchievementSystem.check_achievements(user_id, 'boss_kills', boss_kills)
-
-        db.conn.commit()
+            await AchievementSystem.check_achievements(user_id, 'boss_kills', boss_kills)
 
 async def notify_level_up(user_id: int, new_level: int, rewards: Dict):
     """Уведомляет о повышении уровня"""
-    try:
-        await bot.send_message(
-            user_id,
-            f"🎊 **Повышение уровня!**\n\n"
-            f"🎯 Новый уровень: {new_level}\n"
-            f"🏆 Награды:\n"
-            f"💰 +{rewards['gold']} золота\n"
-            f"💎 +{rewards['sapphires']} сапфиров\n"
-            f"⚡ Энергия восстановлена\n"
-            f"🔧 +{rewards['skill_points']} очков улучшений\n\n"
-            f"Напиши 'улучшить' чтобы распределить очки!",
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        print(f"Не удалось уведомить о повышении уровня: {e}")
+    await outbox.send(
+        user_id,
+        f"🎊 **Повышение уровня!**\n\n"
+        f"🎯 Новый уровень: {new_level}\n"
+        f"🏆 Награды:\n"
+        f"💰 +{rewards['gold']} золота\n"
+        f"💎 +{rewards['sapphires']} сапфиров\n"
+        f"⚡ Энергия восстановлена\n"
+        f"🔧 +{rewards['skill_points']} очков улучшений\n\n"
+        f"Напиши 'улучшить' чтобы распределить очки!",
+        parse_mode='Markdown'
+    )
 
 # ==============================
 # ОБНОВЛЕНИЕ СУЩЕСТВУЮЩИХ ФУНКЦИЙ
@@ -4354,11 +6566,8 @@ class DataRecovery:
     @staticmethod
     async def recover_player_data(user_id: int):
         """Восстанавливает данные игрока при необходимости"""
-        cursor = db.conn.cursor()
-
-        # Проверяем целостность данных
-        cursor.execute('SELECT * FROM players WHERE user_id = ?', (user_id,))
-        player = cursor.fetchone()
+        # Проверяем целостность данных: через кэш, в базе запись может быть еще не сброшена
+        player = await db.get_player(user_id)
 
         if not player:
             return False
@@ -4368,21 +6577,19 @@ class DataRecovery:
             ('pvp_ratings', 'INSERT INTO pvp_ratings (user_id) VALUES (?)'),
             ('character_upgrades', 'INSERT INTO character_upgrades (user_id, available_points) VALUES (?, ?)'),
             ('daily_rewards', 'INSERT INTO daily_rewards (user_id) VALUES (?)'),
-            ('energy_system', 'INSERT INTO energy_system (user_id, energy_accumulated) VALUES (?, ?)'),
-            ('player_mines', 'INSERT INTO player_mines (user_id) VALUES (?)')
+            ('player_mines', "INSERT INTO player_mines (user_id, collected_ts) VALUES (?, CAST(strftime('%s', 'now') AS INTEGER))")
         ]
 
-        for table, query in tables_to_check:
-            cursor.execute(f'SELECT 1 FROM {table} WHERE user_id = ?', (user_id,))
-            if not cursor.fetchone():
-                if 'available_points' in query:
-                    cursor.execute(query, (user_id, max(0, player[4] - 1) * 2))  # level
-                elif 'energy_accumulated' in query:
-                    cursor.execute(query, (user_id, GameConfig.ENERGY_MAX))
-                else:
-                    cursor.execute(query, (user_id,))
+        def restore(cursor):
+            for table, query in tables_to_check:
+                cursor.execute(f'SELECT 1 FROM {table} WHERE user_id = ?', (user_id,))
+                if not cursor.fetchone():
+                    if 'available_points' in query:
+                        cursor.execute(query, (user_id, max(0, player['level'] - 1) * 2))
+                    else:
+                        cursor.execute(query, (user_id,))
 
-        db.conn.commit()
+        await db.run(restore)
         return True
 
 # ==============================
@@ -4452,6 +6659,12 @@ async def initialize_bot():
     """Инициализирует бота при запуске"""
     print("🎮 Magic RPG Bot запускается...")
 
+    # Проверяем, что ни один текстовый хендлер не ловит все сообщения подряд
+    check_text_handlers_scoped(router)
+
+    # Обновляем схему базы данных
+    await initialize_storage()
+
     # Проверяем базу данных
     await check_database_integrity()
 
@@ -4467,13 +6680,11 @@ async def initialize_bot():
 async def check_database_integrity():
     """Проверяет целостность базы данных"""
     try:
-        cursor = db.conn.cursor()
-
         # Проверяем основные таблицы
         required_tables = ['players', 'inventory', 'clans', 'pvp_ratings', 'daily_bosses']
 
         for table in required_tables:
-            cursor.execute(f'SELECT 1 FROM {table} LIMIT 1')
+            await db.fetchone(f'SELECT 1 FROM {table} LIMIT 1')
 
         print("✅ База данных проверена")
 
@@ -4483,18 +6694,14 @@ async def check_database_integrity():
 
 async def recover_active_sessions():
     """Восстанавливает активные игровые сессии"""
-    cursor = db.conn.cursor()
-
-    # Очищаем зависшие PvP бои
-    cursor.execute('DELETE FROM pvp_battles WHERE created_at < datetime("now", "-1 hour")')
+    def cleanup(cursor):
+        # Очищаем старые королевские битвы
+        cursor.execute('DELETE FROM royal_battles WHERE created_at < datetime("now", "-3 hour")')
 
-    # Очищаем старые королевские битвы
-    cursor.execute('DELETE FROM royal_battles WHERE created_at < datetime("now", "-3 hour")')
+        # Очищаем завершенные тёмные охоты
+        cursor.execute('DELETE FROM dark_hunt_sessions WHERE created_at < datetime("now", "-1 hour")')
 
-    # Очищаем завершенные тёмные охоты
-    cursor.execute('DELETE FROM dark_hunt_sessions WHERE created_at < datetime("now", "-1 hour")')
-
-    db.conn.commit()
+    await db.run(cleanup)
     print("✅ Активные сессии восстановлены")
 
 # ==============================
@@ -4530,9 +6737,25 @@ async def error_handler(update: types.Update, exception: Exception):
 # ЗАПУСК БОТА
 # ==============================
 
+async def check_telegram_connection() -> bool:
+    """Проверяет, что API Telegram доступен, до запуска бота"""
+    try:
+        import aiohttp
+        async with aiohttp.ClientSession() as session:
+            async with session.get('https://api.telegram.org') as resp:
+                print(f"Telegram API доступен: {resp.status}")
+    except Exception as e:
+        print(f"❌ Нет подключения к Telegram: {e}")
+        return False
+    return True
+
 async def main():
     """Главная функция запуска бота"""
 
+    # Проверка подключения
+    if not await check_telegram_connection():
+        return
+
     # Инициализируем бота
     await initialize_bot()
 
@@ -4546,23 +6769,18 @@ async def main():
     await bot.delete_webhook(drop_pending_updates=True)
 
     # Запускаем опрос
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    try:
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        # Сохраняем изменения игроков и боссов, которые еще не попали в базу
+        await outbox.drain()
+        await db.flush_players()
+        await boss_health.flush()
 
 # ==============================
 # ТОЧКА ВХОДА ПРОГРАММЫ
 # ==============================
 
-async def main():
-    # Проверка подключения
-    try:
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.get('https://api.telegram.org') as resp:
-                print(f"Telegram API доступен: {resp.status}")
-    except Exception as e:
-        print(f"❌ Нет подключения к Telegram: {e}")
-        return
-
 if __name__ == "__main__":
     try:
         asyncio.run(main())
@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    # Bot при импорте открывает magic_rpg.db в текущем каталоге
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(ROOT)
+    import Bot
+
+    db = Bot.Database(str(tmp_path / 'test.db'))
+    yield db
+    db.executor.shutdown()
+    db.read_executor.shutdown()
+    db.conn.close()
+
+
+def test_concurrent_get_player_waiters_see_load_error(database):
+    loads = []
+
+    async def failing_read(func, *args, readonly=False):
+        loads.append(args)
+        await asyncio.sleep(0)
+        raise RuntimeError('database is locked')
+
+    database._read = failing_read
+
+    async def scenario():
+        return await asyncio.gather(database.get_player(1), database.get_player(1), return_exceptions=True)
+
+    first, second = asyncio.run(scenario())
+    assert isinstance(first, RuntimeError)
+    assert isinstance(second, RuntimeError)
+    assert len(loads) == 1
+    assert database._loading == {}
+    assert 1 not in database._players
+
+
+def test_concurrent_get_player_share_one_load(database):
+    loads = []
+
+    async def read(func, *args, readonly=False):
+        loads.append(args)
+        await asyncio.sleep(0)
+        return {'user_id': 1, 'gold': 100, 'energy': 10, 'energy_ts': 0}
+
+    database._read = read
+    database._start_flusher = lambda: None
+
+    async def scenario():
+        return await asyncio.gather(database.get_player(1), database.get_player(1))
+
+    first, second = asyncio.run(scenario())
+    assert first['gold'] == second['gold'] == 100
+    assert len(loads) == 1